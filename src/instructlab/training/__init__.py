@@ -1,8 +1,10 @@
 __all__ = (
+    "ActivationCheckpointingPolicy",
     "DataProcessArgs",
     "DeepSpeedOffloadStrategy",
     "DeepSpeedOptions",
     "LoraOptions",
+    "OptimizerType",
     "QuantizeDataType",
     "TorchrunArgs",
     "TrainingArgs",
@@ -10,16 +12,20 @@ __all__ = (
     "FSDPOptions",
     "ShardingStrategies",
     "DistributedBackend",
+    "EmptyCacheMode",
 )
 
 # Local
 from .config import (
+    ActivationCheckpointingPolicy,
     DataProcessArgs,
     DeepSpeedOffloadStrategy,
     DeepSpeedOptions,
     DistributedBackend,
+    EmptyCacheMode,
     FSDPOptions,
     LoraOptions,
+    OptimizerType,
     QuantizeDataType,
     ShardingStrategies,
     TorchrunArgs,
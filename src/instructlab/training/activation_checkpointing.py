@@ -0,0 +1,84 @@
+# SPDX-License-Identifier: Apache-2.0
+
+# Standard
+from typing import Optional, Set
+
+# First Party
+from instructlab.training.config import ActivationCheckpointingPolicy
+
+
+def estimate_block_activation_bytes(
+    hidden_size: int, intermediate_size: Optional[int] = None, dtype_bytes: int = 2
+) -> int:
+    """
+    Rough size of the activations a decoder block keeps for the backward pass, per
+    token, with flash attention (no attention matrix is saved): the inputs and outputs
+    of both norms, the q/k/v, attention and output projections, and the gate, up,
+    activation and down projection inputs of the MLP.
+    """
+    intermediate_size = intermediate_size or 4 * hidden_size
+    return dtype_bytes * (10 * hidden_size + 4 * intermediate_size)
+
+
+def select_blocks_to_checkpoint(
+    num_blocks: int,
+    policy: ActivationCheckpointingPolicy,
+    every_n: int = 1,
+    memory_budget_bytes: Optional[float] = None,
+    block_bytes: int = 0,
+    checkpointed_block_bytes: int = 0,
+) -> Set[int]:
+    """
+    Returns the indices of the decoder blocks to wrap in activation checkpointing.
+
+    With `MEMORY_BUDGET`, as many blocks as fit in `memory_budget_bytes` keep their
+    activations (`block_bytes` each), while every other block only keeps its input
+    (`checkpointed_block_bytes`) and recomputes the rest in the backward pass. The
+    last blocks are the ones left uncheckpointed.
+    """
+    policy = ActivationCheckpointingPolicy(policy)
+    if policy == ActivationCheckpointingPolicy.FULL:
+        return set(range(num_blocks))
+    if policy == ActivationCheckpointingPolicy.NONE:
+        return set()
+    if policy == ActivationCheckpointingPolicy.EVERY_N:
+        if every_n < 1:
+            raise ValueError(f"every_n must be at least 1, got {every_n}")
+        return set(range(0, num_blocks, every_n))
+
+    if memory_budget_bytes is None:
+        raise ValueError(
+            "A memory budget is required by the memory_budget activation checkpointing policy"
+        )
+    saved_per_block = block_bytes - checkpointed_block_bytes
+    free_bytes = memory_budget_bytes - num_blocks * checkpointed_block_bytes
+    num_kept = int(free_bytes // saved_per_block) if saved_per_block > 0 else num_blocks
+    num_kept = min(max(num_kept, 0), num_blocks)
+    return set(range(num_blocks - num_kept))
+
+
+def plan_activation_checkpointing(args, model_config, num_blocks: int) -> Set[int]:
+    """
+    Picks the blocks to checkpoint for `args.activation_checkpointing`, sizing the
+    activations for the longest micro-batch the sampler packs on one GPU.
+    """
+    hidden_size = getattr(model_config, "hidden_size", None) or model_config.n_embd
+    intermediate_size = getattr(model_config, "intermediate_size", None) or getattr(
+        model_config, "n_inner", None
+    )
+    tokens_per_micro_batch = args.packing_max_batch_len or args.max_batch_len
+    memory_budget_bytes = (
+        args.activation_memory_budget_gb * 1024**3
+        if args.activation_memory_budget_gb
+        else None
+    )
+    return select_blocks_to_checkpoint(
+        num_blocks,
+        policy=args.activation_checkpointing,
+        every_n=args.activation_checkpointing_every_n,
+        memory_budget_bytes=memory_budget_bytes,
+        block_bytes=tokens_per_micro_batch
+        * estimate_block_activation_bytes(hidden_size, intermediate_size),
+        # a checkpointed block only keeps its input hidden states
+        checkpointed_block_bytes=tokens_per_micro_batch * hidden_size * 2,
+    )
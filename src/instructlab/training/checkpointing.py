@@ -0,0 +1,468 @@
+# SPDX-License-Identifier: Apache-2.0
+
+# Standard
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Dict, List, Optional
+import json
+import math
+import os
+import re
+import shutil
+import threading
+import time
+
+# Third Party
+from accelerate import Accelerator
+from huggingface_hub import split_torch_state_dict_into_shards
+from instructlab.dolomite.hf_models import export_to_huggingface
+from safetensors import safe_open
+from safetensors.torch import save_file
+from torch.distributed.fsdp import FullyShardedDataParallel as FSDP
+import torch
+
+# First Party
+from instructlab.training.utils import add_missing_architectures, log_rank_0
+
+# prefixes added to parameter names by FSDP, activation checkpointing and torch.compile
+WRAPPER_PREFIXES = re.compile(
+    r"(_fsdp_wrapped_module\.|_checkpoint_wrapped_module\.|_orig_mod\.)"
+)
+
+
+def snapshot_state_dict(state_dict: dict) -> dict:
+    """
+    Copies a state dict to host memory so training can keep updating the parameters
+    while the copy is written. GPU tensors are copied into pinned buffers (reused by
+    torch's caching host allocator across saves) with a single sync at the end. CPU
+    tensors are already gathered copies, e.g. FSDP's full state dict offloaded to CPU.
+    Tensors sharing storage, such as tied embeddings, are only kept once.
+    """
+    snapshot = {}
+    seen_storages = set()
+    copied_from_gpu = False
+    for name, tensor in state_dict.items():
+        storage = (tensor.device, tensor.untyped_storage().data_ptr())
+        if storage in seen_storages:
+            continue
+        seen_storages.add(storage)
+
+        if tensor.is_cuda:
+            host = torch.empty(
+                tensor.shape, dtype=tensor.dtype, device="cpu", pin_memory=True
+            )
+            host.copy_(tensor.detach(), non_blocking=True)
+            snapshot[name] = host
+            copied_from_gpu = True
+        else:
+            snapshot[name] = tensor.detach().contiguous()
+
+    if copied_from_gpu:
+        torch.cuda.current_stream().synchronize()
+    return snapshot
+
+
+def write_safetensors(state_dict: dict, output_dir: Path, max_shard_size="5GB"):
+    """Writes `state_dict` as (sharded) safetensors files, like `save_pretrained`."""
+    split = split_torch_state_dict_into_shards(
+        state_dict, max_shard_size=max_shard_size
+    )
+    for filename, tensor_names in split.filename_to_tensors.items():
+        shard = {name: state_dict[name] for name in tensor_names}
+        save_file(shard, output_dir / filename, metadata={"format": "pt"})
+    if split.is_sharded:
+        index = {"metadata": split.metadata, "weight_map": split.tensor_to_filename}
+        with open(output_dir / "model.safetensors.index.json", "w") as f:
+            json.dump(index, f, indent=2, sort_keys=True)
+
+
+def merge_lora_weight(
+    weight: torch.Tensor, lora_a: torch.Tensor, lora_b: torch.Tensor, scaling: float
+) -> torch.Tensor:
+    """Returns `weight + lora_b @ lora_a * scaling`, computed in float32."""
+    delta = lora_b.float() @ lora_a.float()
+    return (weight.float() + delta * scaling).to(weight.dtype)
+
+
+def _owned_modules(module):
+    # `module` and its descendants, up to the FSDP units nested inside of it
+    yield module
+    for child in module.children():
+        if not isinstance(child, FSDP):
+            yield from _owned_modules(child)
+
+
+def gather_lora_state_dict(model, is_main_process: bool) -> Dict[str, torch.Tensor]:
+    """
+    Copies the LoRA adapter weights of `model` to the CPU of the main process, keyed
+    like the base model's weights, e.g. `model.layers.0.mlp.up_proj.lora_A.default.weight`.
+
+    With FSDP this must be called on every rank. The FSDP units are unsharded one at a
+    time, so besides the adapters at most one unit is ever gathered.
+    """
+    # Third Party
+    from peft import LoraModel
+
+    lora_model = next(m for m in model.modules() if isinstance(m, LoraModel))
+    module_names = {
+        module: WRAPPER_PREFIXES.sub("", name)
+        for name, module in lora_model.model.named_modules()
+    }
+
+    lora_state = {}
+
+    def collect(modules):
+        for module in modules:
+            name = module_names.get(module)
+            if name is None or not re.search(r"\.lora_[AB]\.", f"{name}."):
+                continue
+            for param_name, param in module.named_parameters(recurse=False):
+                lora_state[f"{name}.{param_name}"] = param.detach().to("cpu", copy=True)
+
+    fsdp_units = FSDP.fsdp_modules(model)
+    if not fsdp_units:
+        if is_main_process:
+            collect(model.modules())
+        return lora_state
+
+    for unit in fsdp_units:
+        with FSDP.summon_full_params(
+            unit, recurse=False, writeback=False, rank0_only=True, offload_to_cpu=True
+        ):
+            if is_main_process:
+                collect(_owned_modules(unit.module))
+    return lora_state
+
+
+def stream_merge_lora(
+    base_files: List[Path],
+    lora_state: Dict[str, torch.Tensor],
+    output_dir: Path,
+    scaling: float,
+    dtype: torch.dtype = torch.bfloat16,
+    max_shard_size: int = 5 * 10**9,
+):
+    """
+    Writes the base model stored in the safetensors `base_files` to `output_dir` with the
+    adapters of `lora_state` (as returned by `gather_lora_state_dict`) merged into it.
+
+    Output shards are planned from the safetensors headers, then read, merged and
+    written one at a time, so only a single shard of the model is held in memory
+    instead of a merged copy of the whole model.
+    """
+    adapters = {}
+    for name, tensor in lora_state.items():
+        module, kind = re.match(r"(.+)\.lora_([AB])\.", name).groups()
+        adapters.setdefault(f"{module}.weight", {})[kind] = tensor
+    incomplete = [name for name, lora in adapters.items() if set(lora) != {"A", "B"}]
+    if incomplete:
+        raise ValueError(
+            f"LoRA adapters are missing their A or B weights: {sorted(incomplete)}"
+        )
+
+    shards = []
+    shard, shard_size = [], 0
+    for path in base_files:
+        handle = safe_open(path, framework="pt")
+        for name in handle.keys():
+            size = math.prod(handle.get_slice(name).get_shape()) * dtype.itemsize
+            if shard and shard_size + size > max_shard_size:
+                shards.append(shard)
+                shard, shard_size = [], 0
+            shard.append((name, handle))
+            shard_size += size
+    if shard:
+        shards.append(shard)
+
+    missing = adapters.keys() - {name for shard in shards for name, _ in shard}
+    if missing:
+        raise ValueError(
+            f"LoRA adapters target weights that are not in the base model: {sorted(missing)}"
+        )
+
+    weight_map = {}
+    total_size = 0
+    for index, shard in enumerate(shards, start=1):
+        if len(shards) == 1:
+            filename = "model.safetensors"
+        else:
+            filename = f"model-{index:05d}-of-{len(shards):05d}.safetensors"
+        tensors = {}
+        for name, handle in shard:
+            tensor = handle.get_tensor(name)
+            if name in adapters:
+                lora = adapters[name]
+                tensor = merge_lora_weight(tensor, lora["A"], lora["B"], scaling)
+            tensors[name] = tensor.to(dtype)
+            weight_map[name] = filename
+            total_size += tensors[name].numel() * tensors[name].element_size()
+        save_file(tensors, Path(output_dir) / filename, metadata={"format": "pt"})
+        del tensors
+
+    if len(shards) > 1:
+        index = {"metadata": {"total_size": total_size}, "weight_map": weight_map}
+        with open(Path(output_dir) / "model.safetensors.index.json", "w") as f:
+            json.dump(index, f, indent=2, sort_keys=True)
+
+
+class AsyncCheckpointSaver:
+    """
+    Saves `hf_format` checkpoints without stopping training for the write.
+
+    Every rank takes part in gathering the state dict, then the main process copies it
+    to host memory and hands it to a background thread, which writes the safetensors
+    shards (and runs the dolomite to HF export when needed) while training continues.
+    Checkpoints are written to a staging directory and renamed once complete, so a
+    directory under `hf_format` is never partially written.
+
+    At most `max_in_flight` snapshots are held in host memory; saving while that many
+    writes are pending blocks until the oldest one finishes. Completed saves are logged
+    to `metric_logger`. Errors from the background thread are raised on the next call
+    to `save` or `wait`.
+    """
+
+    def __init__(
+        self,
+        metric_logger=None,
+        max_in_flight: int = 1,
+        retention: Optional["CheckpointRetention"] = None,
+    ):
+        self.metric_logger = metric_logger
+        self.max_in_flight = max_in_flight
+        self.retention = retention
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="checkpoint-save"
+        )
+        self._in_flight: deque[Future] = deque()
+
+    def _drain(self, max_pending: int):
+        while len(self._in_flight) > max_pending:
+            self._in_flight.popleft().result()
+
+    def wait(self):
+        """Blocks until every pending checkpoint is written."""
+        self._drain(0)
+
+    def save(
+        self,
+        args,
+        model,
+        tokenizer,
+        accelerator: Accelerator,
+        samples_seen: int,
+        metric: Optional[float] = None,
+    ):
+        start = time.time()
+        # collective on every rank, only the main process gets the full state dict
+        state_dict = accelerator.get_state_dict(model, unwrap=False)
+        if not accelerator.is_main_process:
+            return
+
+        self._drain(self.max_in_flight - 1)
+        snapshot = snapshot_state_dict(state_dict)
+        del state_dict
+
+        convert_dolomite = args.model_type not in ("gpt_megatron", "gpt_dolomite")
+        model_config = accelerator.unwrap_model(model).config
+        if convert_dolomite:
+            add_missing_architectures(args, model_config)
+        config_json = model_config.to_json_string()
+
+        snapshot_time = time.time() - start
+        log_rank_0(
+            f"\033[93mSnapshot of the model at samples_seen: {samples_seen} took {snapshot_time:.2f} seconds, writing it in the background\033[0m",
+            to_print=True,
+        )
+        self._in_flight.append(
+            self._executor.submit(
+                self._write,
+                args=args,
+                tokenizer=tokenizer,
+                snapshot=snapshot,
+                config_json=config_json,
+                samples_seen=samples_seen,
+                convert_dolomite=args.use_dolomite and convert_dolomite,
+                snapshot_time=snapshot_time,
+                metric=metric,
+            )
+        )
+
+    def _write(
+        self,
+        args,
+        tokenizer,
+        snapshot: dict,
+        config_json: str,
+        samples_seen: int,
+        convert_dolomite: bool,
+        snapshot_time: float,
+        metric: Optional[float],
+    ):
+        start = time.time()
+        final_output_dir = (
+            Path(args.output_dir) / "hf_format" / f"samples_{samples_seen}"
+        )
+        staging_dir = final_output_dir.with_name(final_output_dir.name + ".tmp")
+        if staging_dir.exists():
+            shutil.rmtree(staging_dir)
+        staging_dir.mkdir(parents=True)
+
+        with TemporaryDirectory("w") as tmpdir:
+            output_dir = Path(tmpdir) if convert_dolomite else staging_dir
+            (output_dir / "config.json").write_text(config_json)
+            tokenizer.save_pretrained(output_dir)
+            write_safetensors(snapshot, output_dir)
+            del snapshot
+
+            if convert_dolomite:
+                # export doesnt like the directory to exist
+                staging_dir.rmdir()
+                export_to_huggingface(
+                    pretrained_model_name_or_path=tmpdir,
+                    save_path=staging_dir,
+                    model_type=args.model_type,
+                )
+
+        if final_output_dir.exists():
+            shutil.rmtree(final_output_dir)
+        staging_dir.rename(final_output_dir)
+        if self.retention is not None:
+            self.retention.register(
+                final_output_dir.parent,
+                final_output_dir.name,
+                metric=metric,
+                samples_seen=samples_seen,
+            )
+
+        write_time = time.time() - start
+        print(
+            f"\033[93mModel saved in {final_output_dir}, writing took {write_time:.2f} seconds\033[0m"
+        )
+        if self.metric_logger is not None:
+            self.metric_logger.log_sync(
+                {
+                    "checkpoint_saved": str(final_output_dir),
+                    "samples_seen": samples_seen,
+                    "snapshot_seconds": snapshot_time,
+                    "write_seconds": write_time,
+                }
+            )
+
+
+MANIFEST_NAME = "manifest.json"
+
+
+def read_manifest(root: Path) -> Optional[dict]:
+    """
+    Returns the checkpoint manifest of `root` (e.g. `<output_dir>/full_state`), or None
+    if it was never written. `latest` names the most recent checkpoint and `entries`
+    lists the checkpoints that still exist, oldest first.
+    """
+    try:
+        with open(Path(root) / MANIFEST_NAME) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def write_manifest(root: Path, manifest: dict):
+    # write then rename, so readers never see a partially written manifest
+    tmp_path = Path(root) / f".{MANIFEST_NAME}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, Path(root) / MANIFEST_NAME)
+
+
+def select_checkpoints_to_delete(
+    entries: List[dict], keep_last: int, keep_best: int = 0, keep_every: int = 0
+) -> List[str]:
+    """
+    Returns the names of the checkpoints in `entries` (oldest first) that are not
+    among the `keep_last` most recent ones, the `keep_best` ones with the lowest
+    `metric`, or every `keep_every`th one saved. Nothing is deleted when `keep_last`
+    is 0.
+    """
+    if keep_last <= 0:
+        return []
+
+    keep = {entry["name"] for entry in entries[-keep_last:]}
+    if keep_best > 0:
+        scored = [entry for entry in entries if entry.get("metric") is not None]
+        scored.sort(key=lambda entry: entry["metric"])
+        keep.update(entry["name"] for entry in scored[:keep_best])
+    if keep_every > 0:
+        keep.update(
+            entry["name"] for entry in entries if entry["index"] % keep_every == 0
+        )
+    return [entry["name"] for entry in entries if entry["name"] not in keep]
+
+
+class CheckpointRetention:
+    """
+    Tracks the checkpoints saved under a directory such as `<output_dir>/hf_format` in
+    a manifest, and rotates them according to `select_checkpoints_to_delete`.
+
+    Deleted checkpoints are dropped from the manifest first and then removed from disk
+    on a background thread. Must only be used from the main process, where both the
+    training loop and the `AsyncCheckpointSaver` worker register checkpoints, so
+    updating the manifest and scheduling deletions is serialized by a lock.
+    """
+
+    def __init__(self, keep_last: int = 0, keep_best: int = 0, keep_every: int = 0):
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.keep_every = keep_every
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="checkpoint-cleanup"
+        )
+        self._deletions: List[Future] = []
+        self._lock = threading.Lock()
+
+    def register(self, root: Path, name: str, metric: Optional[float] = None, **info):
+        """Records the new checkpoint `root / name` and deletes the expired ones."""
+        with self._lock:
+            self._register(Path(root), name, metric, **info)
+
+    def _register(self, root: Path, name: str, metric: Optional[float], **info):
+        manifest = read_manifest(root) or {
+            "latest": None,
+            "num_saved": 0,
+            "entries": [],
+        }
+        manifest["num_saved"] += 1
+        entries = [entry for entry in manifest["entries"] if entry["name"] != name]
+        entries.append(
+            {
+                "name": name,
+                "index": manifest["num_saved"],
+                "metric": metric,
+                "time": time.time(),
+                **info,
+            }
+        )
+
+        expired = select_checkpoints_to_delete(
+            entries, self.keep_last, self.keep_best, self.keep_every
+        )
+        manifest["entries"] = [
+            entry for entry in entries if entry["name"] not in expired
+        ]
+        manifest["latest"] = name
+        write_manifest(root, manifest)
+
+        for expired_name in expired:
+            print(f"\033[93mRemoving expired checkpoint {root / expired_name}\033[0m")
+            self._deletions.append(
+                self._executor.submit(
+                    shutil.rmtree, root / expired_name, ignore_errors=True
+                )
+            )
+
+    def wait(self):
+        """Blocks until the expired checkpoints are deleted."""
+        with self._lock:
+            deletions, self._deletions = self._deletions, []
+        for deletion in deletions:
+            deletion.result()
@@ -34,6 +34,49 @@ class DistributedBackend(Enum):
     DEEPSPEED: str = "deepspeed"
 
 
+# public API
+class EmptyCacheMode(Enum):
+    """
+    Defines when the unused blocks held by the CUDA caching allocator are released
+    during training.
+    """
+
+    NEVER = "never"
+    ALWAYS = "always"
+    # only when the allocator had to retry allocations or the cache is fragmented
+    ADAPTIVE = "adaptive"
+
+
+# public API
+class OptimizerType(Enum):
+    """
+    Defines the optimizer used with FSDP, DeepSpeed always uses its own
+    FusedAdam or DeepSpeedCPUAdam.
+    """
+
+    ADAMW = "adamw"
+    ADAMW_FUSED = "adamw_fused"
+    ADAMW_FOREACH = "adamw_foreach"
+    # both Adam moments in 8 bits, requires bitsandbytes
+    ADAMW_8BIT = "adamw_8bit"
+    # both Adam moments in bfloat16
+    ADAMW_BF16_STATE = "adamw_bf16_state"
+
+
+class ActivationCheckpointingPolicy(Enum):
+    """
+    Defines which decoder blocks recompute their activations in the backward pass
+    instead of keeping them in memory.
+    """
+
+    FULL = "full"
+    NONE = "none"
+    # every Nth block, see `activation_checkpointing_every_n`
+    EVERY_N = "every_n"
+    # as few blocks as fit in `activation_memory_budget_gb`
+    MEMORY_BUDGET = "memory_budget"
+
+
 # public API
 class QuantizeDataType(Enum):
     """
@@ -137,6 +180,10 @@ class FSDPOptions(BaseModel):
 
     cpu_offload_params: Optional[bool] = False
     sharding_strategy: ShardingStrategies = ShardingStrategies.SHARD_GRAD_OP
+    # every rank writes its own shards of full state checkpoints in parallel
+    sharded_checkpoint: bool = False
+    # only local rank 0 reads the base weights, the other ranks start from the meta device
+    cpu_ram_efficient_loading: bool = False
 
 
 # public API
@@ -172,13 +219,59 @@ class TrainingArgs(BaseModel):
     num_epochs: int
     effective_batch_size: int
     save_samples: int
+    # steps between metric logs, metrics stay on the GPU in between
+    log_interval: int = 1
+    empty_cache: EmptyCacheMode = EmptyCacheMode.ADAPTIVE
+    activation_checkpointing: ActivationCheckpointingPolicy = (
+        ActivationCheckpointingPolicy.FULL
+    )
+    activation_checkpointing_every_n: int = 2
+    # GiB per GPU available to the activations kept for the backward pass
+    activation_memory_budget_gb: Optional[float] = None
+    # used for the model FLOPs utilization metric, detected for common GPUs when unset
+    peak_tflops_per_gpu: Optional[float] = None
+    # log histograms of the time spent in each phase of a step every N steps, 0 disables it
+    profile_step_phases: int = 0
+    # capture a torch.profiler trace for the steps START:END
+    torch_profiler_steps: Optional[str] = None
     learning_rate: float
     warmup_steps: int
     random_seed: int = 42
     use_dolomite: bool = False
+    # compile the decoder blocks, padding batches to compile_num_buckets lengths
+    torch_compile: bool = False
+    compile_num_buckets: int = 8
+    optimizer: OptimizerType = OptimizerType.ADAMW
+    adam_beta1: float = 0.9
+    adam_beta2: float = 0.95
+    # biases and norm weights are not decayed, unless an FSDP flat parameter mixes them with weights
+    weight_decay: float = 0.0
+    # with FSDP, only reduce-scatter gradients on the last micro-step of each accumulation window
+    grad_accum_no_sync: bool = False
+    # with FSDP, end optimizer steps after this many loss-counted tokens on all ranks, 0 disables it
+    target_tokens_per_step: int = 0
+    # retry steps that ran out of memory with a smaller packing capacity
+    oom_recovery: bool = False
+    # compute the loss (and the LM head of HF models) this many tokens at a time, 0 disables chunking
+    loss_chunk_size: int = 0
+    # where HF checkpoints converted for dolomite are cached, ~/.cache/instructlab/dolomite when unset
+    dolomite_cache_dir: Optional[str] = None
     is_padding_free: bool = False  # TODO: deprecate
     checkpoint_at_epoch: bool = True
+    # balance the estimated attention + dense compute of every multipack step across ranks
+    multipack_balance_cost: bool = False
+    # train on the samples that did not fill the last multipack step at the start of the next epoch
+    multipack_carry_over_tail: bool = False
     accelerate_full_state_at_epoch: bool = True
+    # also save the full state with every save_samples checkpoint, to resume mid-epoch
+    accelerate_full_state_at_save: bool = False
+    # write hf_format checkpoints in the background while training continues
+    async_checkpoint: bool = False
+    max_in_flight_checkpoints: int = 1
+    # checkpoint rotation, every checkpoint is kept when keep_last_checkpoints is 0
+    keep_last_checkpoints: int = 0
+    keep_best_checkpoints: int = 0
+    keep_every_nth_checkpoint: int = 0
 
     mock_data: Optional[bool] = False
     mock_data_len: int = 0
@@ -0,0 +1,180 @@
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Offline consolidation of sharded FSDP checkpoints.
+
+With `--fsdp_sharded_checkpoint`, every rank writes its own shards of the full state
+through `torch.distributed.checkpoint`, so saving never gathers the model on one rank.
+This merges the shards of such a checkpoint back into a HuggingFace model directory,
+on CPU and without a process group:
+
+    python -m instructlab.training.consolidate_checkpoint \\
+        --checkpoint_dir=/path/to/output_dir/full_state/epoch_0 \\
+        --model_path=/path/to/base/model \\
+        --output_dir=/path/to/consolidated
+"""
+
+# Standard
+from pathlib import Path
+from typing import Dict, Optional
+import argparse
+import json
+import shutil
+
+# Third Party
+from torch.distributed.checkpoint import FileSystemReader
+from torch.distributed.checkpoint.default_planner import _EmptyStateDictLoadPlanner
+from torch.distributed.checkpoint.state_dict_loader import _load_state_dict
+import torch
+
+# First Party
+from instructlab.training.checkpointing import (
+    WRAPPER_PREFIXES,
+    merge_lora_weight,
+    write_safetensors,
+)
+
+# directory accelerate writes the sharded model of `save_state` into
+FSDP_MODEL_DIR = "pytorch_model_fsdp_0"
+
+# prefix PEFT adds to the names of the base model's weights
+PEFT_PREFIX = "base_model.model."
+
+# files copied along with the weights from the model the checkpoint was trained from
+MODEL_FILES = (
+    "config.json",
+    "generation_config.json",
+    "tokenizer.json",
+    "tokenizer_config.json",
+    "tokenizer.model",
+    "special_tokens_map.json",
+    "added_tokens.json",
+)
+
+
+def load_sharded_model_state(checkpoint_dir: str) -> Dict[str, torch.Tensor]:
+    """
+    Reads every shard of a `torch.distributed.checkpoint` model checkpoint into one
+    state dict. `checkpoint_dir` is either the sharded model directory itself or the
+    `full_state/epoch_N` directory containing it.
+    """
+    checkpoint_dir = Path(checkpoint_dir)
+    if not (checkpoint_dir / ".metadata").exists():
+        checkpoint_dir = checkpoint_dir / FSDP_MODEL_DIR
+
+    state_dict = {}
+    _load_state_dict(
+        state_dict,
+        storage_reader=FileSystemReader(checkpoint_dir),
+        planner=_EmptyStateDictLoadPlanner(),
+        no_dist=True,
+    )
+    # accelerate nests the model weights under "model"
+    return state_dict.get("model", state_dict)
+
+
+def clean_state_dict_keys(state_dict: Dict[str, torch.Tensor]):
+    cleaned = {}
+    for key, tensor in state_dict.items():
+        key = WRAPPER_PREFIXES.sub("", key)
+        if key.startswith(PEFT_PREFIX):
+            key = key[len(PEFT_PREFIX) :]
+        cleaned[key] = tensor
+    return cleaned
+
+
+def merge_lora_weights(
+    state_dict: Dict[str, torch.Tensor], lora_alpha: float, lora_r: int
+) -> Dict[str, torch.Tensor]:
+    """
+    Folds the LoRA adapters of PEFT modules into their base weights,
+    `W + B @ A * lora_alpha / lora_r`, and drops the adapter tensors.
+    """
+    scaling = lora_alpha / lora_r
+    merged = {}
+    for key, tensor in state_dict.items():
+        if ".lora_A." in key or ".lora_B." in key:
+            continue
+        if ".base_layer." not in key:
+            merged[key] = tensor
+            continue
+
+        module, param = key.split(".base_layer.")
+        lora_a = [k for k in state_dict if k.startswith(f"{module}.lora_A.")]
+        if param == "weight" and lora_a:
+            lora_b = lora_a[0].replace(".lora_A.", ".lora_B.")
+            tensor = merge_lora_weight(
+                tensor, state_dict[lora_a[0]], state_dict[lora_b], scaling
+            )
+        merged[f"{module}.{param}"] = tensor
+    return merged
+
+
+def consolidate_checkpoint(
+    checkpoint_dir: str,
+    model_path: str,
+    output_dir: str,
+    lora_alpha: Optional[float] = None,
+    lora_r: Optional[int] = None,
+    dtype: torch.dtype = torch.bfloat16,
+):
+    state_dict = clean_state_dict_keys(load_sharded_model_state(checkpoint_dir))
+    if any(".lora_A." in key for key in state_dict):
+        if not lora_r or lora_alpha is None:
+            raise ValueError(
+                "The checkpoint contains LoRA adapters, `lora_r` and `lora_alpha` are needed to merge them."
+            )
+        state_dict = merge_lora_weights(state_dict, lora_alpha, lora_r)
+    state_dict = {key: tensor.to(dtype) for key, tensor in state_dict.items()}
+
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    for name in MODEL_FILES:
+        if (Path(model_path) / name).exists():
+            shutil.copy(Path(model_path) / name, output_dir / name)
+
+    # the embeddings are resized during training when the tokenizer has more tokens
+    embeddings = state_dict.get("model.embed_tokens.weight")
+    config_file = output_dir / "config.json"
+    if embeddings is not None and config_file.exists():
+        with open(config_file) as f:
+            config = json.load(f)
+        config["vocab_size"] = embeddings.shape[0]
+        with open(config_file, "w") as f:
+            json.dump(config, f, indent=2)
+
+    write_safetensors(state_dict, output_dir)
+    print(f"\033[92mConsolidated {checkpoint_dir} into {output_dir}\033[0m")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Consolidate a sharded FSDP full_state checkpoint into HuggingFace format"
+    )
+    parser.add_argument(
+        "--checkpoint_dir",
+        type=str,
+        required=True,
+        help="A full_state/epoch_N directory saved with --fsdp_sharded_checkpoint",
+    )
+    parser.add_argument(
+        "--model_path",
+        type=str,
+        required=True,
+        help="Model the checkpoint was trained from, its config and tokenizer are copied",
+    )
+    parser.add_argument("--output_dir", type=str, required=True)
+    parser.add_argument("--lora_r", type=int, default=None)
+    parser.add_argument("--lora_alpha", type=float, default=None)
+    parser.add_argument(
+        "--dtype", type=str, default="bfloat16", choices=["bfloat16", "float32"]
+    )
+    args = parser.parse_args()
+    consolidate_checkpoint(
+        checkpoint_dir=args.checkpoint_dir,
+        model_path=args.model_path,
+        output_dir=args.output_dir,
+        lora_alpha=args.lora_alpha,
+        lora_r=args.lora_r,
+        dtype=getattr(torch, args.dtype),
+    )
@@ -1,6 +1,7 @@
 # SPDX-License-Identifier: Apache-2.0
 
 # Standard
+from contextlib import nullcontext
 from copy import deepcopy
 from pathlib import Path
 import argparse
@@ -46,21 +47,53 @@ import torch.distributed
 
 # First Party
 from instructlab.training import config
+from instructlab.training.activation_checkpointing import (
+    plan_activation_checkpointing,
+)
 from instructlab.training.async_logger import AsyncStructuredLogger
 
 # pylint: disable=no-name-in-module
+from instructlab.training.checkpointing import (
+    AsyncCheckpointSaver,
+    CheckpointRetention,
+)
 from instructlab.training.config import (
+    ActivationCheckpointingPolicy,
     DataProcessArgs,
     DistributedBackend,
+    EmptyCacheMode,
+    OptimizerType,
     TorchrunArgs,
     TrainingArgs,
 )
+from instructlab.training.memory import EmptyCachePolicy
+from instructlab.training.metrics import (
+    StepMetrics,
+    ThroughputTracker,
+    get_peak_tflops,
+)
 from instructlab.training.multipack_sampler import (
     find_packing_max_batch_len_and_grad_accum,
 )
+from instructlab.training.oom_recovery import OOMGuard, iterate_epoch, recover_step
+from instructlab.training.optimizers import (
+    OptimizerStats,
+    create_optimizer,
+    make_param_groups,
+)
+from instructlab.training.profiler import StepPhaseProfiler, parse_step_range
 from instructlab.training.setup_accelerator import setup_accelerator
 from instructlab.training.token_dataset import setup_dataloader, setup_dataset
+from instructlab.training.token_budget import (
+    TokenBudget,
+    advance_lr_scheduler,
+    num_token_budget_steps,
+)
 from instructlab.training.tokenizer_utils import setup_tokenizer
+from instructlab.training.torch_compile import (
+    compile_decoder_blocks,
+    make_length_buckets,
+)
 from instructlab.training.utils import (
     StreamablePopen,
     add_noisy_embeddings,
@@ -71,8 +104,10 @@ from instructlab.training.utils import (
     create_lora_config,
     ensure_loadable_dolomite_checkpoint,
     load_latest_full_state,
+    log_rank_0,
     prepare_peft_model,
     prepare_universal_checkpoint_from_latest,
+    read_dolomite_conversion_meta,
     retrieve_chat_template,
     save_checkpoint,
     save_hf_format_accelerate,
@@ -83,26 +118,28 @@ import instructlab.training.data_process as dp
 
 
 def setup_optimizer(args, model):
+    param_groups = make_param_groups(model, args.weight_decay)
+    betas = (args.adam_beta1, args.adam_beta2)
     if args.distributed_training_framework == DistributedBackend.FSDP.value:
-        optimizer = torch.optim.AdamW(
-            model.parameters(),
-            lr=args.learning_rate,
-            betas=(0.9, 0.95),
-            weight_decay=0.0,
+        optimizer = create_optimizer(
+            args.optimizer, param_groups, lr=args.learning_rate, betas=betas
         )
     elif args.distributed_training_framework == DistributedBackend.DEEPSPEED.value:
+        if args.optimizer != OptimizerType.ADAMW.value:
+            log_rank_0(
+                f"\033[33m!!! --optimizer={args.optimizer} is only used with FSDP, DeepSpeed uses its own Adam !!!\033[0m",
+                to_print=True,
+            )
         # need to use this only when the CPU offload optimizer is enabled
         if args.cpu_offload_optimizer:
             print(
                 "\033[33m!!! CPU offload optimizer enabled, using DeepSpeedCPUAdam !!!\033[0m"
             )
             optimizer = DeepSpeedCPUAdam(
-                model.parameters(), lr=args.learning_rate, betas=(0.9, 0.95)
+                param_groups, lr=args.learning_rate, betas=betas
             )
         else:
-            optimizer = FusedAdam(
-                model.parameters(), lr=args.learning_rate, betas=(0.9, 0.95)
-            )
+            optimizer = FusedAdam(param_groups, lr=args.learning_rate, betas=betas)
     else:
         raise ValueError(
             f"Sharding framework {args.distributed_training_framework} is not supported."
@@ -110,6 +147,74 @@ def setup_optimizer(args, model):
     return optimizer
 
 
+def use_torch_compile(args) -> bool:
+    if not args.torch_compile:
+        return False
+    # FSDP only supports compiled modules with `use_orig_params`, which LoRA disables
+    if args.lora_r > 0 or args.use_dolomite:
+        log_rank_0(
+            "\033[33mtorch.compile is not supported with LoRA or dolomite, training without it\033[0m",
+            to_print=True,
+        )
+        return False
+    return True
+
+
+def use_token_budget(args) -> bool:
+    if not args.target_tokens_per_step:
+        return False
+    # DeepSpeed steps the optimizer itself after a fixed number of micro-batches
+    if args.distributed_training_framework != DistributedBackend.FSDP.value:
+        log_rank_0(
+            "\033[33mSizing steps by --target_tokens_per_step is only supported with FSDP, using a fixed number of micro-batches\033[0m",
+            to_print=True,
+        )
+        return False
+    return True
+
+
+def use_grad_accum_no_sync(args, grad_accum) -> bool:
+    # with a token budget, a step may take several micro-batches whatever grad_accum is
+    if not args.grad_accum_no_sync or (
+        grad_accum == 1 and not args.target_tokens_per_step
+    ):
+        return False
+    # DeepSpeed ZeRO reduces the gradients of every micro-step itself
+    if args.distributed_training_framework != DistributedBackend.FSDP.value:
+        log_rank_0(
+            "\033[33mSkipping gradient syncs during accumulation is only supported with FSDP\033[0m",
+            to_print=True,
+        )
+        return False
+    if args.cpu_offload_params_fsdp:
+        log_rank_0(
+            "\033[33mSkipping gradient syncs during accumulation is not supported with CPU offloading\033[0m",
+            to_print=True,
+        )
+        return False
+    return True
+
+
+def use_cpu_ram_efficient_loading(args, tokenizer) -> bool:
+    if not args.fsdp_cpu_ram_efficient_loading:
+        return False
+    if args.distributed_training_framework != DistributedBackend.FSDP.value:
+        log_rank_0(
+            "\033[33mCPU RAM efficient loading is only supported with FSDP, loading the model on every rank\033[0m",
+            to_print=True,
+        )
+        return False
+    # the LoRA, quantization and dolomite setups and resizing the embeddings for
+    # the tokenizer all need the real weights on every rank
+    if args.lora_r > 0 or args.use_dolomite or len(tokenizer) > args.vocab_size:
+        log_rank_0(
+            "\033[33mCPU RAM efficient loading is not supported with LoRA, dolomite or resized embeddings, loading the model on every rank\033[0m",
+            to_print=True,
+        )
+        return False
+    return True
+
+
 def setup_model(args, tokenizer, train_loader, grad_accum, flash_enabled):
     bnb_config = None
     if args.lora_r > 0 and args.lora_quant_bits == 4:
@@ -131,10 +236,22 @@ def setup_model(args, tokenizer, train_loader, grad_accum, flash_enabled):
     if flash_enabled:
         base_model_args["attn_implementation"] = "flash_attention_2"
 
+    args.fsdp_cpu_ram_efficient_loading = use_cpu_ram_efficient_loading(args, tokenizer)
+    if args.fsdp_cpu_ram_efficient_loading:
+        # transformers memory-maps the safetensors on local rank 0 and builds the
+        # model on the meta device everywhere else, then FSDP broadcasts the weights
+        # from rank 0 while sharding them (sync_module_states)
+        os.environ["ACCELERATE_USE_FSDP"] = "true"
+        os.environ["FSDP_CPU_RAM_EFFICIENT_LOADING"] = "true"
+        base_model_args["low_cpu_mem_usage"] = True
+
+    load_start = time.time()
     if args.use_dolomite:
         with ensure_loadable_dolomite_checkpoint(
-            args.model_name_or_path, args.output_dir
+            args.model_name_or_path, args.dolomite_cache_dir
         ) as path:
+            # reused when exporting checkpoints back to HF format
+            args.dolomite_conversion_meta = read_dolomite_conversion_meta(path)
             base_model_args["pretrained_model_name_or_path"] = path
             base_model_args["use_padding_free_transformer"] = True
             model = GPTDolomiteForCausalLM.from_pretrained(
@@ -143,8 +260,11 @@ def setup_model(args, tokenizer, train_loader, grad_accum, flash_enabled):
     else:
         model = AutoModelForCausalLM.from_pretrained(**base_model_args)
 
+    args.model_load_time = time.time() - load_start
     # store the base model args so we can recall them later if saving a LoRA model
     args.base_model_args = base_model_args
+    # counted before the parameters are sharded, used for the FLOPs estimate
+    args.num_model_params = sum(p.numel() for p in model.parameters())
 
     if len(tokenizer) > model.config.vocab_size:
         print(
@@ -193,52 +313,93 @@ def setup_model(args, tokenizer, train_loader, grad_accum, flash_enabled):
         "GraniteForCausalLM",
     ], f"Model class name: {model.__class__.__name__} is not supported."
 
-    model = convert_loss_to_reduce_sum(model, use_dolomite=args.use_dolomite)
+    model = convert_loss_to_reduce_sum(
+        model, use_dolomite=args.use_dolomite, loss_chunk_size=args.loss_chunk_size
+    )
     model = add_noisy_embeddings(model, noise_alpha=args.NEFTune_alpha)
 
+    # pick the decoder blocks that recompute their activations in the backward pass
+    checkpointing_policy = ActivationCheckpointingPolicy(args.activation_checkpointing)
+    block_name = model._no_split_modules[0]
+    num_blocks = sum(
+        1 for module in model.modules() if module.__class__.__name__ == block_name
+    )
+    checkpointed_blocks = plan_activation_checkpointing(args, model.config, num_blocks)
+    full_checkpointing = checkpointing_policy == ActivationCheckpointingPolicy.FULL
+    log_rank_0(
+        f"\033[93mActivation checkpointing ({checkpointing_policy.value}): {len(checkpointed_blocks)} of {num_blocks} blocks\033[0m",
+        to_print=True,
+    )
+
     # handling of gradient checkpointing
     # it is handled differently for lora and full
-    # - with the exception of granite, which handles it
-    #   in the later stanza
+    # - with the exception of granite and selective checkpointing,
+    #   which are handled in the later stanza
     if args.lora_r > 0:
         lora_config = create_lora_config(model, args)
         model = prepare_peft_model(
             model,
             lora_config,
             args.distributed_training_framework,
-            gradient_checkpointing=not args.use_dolomite,
+            # a selective plan wraps its own blocks in the later stanza, so HF
+            # checkpointing (which the kbit preparation turns on for every
+            # block) is only used for the full policy
+            gradient_checkpointing=not args.use_dolomite and full_checkpointing,
         )
         args.lora_config = lora_config
-    elif not args.use_dolomite:
+    elif not args.use_dolomite and full_checkpointing:
         model.gradient_checkpointing_enable()
 
     # granite gradient checkpointing is handled uniformly
-    # for both lora and full here
-    if args.use_dolomite:
-        block_name = model._no_split_modules[0]
+    # for both lora and full here, as is selecting a subset of the blocks
+    if (args.use_dolomite or not full_checkpointing) and checkpointed_blocks:
         apply_gradient_checkpointing(
             model,
             block_name=block_name,
-            use_reentrant=True,  # this should be the HF default mode
+            # this should be the HF default mode
+            use_reentrant=args.use_dolomite,
+            blocks=None if full_checkpointing else checkpointed_blocks,
         )
+        # the KV cache is of no use in training
+        model.config.use_cache = False
 
-        if args.lora_r > 0:
+    if args.lora_r > 0 and (
+        args.use_dolomite or (checkpointed_blocks and not full_checkpointing)
+    ):
+
+        def make_inputs_require_grad(module, input, output):
+            output.requires_grad_(True)
 
-            def make_inputs_require_grad(module, input, output):
-                output.requires_grad_(True)
+        model.get_input_embeddings().register_forward_hook(make_inputs_require_grad)
 
-            model.get_input_embeddings().register_forward_hook(make_inputs_require_grad)
+    if args.torch_compile:
+        # compiled in place, FSDP still finds the blocks by their class
+        args.compile_stats = compile_decoder_blocks(
+            model, block_name, num_buckets=args.compile_num_buckets
+        )
 
+    # counted before the parameters are sharded, sizes the gradient communication
+    args.num_trainable_params = sum(
+        p.numel() for p in model.parameters() if p.requires_grad
+    )
     accelerator = setup_accelerator(args, model, grad_accum)
     if args.distributed_training_framework == DistributedBackend.FSDP.value:
         model = accelerator.prepare(model)
     optimizer = setup_optimizer(args, model)
 
+    num_training_steps = args.num_epochs * len(train_loader) // grad_accum
+    if args.target_tokens_per_step:
+        # the schedule counts steps of exactly target_tokens_per_step tokens
+        num_training_steps = num_token_budget_steps(
+            args.num_epochs * train_loader.dataset.get_num_loss_counted_tokens(),
+            args.target_tokens_per_step,
+        )
+    args.num_training_steps = num_training_steps
     lr_scheduler = get_scheduler(
         name=args.lr_scheduler,
         optimizer=optimizer,
         num_warmup_steps=args.num_warmup_steps,
-        num_training_steps=args.num_epochs * len(train_loader) // grad_accum,
+        num_training_steps=num_training_steps,
     )
     model, optimizer, _, lr_scheduler = accelerator.prepare(
         model,
@@ -335,6 +496,61 @@ def train(
     if hasattr(args, "samples_seen"):
         print(f"\033[93mUpdating 'samples_seen' {args.samples_seen}\033[0m")
         samples_seen = args.samples_seen
+    peak_tflops_per_gpu = args.peak_tflops_per_gpu or get_peak_tflops(
+        torch.cuda.get_device_name()
+    )
+    step_metrics = StepMetrics(
+        accelerator.device,
+        samples_seen=samples_seen,
+        throughput=ThroughputTracker(
+            world_size=world_size,
+            num_params=args.num_model_params,
+            num_layers=args.num_hidden_layers,
+            hidden_size=args.hidden_size,
+            peak_tflops_per_gpu=peak_tflops_per_gpu,
+        ),
+    )
+    empty_cache_policy = EmptyCachePolicy(args.empty_cache)
+    optimizer_stats = OptimizerStats(optimizer)
+    profiler = StepPhaseProfiler(
+        enabled=args.profile_step_phases > 0,
+        trace_steps=parse_step_range(args.torch_profiler_steps),
+        trace_dir=Path(args.output_dir) / "torch_profiler",
+        rank=torch.distributed.get_rank(),
+    )
+    retention = CheckpointRetention(
+        keep_last=args.keep_last_checkpoints,
+        keep_best=args.keep_best_checkpoints,
+        keep_every=args.keep_every_nth_checkpoint,
+    )
+    # training loss of the last logging interval, used to keep the best checkpoints
+    last_loss = None
+    grad_accum_no_sync = use_grad_accum_no_sync(args, grad_accum)
+    # every skipped reduce-scatter would have sent this rank's share of the bf16
+    # gradients of all trainable parameters
+    grad_sync_bytes = 2 * args.num_trainable_params * (world_size - 1) / world_size
+    num_skipped_grad_syncs = 0
+    token_budget = None
+    if args.target_tokens_per_step:
+        # a resumed schedule has already seen the tokens of its completed steps
+        token_budget = TokenBudget(
+            args.target_tokens_per_step,
+            tokens_seen=getattr(lr_scheduler, "scheduler", lr_scheduler).last_epoch
+            * args.target_tokens_per_step,
+        )
+    oom_guard = OOMGuard(enabled=args.oom_recovery)
+    async_saver = None
+    if args.async_checkpoint:
+        if args.lora_r > 0:
+            print(
+                "\033[33mAsynchronous checkpointing is not supported for LoRA, checkpoints will be saved synchronously.\033[0m"
+            )
+        else:
+            async_saver = AsyncCheckpointSaver(
+                metric_logger=metric_logger,
+                max_in_flight=args.max_in_flight_checkpoints,
+                retention=retention,
+            )
 
     if args.save_samples > 0:
         args.save_samples = (args.save_samples // batch_size) * batch_size
@@ -356,8 +572,14 @@ def train(
 
     global_grad_norm = None
     for epoch in range(args.current_epoch, args.num_epochs):
+        num_skipped = 0
         if args.sampler in ("multipack"):
-            train_loader.batch_sampler.set_epoch(epoch)
+            # when resuming, start directly at the first batch that was not trained on
+            # instead of loading and collating the skipped ones
+            num_skipped = max(args.last_step - global_step + 1, 0)
+            train_loader.batch_sampler.set_epoch(epoch, start_batch=num_skipped)
+            num_skipped = min(num_skipped, len(train_loader))
+            global_step += num_skipped
         elif args.sampler in ("distributed"):
             train_loader.sampler.set_epoch(epoch)
         else:
@@ -365,109 +587,224 @@ def train(
 
         if local_rank == 0:
             inner_pb = tqdm(range(len(train_loader)), desc=f"Epoch {epoch}")
+            inner_pb.update(num_skipped)
+            if args.sampler == "multipack":
+                metric_logger.log_sync(
+                    {
+                        "epoch": epoch,
+                        "multipack_plan": train_loader.batch_sampler.epoch_stats(),
+                    }
+                )
 
         # blast through the batches in the train loader up to the last step within the epoch.
-        for batch in train_loader:
-            if global_step <= args.last_step:
-                # in the case of resuming, last_step > 0
+        data_wait_start = time.time()
+        # first micro-batch of the current optimizer step, retried after an OOM
+        step_start_batch = num_skipped
+        # set when a step that could not be retried was dropped midway through its
+        # accumulation window
+        skip_to_step_boundary = False
+        for batch_index, batch in iterate_epoch(train_loader, num_skipped, oom_guard):
+            if args.sampler != "multipack" and global_step <= args.last_step:
+                # in the case of resuming, last_step > 0. The multipack sampler
+                # already started the epoch past these batches
                 global_step += 1
                 if local_rank == 0:
                     inner_pb.update(1)
+                data_wait_start = time.time()
                 continue
-            start = time.time()
-            num_loss_counted_tokens = float(
-                torch.tensor([batch.pop("num_loss_counted_tokens")])
-            )
-            micro_batch_size = float(torch.tensor([batch.pop("num_samples")]))
+            if skip_to_step_boundary:
+                # the rest of the window is skipped as well, an optimizer step on the
+                # gradients of only part of the window would be taken otherwise
+                skip_to_step_boundary = global_step % grad_accum != 0
+                global_step += 1
+                step_start_batch = batch_index + 1
+                if local_rank == 0:
+                    inner_pb.update(1)
+                data_wait_start = time.time()
+                continue
+            data_wait = time.time() - data_wait_start
+            step_metrics.record_data_wait(data_wait)
+            profiler.record("data_wait", data_wait)
+            profiler.start_step(global_step)
+            num_loss_counted_tokens = int(batch.pop("num_loss_counted_tokens"))
+            micro_batch_size = int(batch.pop("num_samples"))
+            total_length = batch.pop("total_length")
+            sum_squared_lengths = batch.pop("sum_squared_lengths")
+            # the token count is reduced across ranks while the forward pass runs
+            step_metrics.start_step(num_loss_counted_tokens, micro_batch_size)
             if not args.use_dolomite:
-                for k in batch:
-                    batch[k] = batch[k].to(local_rank)
-            output = model(
-                **batch,
-                use_cache=False,
-            )
-            loss = output.loss
-            log_loss = loss.detach().item()
-
-            num_loss_counted_tokens, micro_batch_size, log_loss = map(
-                float,
-                accelerator.reduce(
-                    torch.tensor(
-                        [num_loss_counted_tokens, micro_batch_size, log_loss],
-                        dtype=torch.float32,
-                        device=accelerator.device,
+                with profiler.phase("h2d"):
+                    for k in batch:
+                        batch[k] = batch[k].to(local_rank, non_blocking=True)
+            with oom_guard.catch():
+                with profiler.phase("forward"):
+                    output = model(
+                        **batch,
+                        use_cache=False,
+                    )
+                loss = output.loss
+
+                # everything stays on the device, nothing here waits for the GPU
+                step_metrics.end_step(
+                    loss,
+                    total_length=total_length,
+                    sum_squared_lengths=sum_squared_lengths,
+                )
+                if token_budget is not None:
+                    # the gradients are rescaled to the actual step size in finish_step
+                    loss = loss / token_budget.target_tokens * world_size
+                else:
+                    loss = (
+                        loss / step_metrics.loss_tokens() * world_size
+                    )  # dividing by the total number of non-padding tokens and multiplying by the number of GPUs so when accelerate averages by world_size, it will be the correct loss.
+            # every rank has to agree on a failure before any of them moves on
+            if token_budget is not None:
+                # one host reduction sums the tokens of all ranks and holds the vote,
+                # every rank sees the same totals and ends the step together
+                oom_failed = oom_guard.vote(
+                    "forward",
+                    num_failed_ranks=token_budget.add(
+                        num_loss_counted_tokens, failed=oom_guard.failed
                     ),
-                    reduction="sum",
-                ),
-            )
-            samples_seen += int(micro_batch_size)
-
-            # num_loss_counted_tokens = aggregated_values[0]
-            loss = (
-                loss / num_loss_counted_tokens * world_size
-            )  # dividing by the total number of non-padding tokens and multiplying by the number of GPUs so when accelerate averages by world_size, it will be the correct loss.
-            print(
-                f"Epoch: {epoch}, Step: {global_step}, Rank: {torch.distributed.get_rank()}, loss = {loss}"
-            )
-            accelerator.backward(loss)
-
-            if global_step % grad_accum == 0:
-                global_grad_norm = accelerator.clip_grad_norm_(model.parameters(), 1.0)
-                optimizer.step()
-                lr_scheduler.step()
-                optimizer.zero_grad()
+                )
+                step_boundary = token_budget.is_step_boundary(
+                    last_micro_batch=batch_index == len(train_loader) - 1
+                )
+            else:
+                oom_failed = oom_guard.vote("forward")
+                step_boundary = global_step % grad_accum == 0
+            skip_sync = grad_accum_no_sync and not step_boundary
+            if not oom_failed:
+                # FSDP only reduces gradients in the backward pass, which is all that
+                # no_sync has to cover
+                with accelerator.no_sync(model) if skip_sync else nullcontext():
+                    with oom_guard.catch():
+                        with profiler.phase("backward"):
+                            accelerator.backward(loss)
+                oom_failed = oom_guard.vote("backward")
+                num_skipped_grad_syncs += skip_sync
+
+            if oom_failed:
+                output = loss = None
+                profiler.end_step(global_step)
+                oom_event, global_step, step_start_batch, skip_to_step_boundary = (
+                    recover_step(
+                        oom_guard,
+                        optimizer,
+                        train_loader,
+                        batch_index=batch_index,
+                        step_start_batch=step_start_batch,
+                        global_step=global_step,
+                        # a token budget starts its next step right away, a fixed
+                        # window is skipped up to its end
+                        skip_window=token_budget is None and not step_boundary,
+                    )
+                )
+                step_metrics.drop_optimizer_step()
+                if token_budget is not None:
+                    token_budget.drop_step()
+                if local_rank == 0:
+                    print(
+                        f"\033[33mRecovered from running out of memory: {oom_event}\033[0m"
+                    )
+                    metric_logger.log_sync(
+                        {"epoch": epoch, "step": global_step, "oom_recovery": oom_event}
+                    )
+                    inner_pb.reset(total=len(train_loader))
+                    inner_pb.update(
+                        step_start_batch
+                        if oom_guard.restart_batch is not None
+                        else batch_index + 1
+                    )
+                data_wait_start = time.time()
+                continue
 
-            if local_rank == 0:
-                elapsed_time = time.time() - start
-                overall_throughput = args.samples_per_gpu * world_size / elapsed_time
-                current_lr = lr_scheduler.get_last_lr()[0]
-                cuda_mem_allocated = torch.cuda.memory_allocated() / (1024**3)
-                cuda_malloc_retries = torch.cuda.memory_stats()["num_alloc_retries"]
-                global_grad_norm = (
+            if step_boundary:
+                with profiler.phase("optimizer"):
+                    if token_budget is not None:
+                        token_budget.finish_step(model)
+                    global_grad_norm = accelerator.clip_grad_norm_(
+                        model.parameters(), 1.0
+                    )
+                    with optimizer_stats.time_step():
+                        optimizer.step()
+                    if token_budget is not None:
+                        advance_lr_scheduler(
+                            lr_scheduler,
+                            token_budget.lr_steps,
+                            max_steps=args.num_training_steps,
+                        )
+                    else:
+                        lr_scheduler.step()
+                    optimizer.zero_grad()
+                step_start_batch = batch_index + 1
+                step_metrics.end_optimizer_step()
+                step_metrics.record_grad_norm(
                     model.get_global_grad_norm()
                     if hasattr(model, "get_global_grad_norm")
                     else global_grad_norm
                 )
-                global_grad_norm = (
-                    float(global_grad_norm) if global_grad_norm is not None else None
-                )
-                # TODO - Bring back weight_norm gather
-                # weight_norm = float(
-                #     model.optimizer.single_partition_of_fp32_groups[0].norm()
-                # )
 
-                # TODO - Bring back consistent gradnorm and weight_norm logging
-                metric_logger.log_sync(
-                    {
-                        "epoch": epoch,
-                        "step": global_step,
-                        "rank": torch.distributed.get_rank(),
-                        "overall_throughput": overall_throughput,
-                        "lr": current_lr,
-                        "cuda_mem_allocated": cuda_mem_allocated,
-                        "cuda_malloc_retries": cuda_malloc_retries,
-                        "num_loss_counted_tokens": int(num_loss_counted_tokens),
-                        "batch_size": int(micro_batch_size),
-                        "total_loss": float(log_loss / num_loss_counted_tokens),
-                        "samples_seen": samples_seen,
-                        "gradnorm": global_grad_norm,
-                        "total_samples": len(train_loader.dataset),
-                        # "weight_norm": weight_norm,
-                    }
-                )
+            if global_step % args.log_interval == 0:
+                # reading the accumulated metrics back is the only sync, and only
+                # rank 0 pays for it
+                metrics = step_metrics.flush(read=local_rank == 0)
+                optimizer_metrics = optimizer_stats.flush()
+                if local_rank == 0:
+                    last_loss = metrics.get("total_loss", last_loss)
+                    # TODO - Bring back weight_norm gather
+                    # weight_norm = float(
+                    #     model.optimizer.single_partition_of_fp32_groups[0].norm()
+                    # )
+
+                    # TODO - Bring back consistent gradnorm and weight_norm logging
+                    metric_logger.log_sync(
+                        {
+                            "epoch": epoch,
+                            "step": global_step,
+                            "rank": torch.distributed.get_rank(),
+                            "lr": lr_scheduler.get_last_lr()[0],
+                            "cuda_mem_allocated": torch.cuda.memory_allocated()
+                            / (1024**3),
+                            "cuda_malloc_retries": torch.cuda.memory_stats()[
+                                "num_alloc_retries"
+                            ],
+                            "empty_cache_calls": empty_cache_policy.num_empty_cache,
+                            **(
+                                args.compile_stats.flush() if args.torch_compile else {}
+                            ),
+                            **optimizer_metrics,
+                            **(token_budget.flush() if token_budget else {}),
+                            "grad_syncs_skipped": num_skipped_grad_syncs,
+                            "grad_sync_bytes_saved": num_skipped_grad_syncs
+                            * grad_sync_bytes,
+                            **metrics,
+                            "total_samples": len(train_loader.dataset),
+                            # "weight_norm": weight_norm,
+                        }
+                    )
 
             if args.save_samples > 0 and (
                 global_step * batch_size % args.save_samples == 0
             ):
-                save_checkpoint(
-                    args=args,
-                    accelerator=accelerator,
-                    model=model,
-                    tokenizer=tokenizer,
-                    samples_seen=samples_seen,
-                    is_lora=bool(args.lora_r),
-                    hf_format=True,
-                )
+                with profiler.phase("checkpoint", host=True):
+                    save_checkpoint(
+                        args=args,
+                        accelerator=accelerator,
+                        model=model,
+                        tokenizer=tokenizer,
+                        samples_seen=step_metrics.samples_seen,
+                        is_lora=bool(args.lora_r),
+                        hf_format=True,
+                        full_state=args.accelerate_full_state_at_save,
+                        epoch=epoch,
+                        # gradients of a partly accumulated step are not saved, so
+                        # training resumes at the first micro-batch of that step
+                        sampler_state={"epoch": epoch, "start_batch": step_start_batch},
+                        async_saver=async_saver,
+                        retention=retention,
+                        metric=last_loss,
+                    )
 
             # if (
             #     args.save_samples_ds is not None
@@ -479,22 +816,43 @@ def train(
             #         tokenizer,
             #         global_step * args.samples_per_gpu * world_size,
             #     )
+            profiler.end_step(global_step)
+            if profiler.enabled and global_step % args.profile_step_phases == 0:
+                step_phases = profiler.flush()
+                if local_rank == 0:
+                    metric_logger.log_sync(
+                        {
+                            "epoch": epoch,
+                            "step": global_step,
+                            "step_phases": step_phases,
+                        }
+                    )
             global_step += 1
             if local_rank == 0:
                 inner_pb.update(1)
-            torch.cuda.empty_cache()
+            empty_cache_policy.step()
+            data_wait_start = time.time()
         if args.checkpoint_at_epoch:
-            save_checkpoint(
-                args=args,
-                accelerator=accelerator,
-                model=model,
-                tokenizer=tokenizer,
-                samples_seen=samples_seen,
-                is_lora=bool(args.lora_r),
-                full_state=args.accelerate_full_state_at_epoch,
-                hf_format=True,
-                epoch=epoch,
-            )
+            with profiler.phase("checkpoint", host=True):
+                save_checkpoint(
+                    args=args,
+                    accelerator=accelerator,
+                    model=model,
+                    tokenizer=tokenizer,
+                    samples_seen=step_metrics.samples_seen,
+                    is_lora=bool(args.lora_r),
+                    full_state=args.accelerate_full_state_at_epoch,
+                    hf_format=True,
+                    epoch=epoch,
+                    # training continues at the start of the next epoch
+                    sampler_state={"epoch": epoch + 1, "start_batch": 0},
+                    async_saver=async_saver,
+                    retention=retention,
+                    metric=last_loss,
+                )
+
+    if async_saver is not None:
+        async_saver.wait()
 
     if args.save_last:
         save_hf_format_accelerate(
@@ -502,9 +860,12 @@ def train(
             model,
             tokenizer,
             accelerator,
-            samples_seen,
+            step_metrics.samples_seen,
             is_lora=bool(args.lora_r),
+            retention=retention,
+            metric=last_loss,
         )
+    retention.wait()
 
 
 def main(args):
@@ -541,6 +902,14 @@ def main(args):
     with open(Path(args.model_name_or_path) / "config.json") as conf_json:
         model_conf = json.load(conf_json)
     args.model_type = model_conf["model_type"]
+    # per token, dense layers cost ~24*h^2 FLOPs and causal attention ~2*h*len
+    hidden_size = model_conf.get("hidden_size", model_conf.get("n_embd"))
+    attn_cost_coeff = 1 / (12 * hidden_size) if hidden_size else 0.0
+    args.hidden_size = hidden_size or 0
+    args.num_hidden_layers = model_conf.get(
+        "num_hidden_layers", model_conf.get("n_layer", 0)
+    )
+    args.vocab_size = model_conf.get("vocab_size", 0)
 
     #### distributed init #####
     torch.cuda.set_device(int(os.environ["LOCAL_RANK"]))
@@ -583,7 +952,25 @@ def main(args):
     args.samples_per_gpu = (
         args.effective_batch_size // grad_accum // torch.distributed.get_world_size()
     )
+    # sizes the activations of the selective checkpointing policies
+    args.packing_max_batch_len = packing_max_batch_len
 
+    if args.multipack_balance_cost and not (args.use_dolomite or flash_enabled):
+        if os.environ["LOCAL_RANK"] == "0":
+            print(
+                "\033[33mWARNING: cost-balanced multipack packing requires padding-free batches, disabling it.\033[0m"
+            )
+        args.multipack_balance_cost = False
+
+    args.torch_compile = use_torch_compile(args)
+    if not use_token_budget(args):
+        args.target_tokens_per_step = 0
+    # compiled models see a bounded set of sequence lengths
+    length_buckets = (
+        make_length_buckets(args.max_batch_len, args.compile_num_buckets)
+        if args.torch_compile
+        else None
+    )
     train_loader = setup_dataloader(
         dataset,
         tokenizer.pad_token_id,
@@ -595,6 +982,10 @@ def main(args):
         samples_per_gpu=args.samples_per_gpu,
         sampler=args.sampler,
         seed=args.seed,
+        balance_cost=args.multipack_balance_cost,
+        attn_cost_coeff=attn_cost_coeff,
+        carry_over_tail=args.multipack_carry_over_tail,
+        length_buckets=length_buckets,
     )
     if len(train_loader) == 0:
         # this happens sometimes when we have more GPUs than data to process. In this case
@@ -615,6 +1006,10 @@ def main(args):
             samples_per_gpu=args.samples_per_gpu,
             sampler=args.sampler,
             seed=args.seed,
+            balance_cost=args.multipack_balance_cost,
+            attn_cost_coeff=attn_cost_coeff,
+            carry_over_tail=args.multipack_carry_over_tail,
+            length_buckets=length_buckets,
         )
 
     if args.local_rank == 0:
@@ -633,9 +1028,18 @@ def main(args):
             }
         )
 
+    setup_start = time.time()
     model, lr_scheduler, optimizer, accelerator = setup_model(
         args, tokenizer, train_loader, grad_accum, flash_enabled
     )
+    if args.local_rank == 0:
+        metric_logger.log_sync(
+            {
+                "model_load_time": args.model_load_time,
+                "model_setup_time": time.time() - setup_start,
+                "cpu_ram_efficient_loading": args.fsdp_cpu_ram_efficient_loading,
+            }
+        )
 
     load_latest_full_state(args=args, accelerator=accelerator)
 
@@ -704,6 +1108,14 @@ def run_training(torch_args: TorchrunArgs, train_args: TrainingArgs) -> None:
         f"--num_warmup_steps={train_args.warmup_steps}",
         f"--save_samples={train_args.save_samples}",
         f"--log_level=INFO",
+        f"--log_interval={train_args.log_interval}",
+        f"--empty_cache={train_args.empty_cache.value}",
+        f"--activation_checkpointing={train_args.activation_checkpointing.value}",
+        f"--activation_checkpointing_every_n={train_args.activation_checkpointing_every_n}",
+        f"--optimizer={train_args.optimizer.value}",
+        f"--adam_beta1={train_args.adam_beta1}",
+        f"--adam_beta2={train_args.adam_beta2}",
+        f"--weight_decay={train_args.weight_decay}",
         f"--max_batch_len={train_args.max_batch_len}",
         f"--seed={train_args.random_seed}",
         f"--chat-tmpl-path={train_args.chat_tmpl_path}",
@@ -715,6 +1127,9 @@ def run_training(torch_args: TorchrunArgs, train_args: TrainingArgs) -> None:
     if train_args.accelerate_full_state_at_epoch:
         command.append("--accelerate_full_state_at_epoch")
 
+    if train_args.accelerate_full_state_at_save:
+        command.append("--accelerate_full_state_at_save")
+
     if train_args.mock_data:
         command.append("--mock_data")
         if train_args.mock_len:
@@ -723,6 +1138,58 @@ def run_training(torch_args: TorchrunArgs, train_args: TrainingArgs) -> None:
     if train_args.use_dolomite:
         command.append("--use_dolomite")
 
+    if train_args.activation_memory_budget_gb is not None:
+        command.append(
+            f"--activation_memory_budget_gb={train_args.activation_memory_budget_gb}"
+        )
+
+    if train_args.torch_compile:
+        command.append("--torch_compile")
+        command.append(f"--compile_num_buckets={train_args.compile_num_buckets}")
+
+    if train_args.grad_accum_no_sync:
+        command.append("--grad_accum_no_sync")
+
+    if train_args.target_tokens_per_step:
+        command.append(f"--target_tokens_per_step={train_args.target_tokens_per_step}")
+
+    if train_args.oom_recovery:
+        command.append("--oom_recovery")
+
+    if train_args.loss_chunk_size:
+        command.append(f"--loss_chunk_size={train_args.loss_chunk_size}")
+
+    if train_args.dolomite_cache_dir:
+        command.append(f"--dolomite_cache_dir={train_args.dolomite_cache_dir}")
+
+    if train_args.multipack_balance_cost:
+        command.append("--multipack_balance_cost")
+
+    if train_args.multipack_carry_over_tail:
+        command.append("--multipack_carry_over_tail")
+
+    if train_args.peak_tflops_per_gpu:
+        command.append(f"--peak_tflops_per_gpu={train_args.peak_tflops_per_gpu}")
+
+    if train_args.profile_step_phases:
+        command.append(f"--profile_step_phases={train_args.profile_step_phases}")
+
+    if train_args.torch_profiler_steps:
+        command.append(f"--torch_profiler_steps={train_args.torch_profiler_steps}")
+
+    if train_args.keep_last_checkpoints:
+        command.append(f"--keep_last_checkpoints={train_args.keep_last_checkpoints}")
+        command.append(f"--keep_best_checkpoints={train_args.keep_best_checkpoints}")
+        command.append(
+            f"--keep_every_nth_checkpoint={train_args.keep_every_nth_checkpoint}"
+        )
+
+    if train_args.async_checkpoint:
+        command.append("--async_checkpoint")
+        command.append(
+            f"--max_in_flight_checkpoints={train_args.max_in_flight_checkpoints}"
+        )
+
     if train_args.disable_flash_attn:
         command.append("--disable_flash_attn")
 
@@ -787,6 +1254,12 @@ def run_training(torch_args: TorchrunArgs, train_args: TrainingArgs) -> None:
         f"--fsdp_sharding_strategy={train_args.fsdp_options.sharding_strategy.value}"
     )
 
+    if train_args.fsdp_options.sharded_checkpoint:
+        command.append("--fsdp_sharded_checkpoint")
+
+    if train_args.fsdp_options.cpu_ram_efficient_loading:
+        command.append("--fsdp_cpu_ram_efficient_loading")
+
     print(f"\033[92mRunning training command as subprocess: {' '.join(command)}\033[0m")
     process = None
     interrupt: KeyboardInterrupt | Exception | None = None
@@ -897,7 +1370,157 @@ if __name__ == "__main__":
         action="store_true",
         help="Save full model state using Accelerate after finishing an epoch.",
     )
+    parser.add_argument(
+        "--accelerate_full_state_at_save",
+        action="store_true",
+        help="Also save full model state using Accelerate with every save_samples checkpoint, "
+        "so training can resume from the middle of an epoch.",
+    )
+    parser.add_argument(
+        "--async_checkpoint",
+        action="store_true",
+        help="Write HF format checkpoints on a background thread from a host memory snapshot, "
+        "so training continues during the write. LoRA and full state saves stay synchronous.",
+    )
+    parser.add_argument(
+        "--max_in_flight_checkpoints",
+        type=int,
+        default=1,
+        help="Number of asynchronous checkpoints that may be held in host memory at once.",
+    )
+    parser.add_argument(
+        "--keep_last_checkpoints",
+        type=int,
+        default=0,
+        help="Keep only the N most recent checkpoints in hf_format and full_state, "
+        "plus the ones selected by the options below. Every checkpoint is kept when 0.",
+    )
+    parser.add_argument(
+        "--keep_best_checkpoints",
+        type=int,
+        default=0,
+        help="Also keep the N checkpoints with the lowest training loss.",
+    )
+    parser.add_argument(
+        "--keep_every_nth_checkpoint",
+        type=int,
+        default=0,
+        help="Also keep every Nth checkpoint saved.",
+    )
     parser.add_argument("--log_level", type=str, default="INFO")
+    parser.add_argument(
+        "--log_interval",
+        type=int,
+        default=1,
+        help="Number of steps between metric logs. Metrics are kept on the GPU in between, "
+        "so larger values avoid waiting on the GPU every step.",
+    )
+    parser.add_argument(
+        "--empty_cache",
+        type=str,
+        choices=[mode.value for mode in EmptyCacheMode],
+        default=EmptyCacheMode.ADAPTIVE.value,
+        help="When to release the CUDA caching allocator's unused blocks after a step. "
+        "'adaptive' only does so after allocation retries or when the cache is fragmented.",
+    )
+    parser.add_argument(
+        "--torch_compile",
+        action="store_true",
+        default=False,
+        help="Compile the decoder blocks with torch.compile. Batches are padded to one of "
+        "--compile_num_buckets lengths so that only that many shapes are compiled.",
+    )
+    parser.add_argument(
+        "--compile_num_buckets",
+        type=int,
+        default=8,
+        help="Number of sequence length buckets batches are padded to with --torch_compile.",
+    )
+    parser.add_argument(
+        "--optimizer",
+        type=str,
+        choices=[optimizer.value for optimizer in OptimizerType],
+        default=OptimizerType.ADAMW.value,
+        help="Optimizer used with FSDP. 'adamw_fused' and 'adamw_foreach' update many "
+        "parameters per kernel, 'adamw_8bit' (bitsandbytes) and 'adamw_bf16_state' shrink "
+        "the optimizer state.",
+    )
+    parser.add_argument("--adam_beta1", type=float, default=0.9)
+    parser.add_argument("--adam_beta2", type=float, default=0.95)
+    parser.add_argument(
+        "--weight_decay",
+        type=float,
+        default=0.0,
+        help="Decoupled weight decay, not applied to biases and norm weights.",
+    )
+    parser.add_argument(
+        "--target_tokens_per_step",
+        type=int,
+        default=0,
+        help="With FSDP, end every optimizer step once the micro-batches accumulated on all "
+        "ranks reach this many loss-counted tokens, instead of after a fixed number of "
+        "micro-batches. The learning rate schedule then counts steps of this many tokens, "
+        "so --num_warmup_steps is in units of it. 0 disables it.",
+    )
+    parser.add_argument(
+        "--oom_recovery",
+        action="store_true",
+        default=False,
+        help="Recover from CUDA out of memory errors in the forward and backward passes: "
+        "every rank drops the failed step, the rest of the epoch is packed again with a "
+        "smaller --max_batch_len and the step is retried. See oom_recovery.py for the "
+        "failures this cannot recover from.",
+    )
+    parser.add_argument(
+        "--grad_accum_no_sync",
+        action="store_true",
+        default=False,
+        help="With FSDP, only reduce-scatter the gradients on the last micro-step of every "
+        "gradient accumulation window. The other micro-steps accumulate unsharded gradients "
+        "locally, which saves communication at the cost of memory.",
+    )
+    parser.add_argument(
+        "--activation_checkpointing",
+        type=str,
+        choices=[policy.value for policy in ActivationCheckpointingPolicy],
+        default=ActivationCheckpointingPolicy.FULL.value,
+        help="Which decoder blocks recompute their activations in the backward pass: all of them, "
+        "none, every Nth one, or as few as fit in --activation_memory_budget_gb.",
+    )
+    parser.add_argument(
+        "--activation_checkpointing_every_n",
+        type=int,
+        default=2,
+        help="Checkpoint every Nth decoder block with the 'every_n' policy.",
+    )
+    parser.add_argument(
+        "--activation_memory_budget_gb",
+        type=float,
+        default=None,
+        help="GiB per GPU available to the activations kept for the backward pass, used by the "
+        "'memory_budget' policy to leave as many blocks uncheckpointed as fit.",
+    )
+    parser.add_argument(
+        "--peak_tflops_per_gpu",
+        type=float,
+        default=None,
+        help="Peak bf16 TFLOPS of one GPU, used to report model FLOPs utilization. "
+        "Detected from the device name for common GPUs when not set.",
+    )
+    parser.add_argument(
+        "--profile_step_phases",
+        type=int,
+        default=0,
+        help="Time the data wait, H2D copy, forward, backward, optimizer and checkpoint "
+        "phases of each step and log their histograms every N steps. Disabled when 0.",
+    )
+    parser.add_argument(
+        "--torch_profiler_steps",
+        type=str,
+        default=None,
+        help="Capture a torch.profiler trace for the inclusive range of steps START:END, "
+        "written to <output_dir>/torch_profiler.",
+    )
     parser.add_argument("--seed", type=int, default=42)
     parser.add_argument("--mock_data", action="store_true")
     parser.add_argument("--mock_len", type=int, default=2600)
@@ -918,6 +1541,13 @@ if __name__ == "__main__":
         help="Sharding strategy to be used for FSDP distributed training.",
     )
     parser.add_argument("--use_dolomite", action="store_true")
+    parser.add_argument(
+        "--dolomite_cache_dir",
+        type=str,
+        default=None,
+        help="Directory where HF checkpoints converted to dolomite are cached and reused across runs. "
+        "Share it between nodes to convert only once. Defaults to ~/.cache/instructlab/dolomite.",
+    )
     parser.add_argument("--lora_r", type=int, default=0)  # set to > 0 to activate lora
     parser.add_argument("--lora_alpha", type=int, default=32)
     parser.add_argument("--lora_dropout", type=float, default=0.1)
@@ -929,6 +1559,18 @@ if __name__ == "__main__":
         help="Which modules we should target for injecting LoRA layers. Defaults to selecting all projection layers when no values are provided.",
     )
     parser.add_argument("--max_batch_len", type=int, default=60000)
+    parser.add_argument(
+        "--multipack_balance_cost",
+        action="store_true",
+        help="Balance the estimated compute cost (linear + quadratic attention term in the sample length) "
+        "across ranks in each multipack step, instead of only capping the tokens per rank.",
+    )
+    parser.add_argument(
+        "--multipack_carry_over_tail",
+        action="store_true",
+        help="Prepend the samples that could not fill the last multipack step of an epoch "
+        "to the next epoch, instead of skipping them.",
+    )
     parser.add_argument(
         "--cpu_offload_optimizer",
         action="store_true",
@@ -941,6 +1583,22 @@ if __name__ == "__main__":
         default=False,
         help="Offload to CPU when using FSDP.",
     )
+    parser.add_argument(
+        "--fsdp_sharded_checkpoint",
+        action="store_true",
+        default=False,
+        help="Save and load FSDP full state checkpoints as shards written by every rank in parallel, "
+        "instead of gathering them on rank 0. Use instructlab.training.consolidate_checkpoint "
+        "to convert them to HuggingFace format.",
+    )
+    parser.add_argument(
+        "--fsdp_cpu_ram_efficient_loading",
+        action="store_true",
+        default=False,
+        help="Only read the base model's weights on local rank 0 and broadcast them from rank 0 "
+        "while FSDP shards the model, instead of loading the full model on every rank. "
+        "Not supported with LoRA or dolomite.",
+    )
     parser.add_argument(
         "--cpu_offload_optimizer_pin_memory",
         action="store_true",
@@ -954,6 +1612,14 @@ if __name__ == "__main__":
         help="Ratio of the optimizer to be offloaded to CPU. The rest will be on GPU(s).",
     )
     parser.add_argument("--NEFTune_alpha", type=float, default=None)
+    parser.add_argument(
+        "--loss_chunk_size",
+        type=int,
+        default=0,
+        help="Compute the cross-entropy this many tokens at a time, recomputing each chunk in the "
+        "backward pass. For HF models the LM head is chunked too, so the full-vocabulary logits are "
+        "never materialized; dolomite models still build them. 0 computes the loss over all tokens at once.",
+    )
     parser.add_argument(
         "--chat-tmpl-path",
         type=str,
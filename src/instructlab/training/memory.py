@@ -0,0 +1,86 @@
+# SPDX-License-Identifier: Apache-2.0
+
+# Standard
+from typing import Callable, Dict, Optional
+
+# Third Party
+import torch
+
+# First Party
+from instructlab.training.config import EmptyCacheMode
+
+
+class EmptyCachePolicy:
+    """
+    Decides when to call `torch.cuda.empty_cache()` between training steps.
+
+    Releasing the caching allocator's blocks forces the next step to allocate them
+    again with cudaMalloc, which is expensive and synchronizes the device, so it only
+    pays off when memory is close to running out. In adaptive mode the cache is
+    emptied when the allocator had to free its cache and retry an allocation since the
+    last step (`num_alloc_retries` went up), or when more than
+    `fragmentation_threshold` of the reserved memory is fragmented while the reserved
+    memory is above `min_reserved_bytes`. Memory that is only cached, like the freed
+    activations of the step, is reused as is by the next step and does not count.
+
+    `stats_provider` returns a dictionary in the format of `torch.cuda.memory_stats()`
+    and `empty_cache` releases the cache, both can be replaced to exercise the policy
+    without a GPU.
+    """
+
+    def __init__(
+        self,
+        mode: EmptyCacheMode = EmptyCacheMode.ADAPTIVE,
+        fragmentation_threshold: float = 0.5,
+        min_reserved_bytes: int = 1024**3,
+        stats_provider: Optional[Callable[[], Dict[str, int]]] = None,
+        empty_cache: Optional[Callable[[], None]] = None,
+    ):
+        self.mode = EmptyCacheMode(mode)
+        self.fragmentation_threshold = fragmentation_threshold
+        self.min_reserved_bytes = min_reserved_bytes
+        self.stats_provider = stats_provider or torch.cuda.memory_stats
+        self.empty_cache = empty_cache or torch.cuda.empty_cache
+        self.num_empty_cache = 0
+        self._last_alloc_retries = None
+
+    @staticmethod
+    def fragmentation(stats: Dict[str, int]) -> float:
+        """
+        Share of the reserved memory held by the free parts of split blocks, which can
+        neither be released nor serve allocations larger than those parts.
+        """
+        reserved = stats.get("reserved_bytes.all.current", 0)
+        if not reserved:
+            return 0.0
+        return stats.get("inactive_split_bytes.all.current", 0) / reserved
+
+    def should_empty_cache(self) -> bool:
+        if self.mode == EmptyCacheMode.NEVER:
+            return False
+        if self.mode == EmptyCacheMode.ALWAYS:
+            return True
+
+        # the allocator stats are host-side bookkeeping, reading them does not sync
+        stats = self.stats_provider()
+        alloc_retries = stats.get("num_alloc_retries", 0)
+        retried = (
+            self._last_alloc_retries is not None
+            and alloc_retries > self._last_alloc_retries
+        )
+        self._last_alloc_retries = alloc_retries
+        if retried:
+            return True
+
+        return (
+            stats.get("reserved_bytes.all.current", 0) >= self.min_reserved_bytes
+            and self.fragmentation(stats) > self.fragmentation_threshold
+        )
+
+    def step(self) -> bool:
+        """Empties the cache if the policy asks for it, returns whether it did."""
+        if not self.should_empty_cache():
+            return False
+        self.empty_cache()
+        self.num_empty_cache += 1
+        return True
@@ -0,0 +1,297 @@
+# SPDX-License-Identifier: Apache-2.0
+
+# Standard
+from collections import deque
+from typing import Optional
+import time
+
+# Third Party
+from torch import distributed as dist
+import torch
+
+# dense bf16 peak of common accelerators, matched against the device name
+PEAK_TFLOPS_BF16 = {
+    "H200": 989.0,
+    "H100": 989.0,
+    "A100": 312.0,
+    "L40S": 362.0,
+    "L4": 121.0,
+    "MI300X": 1307.0,
+}
+
+
+def get_peak_tflops(device_name: str) -> Optional[float]:
+    for name, tflops in PEAK_TFLOPS_BF16.items():
+        if name in device_name:
+            return tflops
+    return None
+
+
+class ThroughputTracker:
+    """
+    Turns the totals of each logging interval into rates, both for the interval itself
+    and averaged over the last `window` intervals.
+
+    Model FLOPs are estimated as `6 * num_params` per token for the dense layers plus
+    `6 * num_layers * hidden_size` per squared sample length for causal attention
+    (forward and backward). MFU is only reported when the peak FLOPS of a GPU is known.
+    """
+
+    def __init__(
+        self,
+        world_size: int,
+        num_params: int = 0,
+        num_layers: int = 0,
+        hidden_size: int = 0,
+        peak_tflops_per_gpu: Optional[float] = None,
+        window: int = 20,
+    ):
+        self.world_size = world_size
+        self.flops_per_token = 6 * num_params
+        self.flops_per_squared_token = 6 * num_layers * hidden_size
+        self.peak_flops = (
+            peak_tflops_per_gpu * 1e12 * world_size if peak_tflops_per_gpu else None
+        )
+        self.intervals = deque(maxlen=window)
+
+    def _rates(self, elapsed, data_wait, steps, tokens, loss_tokens, samples, flops):
+        elapsed = max(elapsed, 1e-9)
+        return {
+            "samples_per_second": samples / elapsed,
+            "tokens_per_second": tokens / elapsed,
+            "loss_tokens_per_second": loss_tokens / elapsed,
+            "mfu": flops / elapsed / self.peak_flops if self.peak_flops else None,
+            "data_wait_time": data_wait / steps,
+            "compute_time": (elapsed - data_wait) / steps,
+        }
+
+    def update(
+        self,
+        elapsed: float,
+        data_wait: float,
+        steps: int,
+        num_tokens: float,
+        num_loss_counted_tokens: float,
+        num_samples: float,
+        sum_squared_lengths: float,
+    ) -> dict:
+        """
+        Records one logging interval of `steps` steps, with token and sample counts
+        summed over all ranks. `data_wait` is the time spent waiting on the data loader,
+        the remainder of `elapsed` is counted as compute.
+        """
+        flops = (
+            self.flops_per_token * num_tokens
+            + self.flops_per_squared_token * sum_squared_lengths
+        )
+        interval = (
+            elapsed,
+            data_wait,
+            steps,
+            num_tokens,
+            num_loss_counted_tokens,
+            num_samples,
+            flops,
+        )
+        self.intervals.append(interval)
+
+        metrics = self._rates(*interval)
+        window = self._rates(*map(sum, zip(*self.intervals)))
+        metrics.update({f"{key}_window": value for key, value in window.items()})
+        return metrics
+
+
+class StepMetrics:
+    """
+    Keeps the per-step training metrics on the device so the training loop never has to
+    wait for the GPU to catch up.
+
+    The loss-counted token and sample counts of a step are known before its forward
+    pass, so `start_step` all-reduces them asynchronously while the forward pass runs;
+    only the loss normalization waits for them, in `loss_tokens`. The loss and token
+    lengths, which only matter for logging, are accumulated locally and reduced across
+    ranks once per logging interval in `flush`, which every rank has to call. Values
+    are only copied back to the host in `flush` or when `samples_seen` is read.
+
+    `host_syncs` counts every device-to-host read this class performs, so a training
+    step that does not log or checkpoint is expected to leave it unchanged.
+
+    The micro-batches of an optimizer step are also tracked on their own until
+    `end_optimizer_step`, so that `drop_optimizer_step` can take a step whose gradients
+    were discarded, e.g. after running out of memory, back out of the totals.
+    """
+
+    # layout of the reduced per-step counts
+    TOKENS, SAMPLES = range(2)
+    # layout of the locally accumulated logging values
+    LOSS, TOTAL_TOKENS, SQUARED_LENGTHS = range(3)
+
+    def __init__(
+        self,
+        device: torch.device,
+        samples_seen: int = 0,
+        throughput: Optional[ThroughputTracker] = None,
+    ):
+        self.device = torch.device(device)
+        self.throughput = throughput
+        self.host_syncs = 0
+        self._samples_seen_base = samples_seen
+        self._samples_seen = torch.zeros((), dtype=torch.float64, device=self.device)
+        self._counts_window = torch.zeros(2, dtype=torch.float64, device=self.device)
+        self._local_window = torch.zeros(3, dtype=torch.float64, device=self.device)
+        # what the current optimizer step added to the windows and to samples_seen
+        self._pending_window = torch.zeros(5, dtype=torch.float64, device=self.device)
+        self._pending_samples = torch.zeros((), dtype=torch.float64, device=self.device)
+        self._pending_steps = 0
+        self._step_counts = None
+        self._step_counts_work = None
+        self._window_steps = 0
+        self._window_start = time.time()
+        self._data_wait = 0.0
+        self._grad_norm = None
+
+    def _to_device(self, values):
+        host = torch.tensor(values, dtype=torch.float32)
+        if self.device.type == "cuda":
+            # copying from pinned memory lets the host queue the transfer and move on
+            host = host.pin_memory()
+        return host.to(self.device, non_blocking=True)
+
+    def record_data_wait(self, seconds: float):
+        self._data_wait += seconds
+
+    def start_step(self, num_loss_counted_tokens: int, micro_batch_size: int):
+        """Starts summing this step's loss-counted tokens and samples across ranks."""
+        self._step_counts = self._to_device([num_loss_counted_tokens, micro_batch_size])
+        self._step_counts_work = None
+        if dist.is_initialized():
+            self._step_counts_work = dist.all_reduce(self._step_counts, async_op=True)
+
+    def loss_tokens(self) -> torch.Tensor:
+        """
+        Returns the number of loss-counted tokens of the current step summed over all
+        ranks, as a device scalar. With NCCL, waiting on the reduction started by
+        `start_step` only orders it before the work queued next, the host moves on.
+        """
+        if self._step_counts_work is not None:
+            self._step_counts_work.wait()
+            self._step_counts_work = None
+        return self._step_counts[self.TOKENS]
+
+    def end_step(
+        self,
+        loss: torch.Tensor,
+        total_length: int = 0,
+        sum_squared_lengths: int = 0,
+    ):
+        """Accumulates this rank's detached loss and token lengths for the next log."""
+        self.loss_tokens()
+        local = torch.cat(
+            [
+                loss.detach().to(self._local_window).reshape(1),
+                self._to_device([total_length, sum_squared_lengths]).to(
+                    self._local_window
+                ),
+            ]
+        )
+        self._counts_window += self._step_counts
+        self._samples_seen += self._step_counts[self.SAMPLES]
+        self._local_window += local
+        self._window_steps += 1
+        self._pending_window += torch.cat([self._step_counts.to(local), local])
+        self._pending_samples += self._step_counts[self.SAMPLES]
+        self._pending_steps += 1
+
+    def end_optimizer_step(self):
+        """Keeps the micro-batches of the optimizer step that was just taken."""
+        self._pending_window.zero_()
+        self._pending_samples.zero_()
+        self._pending_steps = 0
+
+    def drop_optimizer_step(self):
+        """
+        Removes the micro-batches of the current optimizer step, which was dropped, from
+        the totals, so micro-batches that are trained on again are not counted twice.
+        Micro-batches that were already logged by a `flush` stay in the logs.
+        """
+        self._counts_window -= self._pending_window[:2]
+        self._local_window -= self._pending_window[2:]
+        self._samples_seen -= self._pending_samples
+        self._window_steps -= self._pending_steps
+        self.end_optimizer_step()
+
+    def record_grad_norm(self, grad_norm):
+        self._grad_norm = grad_norm
+
+    @property
+    def samples_seen(self) -> int:
+        self.host_syncs += 1
+        return self._samples_seen_base + int(self._samples_seen.item())
+
+    def flush(self, read: bool = True) -> dict:
+        """
+        Returns the totals accumulated since the previous flush and starts a new window.
+        Must be called on every rank, as the logging values are reduced here. Ranks that
+        do not log pass `read=False` to reset the window without syncing.
+        """
+        metrics = {}
+        if self._window_steps and dist.is_initialized():
+            dist.all_reduce(self._local_window)
+        if read and self._window_steps:
+            # gather everything into one tensor so reading it back is a single sync
+            grad_norm = self._grad_norm
+            values = [
+                self._counts_window,
+                self._local_window,
+                self._samples_seen.reshape(1),
+            ]
+            if isinstance(grad_norm, torch.Tensor):
+                values.append(grad_norm.detach().to(self._local_window).reshape(1))
+            values = torch.cat(values).tolist()
+            self.host_syncs += 1
+            (
+                num_loss_counted_tokens,
+                batch_size,
+                loss,
+                total_length,
+                sum_squared_lengths,
+                samples_seen,
+            ) = values[:6]
+            if isinstance(grad_norm, torch.Tensor):
+                grad_norm = values[6]
+
+            # the read above waited for the GPU, so the wall time covers all the work
+            elapsed_time = time.time() - self._window_start
+            metrics = {
+                "num_loss_counted_tokens": int(num_loss_counted_tokens),
+                "num_tokens": int(total_length),
+                "batch_size": int(batch_size),
+                "total_loss": loss / max(num_loss_counted_tokens, 1),
+                "samples_seen": self._samples_seen_base + int(samples_seen),
+                "gradnorm": float(grad_norm) if grad_norm is not None else None,
+                "overall_throughput": batch_size / elapsed_time,
+                "steps": self._window_steps,
+                "host_syncs": self.host_syncs,
+            }
+            if self.throughput is not None:
+                metrics.update(
+                    self.throughput.update(
+                        elapsed=elapsed_time,
+                        data_wait=self._data_wait,
+                        steps=self._window_steps,
+                        num_tokens=total_length,
+                        num_loss_counted_tokens=num_loss_counted_tokens,
+                        num_samples=batch_size,
+                        sum_squared_lengths=sum_squared_lengths,
+                    )
+                )
+
+        self._counts_window.zero_()
+        self._local_window.zero_()
+        self._window_steps = 0
+        # the window was logged, a dropped step can only be taken out of samples_seen
+        self._pending_window.zero_()
+        self._pending_steps = 0
+        self._window_start = time.time()
+        self._data_wait = 0.0
+        return metrics
@@ -0,0 +1,220 @@
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Offline multipack planning.
+
+Runs the same packing search that `main_ds` performs at startup, but on CPU and for a
+hypothetical number of GPUs, so `effective_batch_size` and `max_batch_len` can be
+chosen without launching a distributed job:
+
+    python -m instructlab.training.multipack_planner \\
+        --data_path=/path/to/processed/data.jsonl \\
+        --num_gpus=64 --effective_batch_size=3840 --max_batch_len=60000
+"""
+
+# Standard
+from pathlib import Path
+import argparse
+import json
+
+# Third Party
+import numpy as np
+
+# First Party
+from instructlab.training.multipack_sampler import (
+    MultipackDistributedBatchSampler,
+    find_packing_max_batch_len_and_grad_accum,
+)
+
+
+class LengthsDataset:
+    """
+    Stand-in for `TokenDataset` that only carries the sample lengths, which is all
+    the packing search looks at.
+    """
+
+    def __init__(self, lengths: np.ndarray):
+        self.lengths = np.asarray(lengths)
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def get_lengths(self):
+        return self.lengths
+
+
+def load_lengths(data_path: str) -> np.ndarray:
+    """
+    Reads the sample lengths from either a processed `.jsonl` dataset (using its `len`
+    column when present) or a length index saved as `.npy` or as a JSON list.
+    """
+    path = Path(data_path)
+    if path.suffix == ".npy":
+        return np.load(path)
+    if path.suffix == ".json":
+        with open(path) as f:
+            return np.array(json.load(f))
+
+    lengths = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            sample = json.loads(line)
+            lengths.append(
+                sample["len"] if "len" in sample else len(sample["input_ids"])
+            )
+    return np.array(lengths)
+
+
+def plan_multipack(
+    lengths: np.ndarray,
+    num_gpus: int,
+    effective_batch_size: int,
+    max_batch_len: int,
+    is_padding: bool = False,
+    seed: int = 42,
+    balance_cost: bool = False,
+    attn_cost_coeff: float = 0.0,
+    carry_over_tail: bool = False,
+) -> dict:
+    """
+    Computes the packing length and gradient accumulation `main_ds` would pick for the
+    given dataset and GPU count, and summarizes the resulting first epoch.
+    """
+    dataset = LengthsDataset(lengths)
+    plan = {
+        "num_gpus": num_gpus,
+        "num_samples": len(dataset),
+        "avg_sample_len": float(lengths.mean()),
+        "max_sample_len": int(lengths.max()),
+        "effective_batch_size": effective_batch_size,
+        "max_batch_len_per_gpu": max_batch_len,
+    }
+    try:
+        packing_max_batch_len, grad_accum = find_packing_max_batch_len_and_grad_accum(
+            num_gpus=num_gpus,
+            avg_sample_len=lengths.mean(),
+            effective_batch_size=effective_batch_size,
+            max_batch_len_per_gpu=max_batch_len,
+            is_padding=is_padding,
+            dataset=dataset,
+            seed=seed,
+        )
+    except RuntimeError as e:
+        plan.update({"sampler": "distributed", "grad_accum": 1, "reason": str(e)})
+        return plan
+
+    sampler = MultipackDistributedBatchSampler(
+        batch_max_length=packing_max_batch_len,
+        lengths=dataset.get_lengths(),
+        num_replicas=num_gpus,
+        rank=0,
+        seed=seed,
+        padding=is_padding,
+        prefetch_next_epoch=False,
+        balance_cost=balance_cost,
+        attn_cost_coeff=attn_cost_coeff,
+        carry_over_tail=carry_over_tail,
+    )
+    epoch_stats = sampler.epoch_stats()
+    num_batches = epoch_stats["num_steps"]
+    num_packed = (
+        len(dataset)
+        - epoch_stats["dropped_long_samples"]
+        - epoch_stats["dropped_tail_samples"]
+    )
+    tokens_per_step = (
+        epoch_stats["tokens_per_rank_mean"] * num_gpus * grad_accum
+        if num_batches
+        else 0
+    )
+    plan.update(
+        {
+            "sampler": "multipack" if num_batches else "distributed",
+            "grad_accum": grad_accum,
+            "packing_max_batch_len": packing_max_batch_len,
+            "batches_per_epoch": num_batches,
+            "optimizer_steps_per_epoch": num_batches // grad_accum,
+            "avg_samples_per_step": (
+                num_packed / num_batches * grad_accum if num_batches else 0
+            ),
+            "est_tokens_per_step": tokens_per_step,
+            "multipack_plan": epoch_stats,
+        }
+    )
+    return plan
+
+
+def main(args):
+    lengths = load_lengths(args.data_path)
+    attn_cost_coeff = 1 / (12 * args.hidden_size) if args.hidden_size else 0.0
+    plan = plan_multipack(
+        lengths,
+        num_gpus=args.num_gpus,
+        effective_batch_size=args.effective_batch_size,
+        max_batch_len=args.max_batch_len,
+        is_padding=args.padding,
+        seed=args.seed,
+        balance_cost=args.multipack_balance_cost,
+        attn_cost_coeff=attn_cost_coeff,
+        carry_over_tail=args.multipack_carry_over_tail,
+    )
+
+    if args.json:
+        print(json.dumps(plan, indent=4))
+        return
+
+    if plan["sampler"] == "distributed":
+        print(
+            "\033[33mMultipack cannot be used with this configuration, training would fall back to the distributed sampler with grad_accum=1.\033[0m"
+        )
+        if "reason" in plan:
+            print(f"\033[33m{plan['reason']}\033[0m")
+        return
+
+    multipack_plan = plan.pop("multipack_plan")
+    for key, value in {**plan, **multipack_plan}.items():
+        if isinstance(value, float):
+            value = f"{value:.4f}"
+        print(f"\033[36m{key:>28}\033[0m: {value}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Simulate multipack planning for a processed dataset without GPUs"
+    )
+    parser.add_argument(
+        "--data_path",
+        type=str,
+        required=True,
+        help="Processed dataset (.jsonl) or a length index (.npy, or .json list of lengths)",
+    )
+    parser.add_argument(
+        "--num_gpus", type=int, required=True, help="Hypothetical number of GPUs"
+    )
+    parser.add_argument("--effective_batch_size", type=int, default=3840)
+    parser.add_argument("--max_batch_len", type=int, default=60000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument(
+        "--padding",
+        action="store_true",
+        help="Plan for padded batches, as used when flash attention is disabled.",
+    )
+    parser.add_argument("--multipack_balance_cost", action="store_true")
+    parser.add_argument("--multipack_carry_over_tail", action="store_true")
+    parser.add_argument(
+        "--hidden_size",
+        type=int,
+        default=None,
+        help="Model hidden size, used to weigh the attention cost in the balance statistics.",
+    )
+    parser.add_argument(
+        "--json", action="store_true", help="Print the plan as a JSON document."
+    )
+    args = parser.parse_args()
+    if args.padding and args.multipack_balance_cost:
+        parser.error(
+            "--multipack_balance_cost only supports padding-free batches, it cannot be combined with --padding"
+        )
+    main(args)
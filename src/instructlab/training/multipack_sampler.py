@@ -24,13 +24,15 @@ taken from https://github.com/imoneoi/multipack_sampler
 """
 
 # Standard
-from typing import List, Optional
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional
+import threading
+import time
 
 # Third Party
 from torch.utils.data import Sampler
 import numba
 import numpy as np
-import torch
 import torch.distributed as dist
 
 
@@ -67,11 +69,13 @@ def find_max_pack_len_with_padding(
 
         The function creates a sampler using the MultipackDistributedBatchSampler class, generates batches using the sampler, and then returns the ratio of the dataset size to the number of batches.
         """
+        # the number of batches is the same on every rank, so simulating rank 0
+        # of `num_gpus` replicas lets this run without a process group
         sampler = MultipackDistributedBatchSampler(
             batch_max_length=num_tokens_per_gpu,
             lengths=dataset.get_lengths(),
-            num_replicas=torch.distributed.get_world_size(),
-            rank=torch.distributed.get_rank(),
+            num_replicas=num_gpus,
+            rank=0,
             seed=seed,
             padding=True,
         )
@@ -138,6 +142,10 @@ def find_packing_max_batch_len_and_grad_accum(
     - effective_batch_size (int): The total batch size intended to be processed across all GPUs and
       accumulation steps.
     - max_batch_len_per_gpu (int): The maximum permissible number of tokens on each GPU to avoid memory overflow.
+    - is_padding (bool): Whether batches are padded rather than packed padding-free.
+    - dataset: Any object exposing `get_lengths()` and `__len__`, the search never touches the samples
+      themselves nor the process group, so this can run offline on CPU.
+    - seed (int): The seed used to shuffle the dataset when simulating the packing.
 
     Returns:
     - Tuple[int, int]: A tuple where the first element is the maximum batch length that can be achieved
@@ -170,7 +178,7 @@ def find_packing_max_batch_len_and_grad_accum(
     return packing_max_batch_len, grad_accum
 
 
-@numba.njit
+@numba.njit(nogil=True)
 def ffd_check(a: np.ndarray, c: int, n: int):
     # First-fit-decreasing bin packing
     # Check if a[] could fit in n bins with capacity c
@@ -192,7 +200,7 @@ def ffd_check(a: np.ndarray, c: int, n: int):
     return True
 
 
-@numba.njit
+@numba.njit(nogil=True)
 def ffd_check_padding(a: np.ndarray, c: int, n: int):
     # First-fit-decreasing bin packing
     # Check if a[] could fit in n bins with capacity c
@@ -225,7 +233,7 @@ def ffd_check_padding(a: np.ndarray, c: int, n: int):
     return True
 
 
-@numba.njit
+@numba.njit(nogil=True)
 def ffd_with_result(a: np.ndarray, c: int, start_index: int):
     # First-fit-decreasing bin packing (with result return)
 
@@ -250,7 +258,7 @@ def ffd_with_result(a: np.ndarray, c: int, start_index: int):
     return bins_result
 
 
-@numba.njit
+@numba.njit(nogil=True)
 def ffd_with_result_padding(a: np.ndarray, c: int, start_index: int):
     # First-fit-decreasing bin packing (with result return)
 
@@ -283,7 +291,66 @@ def ffd_with_result_padding(a: np.ndarray, c: int, start_index: int):
     return bins_result
 
 
-@numba.njit
+@numba.njit(nogil=True)
+def sample_cost(size, attn_cost_coeff: float):
+    # Estimated compute cost of a sample: the dense layers scale linearly with its
+    # length while attention scales quadratically
+    return size + attn_cost_coeff * size * size
+
+
+@numba.njit(nogil=True)
+def lpt_check(a: np.ndarray, c: int, n: int, attn_cost_coeff: float):
+    # Longest-processing-time-first scheduling under a token capacity
+    # Check if a[] could be spread over n bins with capacity c, always placing
+    # the next largest sample into the cheapest bin that still has room
+    # https://en.wikipedia.org/wiki/Longest-processing-time-first_scheduling
+
+    a = np.sort(a)[::-1]
+    bins_tokens = np.zeros((n,), dtype=a.dtype)
+    bins_cost = np.zeros((n,), dtype=np.float64)
+    for size in a:
+        best = -1
+        for idx in range(n):
+            if bins_tokens[idx] + size <= c and (
+                best == -1 or bins_cost[idx] < bins_cost[best]
+            ):
+                best = idx
+
+        if best == -1:
+            return False
+
+        bins_tokens[best] += size
+        bins_cost[best] += sample_cost(size, attn_cost_coeff)
+
+    return True
+
+
+@numba.njit(nogil=True)
+def lpt_with_result(a: np.ndarray, c: int, n: int, attn_cost_coeff: float):
+    # Longest-processing-time-first scheduling (with result return)
+    # Returns the bin assigned to every entry of a[], assumes lpt_check(a) holds
+
+    indices = np.argsort(a)[::-1]
+    bins_tokens = np.zeros((n,), dtype=a.dtype)
+    bins_cost = np.zeros((n,), dtype=np.float64)
+    assignment = np.full((len(a),), -1, dtype=np.int64)
+    for a_id in indices:
+        size = a[a_id]
+        best = -1
+        for idx in range(n):
+            if bins_tokens[idx] + size <= c and (
+                best == -1 or bins_cost[idx] < bins_cost[best]
+            ):
+                best = idx
+
+        bins_tokens[best] += size
+        bins_cost[best] += sample_cost(size, attn_cost_coeff)
+        assignment[a_id] = best
+
+    return assignment
+
+
+@numba.njit(nogil=True)
 def allocate(
     lengths: np.ndarray,
     lengths_cumsum: np.ndarray,
@@ -291,6 +358,7 @@ def allocate(
     c: int,
     n: int,
     padding: bool = True,
+    attn_cost_coeff: float = 0.0,
 ):
     # Dynamic batch allocator, similar to Multifit
     # https://en.wikipedia.org/wiki/Multifit_algorithm
@@ -300,6 +368,11 @@ def allocate(
     start_index = 0
     result = []
 
+    # per-step token count and estimated cost of every rank's bin
+    max_steps = len(lengths) // n + 1
+    step_tokens = np.zeros((max_steps, n), dtype=np.int64)
+    step_costs = np.zeros((max_steps, n), dtype=np.float64)
+
     while True:
         # binary search [l, r)
         l = 1
@@ -329,18 +402,122 @@ def allocate(
         if len(batch) < n:
             break
 
+        for bin_id in range(n):
+            for idx in batch[bin_id]:
+                step_tokens[len(result), bin_id] += lengths[idx]
+                step_costs[len(result), bin_id] += sample_cost(
+                    lengths[idx], attn_cost_coeff
+                )
+
         start_index += l
         s = lengths_cumsum[start_index - 1]
 
         # add local rank
         result.append(batch[rank])
 
-    return result, s, len(result) * c * n
+    num_steps = len(result)
+    return (
+        result,
+        s,
+        num_steps * c * n,
+        step_tokens[:num_steps],
+        step_costs[:num_steps],
+    )
+
+
+@numba.njit(nogil=True)
+def allocate_balanced(
+    lengths: np.ndarray,
+    lengths_cumsum: np.ndarray,
+    rank: int,
+    c: int,
+    n: int,
+    attn_cost_coeff: float,
+):
+    # Same global step construction as `allocate`, but the samples of each step are
+    # spread over the n bins so that their estimated compute cost is balanced,
+    # rather than their token counts. Ranks then finish their forward/backward at
+    # roughly the same time and spend less time waiting in collectives.
+
+    s = 0
+    start_index = 0
+    result = []
+
+    max_steps = len(lengths) // n + 1
+    step_tokens = np.zeros((max_steps, n), dtype=np.int64)
+    step_costs = np.zeros((max_steps, n), dtype=np.float64)
+
+    while True:
+        # binary search [l, r)
+        l = 1
+        r = 1 + np.searchsorted(lengths_cumsum[start_index:], s + c * n, "right")
+
+        while r - l > 1:
+            m = (l + r) // 2
+            if lpt_check(lengths[start_index : start_index + m], c, n, attn_cost_coeff):
+                l = m
+            else:
+                r = m
+
+        # use length l, every bin needs at least one sample
+        if l < n or start_index + l > len(lengths):
+            break
+        assignment = lpt_with_result(
+            lengths[start_index : start_index + l], c, n, attn_cost_coeff
+        )
+        if np.bincount(assignment, minlength=n).min() == 0:
+            break
+
+        for a_id in range(l):
+            size = lengths[start_index + a_id]
+            step_tokens[len(result), assignment[a_id]] += size
+            step_costs[len(result), assignment[a_id]] += sample_cost(
+                size, attn_cost_coeff
+            )
+
+        # add local rank
+        result.append(np.where(assignment == rank)[0] + start_index)
+
+        start_index += l
+        s = lengths_cumsum[start_index - 1]
+
+    num_steps = len(result)
+    return (
+        result,
+        s,
+        num_steps * c * n,
+        step_tokens[:num_steps],
+        step_costs[:num_steps],
+    )
 
 
 class MultipackDistributedBatchSampler(Sampler):
     """Unpadded length sampling using Multipack.
     Approximate (at most ~1.22x) the optimal solution of the identical-machines scheduling problem, which is NP-hard.
+
+    Packing plans are cached per epoch. When `prefetch_next_epoch` is set, calling
+    `set_epoch(N)` also starts building the plan for epoch N+1 on a background thread
+    (the numba kernels release the GIL), so the next epoch boundary does not stall
+    on `generate_batches`.
+
+    With `balance_cost` set, the samples of every global step are distributed so that
+    each rank gets a similar estimated compute cost (`length + attn_cost_coeff * length**2`)
+    instead of a similar token count, since attention makes a bin holding one long
+    sample slower than a bin holding many short samples of the same total length.
+
+    The last few samples of an epoch that cannot fill a global step across all ranks
+    are normally skipped. With `carry_over_tail` set, they are moved to the front of the
+    next epoch's permutation instead, so every sample is still used at most once per
+    epoch. The tail of the last epoch is skipped all the same. Plans then depend on the
+    previous epoch, so resuming at epoch N replays the (cheap) planning of epochs
+    0..N-1.
+
+    `set_epoch(N, start_batch=K)` makes iteration start at batch K of the epoch's plan,
+    so resuming mid-epoch never loads or collates the batches that were already trained
+    on. `len()` still counts every batch of the epoch.
+
+    `replan` packs the rest of the current epoch again with a smaller capacity, to
+    recover from running out of memory without restarting the epoch.
     """
 
     def __init__(
@@ -351,6 +528,10 @@ class MultipackDistributedBatchSampler(Sampler):
         rank: Optional[int] = None,
         seed: int = 0,
         padding: bool = True,
+        prefetch_next_epoch: bool = True,
+        balance_cost: bool = False,
+        attn_cost_coeff: float = 0.0,
+        carry_over_tail: bool = False,
     ):
         # Get rank
         if num_replicas is None:
@@ -371,51 +552,215 @@ class MultipackDistributedBatchSampler(Sampler):
         assert isinstance(self.lengths, np.ndarray)
 
         self.epoch = 0
+        self.start_batch = 0
 
         # statistics
         self.eff_total_used = 0
         self.eff_total_slots = 0
         self.padding = padding
 
-    def set_epoch(self, epoch: int):
+        if balance_cost and padding:
+            raise ValueError(
+                "Cost-balanced multipack packing is only supported for padding-free batches."
+            )
+        self.balance_cost = balance_cost
+        self.attn_cost_coeff = attn_cost_coeff
+        self.carry_over_tail = carry_over_tail
+
+        # epoch -> Future[plan], see `_generate_plan`
+        self.prefetch_next_epoch = prefetch_next_epoch
+        self._plans: Dict[int, Future] = {}
+        self._plans_lock = threading.Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def __getstate__(self):
+        # the executor, lock and in-flight futures can be neither copied nor pickled,
+        # plans are simply recomputed on demand by the copy
+        state = self.__dict__.copy()
+        state["_plans"] = {}
+        state["_plans_lock"] = None
+        state["_executor"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._plans_lock = threading.Lock()
+
+    def set_epoch(self, epoch: int, start_batch: int = 0):
         self.epoch = epoch
-
-    def generate_batches(self, set_stats=False):
-        indices = np.random.default_rng(seed=self.seed + self.epoch).permutation(
+        self.start_batch = start_batch
+        with self._plans_lock:
+            # plans from earlier epochs will not be needed again, except for the
+            # previous epoch's leftover samples when they are carried over
+            for stale in [e for e in self._plans if e < epoch - 1]:
+                del self._plans[stale]
+        if self.prefetch_next_epoch:
+            self._submit_plan(epoch)
+            self._submit_plan(epoch + 1)
+
+    def _submit_plan(self, epoch: int) -> Future:
+        with self._plans_lock:
+            future = self._plans.get(epoch)
+            if future is None:
+                if self._executor is None:
+                    # a single worker keeps plans computed in epoch order
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=1, thread_name_prefix="multipack-plan"
+                    )
+                future = self._executor.submit(self._generate_plan, epoch)
+                self._plans[epoch] = future
+            return future
+
+    def _get_plan(self, epoch: int):
+        with self._plans_lock:
+            future = self._plans.get(epoch)
+            compute = future is None
+            if compute:
+                future = Future()
+                self._plans[epoch] = future
+
+        if compute:
+            # nothing in flight, compute on the calling thread. This must happen
+            # outside of the lock, carrying over the tail plans the previous epoch
+            try:
+                future.set_result(self._generate_plan(epoch))
+            except BaseException as e:
+                future.set_exception(e)
+                raise
+        return future.result()
+
+    def _generate_plan(self, epoch: int):
+        start = time.perf_counter()
+        indices = np.random.default_rng(seed=self.seed + epoch).permutation(
             len(self.lengths)
         )
 
+        # samples left over at the end of the previous epoch go first, and are taken
+        # out of this epoch's permutation so they are not trained on twice
+        carried = np.array([], dtype=indices.dtype)
+        if self.carry_over_tail and epoch > 0:
+            carried = self._get_plan(epoch - 1)["tail"]
+            indices = np.concatenate([carried, indices[~np.isin(indices, carried)]])
+
+        plan = self._pack(indices)
+        plan["num_carried_over"] = len(carried)
+        plan["plan_time"] = time.perf_counter() - start
+        return plan
+
+    def _pack(self, indices: np.ndarray):
         # remove indices where the entries are longer than batch max length
+        num_candidates = len(indices)
         indices = indices[self.lengths[indices] <= self.batch_max_length]
-        if len(indices) < len(self.lengths):
+        if len(indices) < num_candidates:
             print(
-                f"\033[33mDropping {len(self.lengths) - len(indices)} samples longer than batch_max_length. Ensure that the right max_batch_length is used during data processing.\033[0m"
+                f"\033[33mDropping {num_candidates - len(indices)} samples longer than batch_max_length. Ensure that the right max_batch_length is used during data processing.\033[0m"
             )
 
         lengths = self.lengths[indices]
         lengths_cumsum = np.cumsum(lengths)
 
-        batches, total_used, total_slots = allocate(
-            lengths=lengths,
-            lengths_cumsum=lengths_cumsum,
-            rank=self.rank,
-            c=self.batch_max_length,
-            n=self.num_replicas,
-            padding=self.padding,
-        )
+        if self.balance_cost:
+            batches, total_used, total_slots, step_tokens, step_costs = (
+                allocate_balanced(
+                    lengths=lengths,
+                    lengths_cumsum=lengths_cumsum,
+                    rank=self.rank,
+                    c=self.batch_max_length,
+                    n=self.num_replicas,
+                    attn_cost_coeff=self.attn_cost_coeff,
+                )
+            )
+        else:
+            batches, total_used, total_slots, step_tokens, step_costs = allocate(
+                lengths=lengths,
+                lengths_cumsum=lengths_cumsum,
+                rank=self.rank,
+                c=self.batch_max_length,
+                n=self.num_replicas,
+                padding=self.padding,
+                attn_cost_coeff=self.attn_cost_coeff,
+            )
 
         batches = [indices[batch] for batch in batches]
+        # steps consume a prefix of the permutation, the remainder could not fill n bins
+        num_allocated = int(np.searchsorted(lengths_cumsum, total_used, side="right"))
+        return {
+            "indices": indices,
+            "batches": batches,
+            "total_used": total_used,
+            "total_slots": total_slots,
+            "step_tokens": step_tokens,
+            "step_costs": step_costs,
+            "num_dropped_long": num_candidates - len(indices),
+            "num_dropped_tail": len(indices) - num_allocated,
+            "data_utilization": len(np.unique(indices[:num_allocated]))
+            / len(self.lengths),
+            "tail": indices[num_allocated:],
+        }
+
+    def replan(self, batch_max_length: int, start_batch: int):
+        """
+        Packs the samples of the current epoch that batch `start_batch` and the ones
+        after it would have used again, into bins of `batch_max_length` tokens, and
+        makes iteration start at `start_batch`. Earlier batches keep their place in the
+        plan, and later epochs are planned with the new capacity.
+
+        Every global step consumes a prefix of the epoch's permutation, so the tokens of
+        the first `start_batch` steps locate the first sample that was not trained on.
+        """
+        start = time.perf_counter()
+        old = self._get_plan(self.epoch)
+        old_capacity = self.batch_max_length
+        self.batch_max_length = batch_max_length
+
+        consumed_tokens = int(old["step_tokens"][:start_batch].sum())
+        lengths_cumsum = np.cumsum(self.lengths[old["indices"]])
+        offset = int(np.searchsorted(lengths_cumsum, consumed_tokens, side="right"))
+        new = self._pack(old["indices"][offset:])
+        plan = {
+            "indices": np.concatenate([old["indices"][:offset], new["indices"]]),
+            "batches": old["batches"][:start_batch] + new["batches"],
+            "total_used": consumed_tokens + new["total_used"],
+            "total_slots": start_batch * old_capacity * self.num_replicas
+            + new["total_slots"],
+            "step_tokens": np.concatenate(
+                [old["step_tokens"][:start_batch], new["step_tokens"]]
+            ),
+            "step_costs": np.concatenate(
+                [old["step_costs"][:start_batch], new["step_costs"]]
+            ),
+            "num_dropped_long": old["num_dropped_long"] + new["num_dropped_long"],
+            "num_dropped_tail": new["num_dropped_tail"],
+            "num_carried_over": old["num_carried_over"],
+            "data_utilization": offset / len(self.lengths) + new["data_utilization"],
+            "tail": new["tail"],
+            "plan_time": time.perf_counter() - start,
+        }
+
+        future = Future()
+        future.set_result(plan)
+        with self._plans_lock:
+            self._plans[self.epoch] = future
+            # later plans were built with the old capacity (and tail)
+            for stale in [e for e in self._plans if e > self.epoch]:
+                del self._plans[stale]
+        self.start_batch = start_batch
+        if self.prefetch_next_epoch:
+            self._submit_plan(self.epoch + 1)
+
+    def generate_batches(self, set_stats=False):
+        plan = self._get_plan(self.epoch)
 
         # statistics
         if set_stats:
-            self.eff_total_used += total_used
-            self.eff_total_slots += total_slots
+            self.eff_total_used += plan["total_used"]
+            self.eff_total_slots += plan["total_slots"]
 
-        return batches
+        return plan["batches"]
 
     def __iter__(self):
         batches = self.generate_batches(set_stats=True)
-        return iter(batches)
+        return iter(batches[self.start_batch :])
 
     def __len__(self):
         return self.num_batches()
@@ -425,4 +770,49 @@ class MultipackDistributedBatchSampler(Sampler):
         return len(batches)
 
     def efficiency(self):
+        if not self.eff_total_slots:
+            return 0.0
         return self.eff_total_used / self.eff_total_slots
+
+    def imbalance_stats(self):
+        """
+        Summarizes how evenly the estimated compute cost of the current epoch is spread
+        across ranks. The imbalance of a step is the ratio between its most expensive
+        bin and the average bin, so 1.0 means every rank does the same amount of work.
+        """
+        step_costs = self._get_plan(self.epoch)["step_costs"]
+        if len(step_costs) == 0:
+            return {"cost_imbalance_mean": None, "cost_imbalance_max": None}
+        imbalance = step_costs.max(axis=1) / np.maximum(step_costs.mean(axis=1), 1e-9)
+        return {
+            "cost_imbalance_mean": float(imbalance.mean()),
+            "cost_imbalance_max": float(imbalance.max()),
+        }
+
+    def epoch_stats(self):
+        """
+        Packing statistics of the current epoch's plan, meant to be emitted at the start
+        of every epoch for capacity planning of `max_batch_len` and the GPU count.
+        """
+        plan = self._get_plan(self.epoch)
+        step_tokens = plan["step_tokens"]
+        stats = {
+            "num_steps": len(step_tokens),
+            "efficiency": (
+                plan["total_used"] / plan["total_slots"]
+                if plan["total_slots"]
+                else None
+            ),
+            "tokens_per_rank_min": int(step_tokens.min()) if step_tokens.size else None,
+            "tokens_per_rank_mean": (
+                float(step_tokens.mean()) if step_tokens.size else None
+            ),
+            "tokens_per_rank_max": int(step_tokens.max()) if step_tokens.size else None,
+            "dropped_long_samples": plan["num_dropped_long"],
+            "dropped_tail_samples": plan["num_dropped_tail"],
+            "carried_over_samples": plan["num_carried_over"],
+            "data_utilization": plan["data_utilization"],
+            "plan_time_seconds": plan["plan_time"],
+        }
+        stats.update(self.imbalance_stats())
+        return stats
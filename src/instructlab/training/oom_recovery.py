@@ -0,0 +1,204 @@
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Recovery from CUDA out-of-memory errors in the training loop.
+
+Every rank runs its forward and backward passes inside `OOMGuard.catch`, which swallows
+an OOM, and then calls `OOMGuard.vote`, which tells every rank whether any of them ran
+out of memory. All ranks therefore drop the same optimizer step together. The gradients
+accumulated for it are released, the multipack sampler packs the rest of the epoch again
+with a smaller capacity, and training resumes at the first micro-batch of that step.
+
+The vote runs over a gloo group on the host, and the ranks that did not run out of
+memory only reach it once their host has queued the whole pass. This does not cover
+every failure:
+
+- A rank that runs out of memory in the middle of the forward or backward pass never
+  issues the FSDP collectives of the rest of that pass, while the other ranks already
+  queued theirs. NCCL then waits for collectives that never come, and the job is only
+  torn down by the NCCL watchdog timeout. Recovery is reliable when the OOM happens on
+  every rank, or on a rank before it diverges from the others, such as in the
+  allocation of the first activations or of the loss.
+- An OOM outside of the guarded passes, e.g. in the optimizer step, is not recovered.
+- Resuming from a checkpoint replans every epoch with the original capacity.
+"""
+
+# Standard
+from contextlib import contextmanager
+from typing import Optional, Tuple
+import gc
+
+# Third Party
+import torch
+import torch.distributed as dist
+
+# First Party
+from instructlab.training.multipack_sampler import MultipackDistributedBatchSampler
+
+
+def is_oom_error(exc: BaseException) -> bool:
+    return isinstance(exc, torch.cuda.OutOfMemoryError) or (
+        isinstance(exc, RuntimeError) and "out of memory" in str(exc)
+    )
+
+
+class OOMGuard:
+    """
+    Catches CUDA out-of-memory errors on this rank and agrees with the other ranks on
+    whether the current step failed. When disabled, `catch` lets every error through
+    and `vote` returns False without communicating.
+
+    `restart_batch` is set by `recover` when the epoch was replanned, and tells
+    `iterate_epoch` to restart the data loader at that batch.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = False,
+        shrink_factor: float = 0.8,
+        max_recoveries: int = 5,
+        group: Optional[dist.ProcessGroup] = None,
+    ):
+        self.enabled = enabled
+        self.shrink_factor = shrink_factor
+        self.max_recoveries = max_recoveries
+        self.num_recoveries = 0
+        self.restart_batch = None
+        self._failed = False
+        self.failed_phase = None
+        self.num_failed_ranks = 0
+        if enabled and group is None and dist.is_initialized():
+            group = dist.new_group(backend="gloo")
+        self.group = group
+
+    @contextmanager
+    def catch(self):
+        if not self.enabled:
+            yield
+            return
+        try:
+            yield
+        except Exception as exc:  # pylint: disable=broad-exception-caught
+            if not is_oom_error(exc):
+                raise
+            self._failed = True
+
+    @property
+    def failed(self) -> bool:
+        """Whether this rank ran out of memory since the previous vote."""
+        return self._failed
+
+    def vote(self, phase: str, num_failed_ranks: Optional[int] = None) -> bool:
+        """
+        Returns whether any rank ran out of memory since the previous vote, which was
+        held after `phase`. Every rank has to call it at the same point. When another
+        reduction already summed `failed` across ranks, its total is passed as
+        `num_failed_ranks` and the vote issues no collective.
+        """
+        if not self.enabled:
+            return False
+        if num_failed_ranks is None:
+            failed = torch.tensor([self._failed], dtype=torch.int64)
+            if self.group is not None:
+                dist.all_reduce(failed, group=self.group)
+            num_failed_ranks = int(failed)
+        self._failed = False
+        self.num_failed_ranks = num_failed_ranks
+        if self.num_failed_ranks:
+            self.failed_phase = phase
+        return self.num_failed_ranks > 0
+
+    def recover(
+        self,
+        optimizer,
+        sampler,
+        restart_batch: int,
+        min_batch_len: int,
+    ) -> dict:
+        """
+        Releases the memory of the failed step and, with a multipack sampler, replans
+        the rest of the epoch with `shrink_factor` times the capacity, never below
+        `min_batch_len`, starting at `restart_batch`. Other samplers cannot replan, so
+        the failed step is skipped. Raises once recovery is not possible anymore.
+        """
+        self.num_recoveries += 1
+        if self.num_recoveries > self.max_recoveries:
+            raise RuntimeError(
+                f"Ran out of memory {self.num_recoveries} times, giving up on OOM recovery"
+            )
+
+        # the gradients of a pass that failed midway are incomplete, the step is dropped
+        optimizer.zero_grad(set_to_none=True)
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+        event = {
+            "phase": self.failed_phase,
+            "failed_ranks": self.num_failed_ranks,
+            "recoveries": self.num_recoveries,
+        }
+        if isinstance(sampler, MultipackDistributedBatchSampler):
+            capacity = max(
+                int(sampler.batch_max_length * self.shrink_factor), min_batch_len
+            )
+            if capacity >= sampler.batch_max_length:
+                raise RuntimeError(
+                    f"Ran out of memory with a packing capacity of {sampler.batch_max_length} tokens, which cannot be reduced any further"
+                )
+            event["previous_batch_max_length"] = sampler.batch_max_length
+            sampler.replan(capacity, restart_batch)
+            event["batch_max_length"] = capacity
+            event["restart_batch"] = restart_batch
+            self.restart_batch = restart_batch
+        return event
+
+
+def recover_step(
+    guard: OOMGuard,
+    optimizer,
+    train_loader,
+    batch_index: int,
+    step_start_batch: int,
+    global_step: int,
+    skip_window: bool,
+) -> Tuple[dict, int, int, bool]:
+    """
+    Recovers the training loop from an OOM at `batch_index`, in the optimizer step that
+    started at `step_start_batch`. Returns the recovery event, the `global_step` and
+    `step_start_batch` to continue with, and whether the rest of the accumulation window
+    is skipped, which `skip_window` asks for when the step cannot be retried.
+    """
+    event = guard.recover(
+        optimizer,
+        train_loader.batch_sampler,
+        restart_batch=step_start_batch,
+        # every micro-batch still has to fit the longest sample
+        min_batch_len=int(train_loader.dataset.get_lengths().max()),
+    )
+    if guard.restart_batch is not None:
+        # the step is retried from its first micro-batch on the new plan
+        return (
+            event,
+            global_step - (batch_index - step_start_batch),
+            step_start_batch,
+            False,
+        )
+    return event, global_step + 1, batch_index + 1, skip_window
+
+
+def iterate_epoch(train_loader, start_batch: int, guard: OOMGuard):
+    """
+    Yields the batches of an epoch along with their index in the epoch. When `guard`
+    replanned the epoch, the loader is restarted at the batch it asked for.
+    """
+    batch_index = start_batch
+    while True:
+        for batch in train_loader:
+            yield batch_index, batch
+            if guard.restart_batch is not None:
+                break
+            batch_index += 1
+        else:
+            return
+        batch_index, guard.restart_batch = guard.restart_batch, None
@@ -0,0 +1,229 @@
+# SPDX-License-Identifier: Apache-2.0
+
+# Standard
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+import time
+import warnings
+
+# Third Party
+import torch
+
+# First Party
+from instructlab.training.config import OptimizerType
+
+OptimizerBuilder = Callable[..., torch.optim.Optimizer]
+OPTIMIZERS: Dict[str, OptimizerBuilder] = {}
+
+
+def register_optimizer(name: str):
+    """
+    Registers a function building an optimizer from parameter groups, a learning rate
+    and betas under `name`, so it can be selected with `--optimizer`.
+    """
+
+    def register(builder: OptimizerBuilder) -> OptimizerBuilder:
+        OPTIMIZERS[name] = builder
+        return builder
+
+    return register
+
+
+@register_optimizer(OptimizerType.ADAMW.value)
+def _adamw(param_groups, lr, betas):
+    return torch.optim.AdamW(param_groups, lr=lr, betas=betas)
+
+
+@register_optimizer(OptimizerType.ADAMW_FOREACH.value)
+def _adamw_foreach(param_groups, lr, betas):
+    # updates all the parameters of a group with a few multi-tensor kernels
+    return torch.optim.AdamW(param_groups, lr=lr, betas=betas, foreach=True)
+
+
+@register_optimizer(OptimizerType.ADAMW_FUSED.value)
+def _adamw_fused(param_groups, lr, betas):
+    # the whole update of a group in a single kernel
+    return torch.optim.AdamW(param_groups, lr=lr, betas=betas, fused=True)
+
+
+@register_optimizer(OptimizerType.ADAMW_8BIT.value)
+def _adamw_8bit(param_groups, lr, betas):
+    try:
+        # Third Party
+        from bitsandbytes.optim import AdamW8bit
+    except ImportError as exc:
+        raise ImportError(
+            "The adamw_8bit optimizer requires bitsandbytes to be installed"
+        ) from exc
+    # keeps both moments block-wise quantized to 8 bits, a quarter of fp32 state
+    return AdamW8bit(param_groups, lr=lr, betas=betas)
+
+
+@register_optimizer(OptimizerType.ADAMW_BF16_STATE.value)
+def _adamw_bf16_state(param_groups, lr, betas):
+    return AdamWBF16State(param_groups, lr=lr, betas=betas)
+
+
+class AdamWBF16State(torch.optim.Optimizer):
+    """
+    AdamW keeping both moments in bfloat16, half the memory of fp32 optimizer state.
+    The moments are updated and applied in fp32, only their storage is rounded.
+    """
+
+    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8, weight_decay=0.0):
+        defaults = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay)
+        super().__init__(params, defaults)
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+
+        for group in self.param_groups:
+            beta1, beta2 = group["betas"]
+            for param in group["params"]:
+                if param.grad is None:
+                    continue
+                state = self.state[param]
+                if not state:
+                    state["step"] = 0
+                    state["exp_avg"] = torch.zeros_like(param, dtype=torch.bfloat16)
+                    state["exp_avg_sq"] = torch.zeros_like(param, dtype=torch.bfloat16)
+                state["step"] += 1
+
+                grad = param.grad.float()
+                exp_avg = state["exp_avg"].float().lerp_(grad, 1 - beta1)
+                exp_avg_sq = state["exp_avg_sq"].float()
+                exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+                state["exp_avg"].copy_(exp_avg)
+                state["exp_avg_sq"].copy_(exp_avg_sq)
+
+                bias_correction1 = 1 - beta1 ** state["step"]
+                bias_correction2 = 1 - beta2 ** state["step"]
+                denom = (exp_avg_sq / bias_correction2).sqrt_().add_(group["eps"])
+                update = exp_avg.div_(denom).mul_(group["lr"] / bias_correction1)
+                if group["weight_decay"]:
+                    param.mul_(1 - group["lr"] * group["weight_decay"])
+                param.sub_(update.to(param.dtype))
+        return loss
+
+
+def is_decayed(name: str) -> bool:
+    # decided by name, FSDP flattens the sharded parameters so their shape is lost
+    name = name.lower()
+    return not (name.endswith("bias") or "norm" in name or "ln_" in name)
+
+
+def original_param_names(name: str, param: torch.nn.Parameter) -> List[str]:
+    """
+    Names of the model parameters behind `param`. FSDP without `use_orig_params`
+    (as with LoRA) flattens each wrapped module into one `_flat_param`, which keeps
+    the names of the parameters it holds in `_fqns`.
+    """
+    fqns = getattr(param, "_fqns", None)
+    if not fqns:
+        return [name]
+    # the names are relative to the module holding the flat parameter
+    prefix = name[: -len("_flat_param")]
+    return [prefix + fqn for fqn in fqns]
+
+
+def make_param_groups(model: torch.nn.Module, weight_decay: float) -> List[dict]:
+    """
+    Splits the trainable parameters of `model` into a group with `weight_decay` and one
+    without it for biases and norm weights, in a single pass over the parameters.
+    A flat parameter mixing both kinds cannot be split and is decayed as a whole.
+    """
+    if not weight_decay:
+        return [
+            {
+                "params": [p for p in model.parameters() if p.requires_grad],
+                "weight_decay": 0.0,
+            }
+        ]
+
+    decay, no_decay, mixed = [], [], []
+    for name, param in model.named_parameters():
+        if not param.requires_grad:
+            continue
+        decayed = [is_decayed(n) for n in original_param_names(name, param)]
+        if all(decayed):
+            decay.append(param)
+        elif not any(decayed):
+            no_decay.append(param)
+        else:
+            decay.append(param)
+            mixed.append(name)
+    if mixed:
+        warnings.warn(
+            f"{len(mixed)} flattened FSDP parameters hold both weights and biases or "
+            f"norms, weight decay is applied to all of them (e.g. {mixed[0]})"
+        )
+    groups = [{"params": decay, "weight_decay": weight_decay}]
+    if no_decay:
+        groups.append({"params": no_decay, "weight_decay": 0.0})
+    return groups
+
+
+def create_optimizer(
+    optimizer_type: OptimizerType,
+    param_groups: List[dict],
+    lr: float,
+    betas: Tuple[float, float],
+) -> torch.optim.Optimizer:
+    optimizer_type = OptimizerType(optimizer_type)
+    return OPTIMIZERS[optimizer_type.value](param_groups, lr=lr, betas=betas)
+
+
+def optimizer_state_bytes(optimizer) -> int:
+    """Size of this rank's optimizer state, e.g. the Adam moments of its shards."""
+    state = getattr(optimizer, "state", None) or {}
+    return sum(
+        value.numel() * value.element_size()
+        for param_state in state.values()
+        for value in param_state.values()
+        if isinstance(value, torch.Tensor)
+    )
+
+
+class OptimizerStats:
+    """
+    Times the optimizer steps, with CUDA events resolved in `flush` so timing does not
+    add syncs to the step, and reports the optimizer state memory.
+    """
+
+    def __init__(self, optimizer, use_cuda: Optional[bool] = None):
+        self.optimizer = optimizer
+        self.use_cuda = torch.cuda.is_available() if use_cuda is None else use_cuda
+        self._events = []
+        self._durations = []
+
+    @contextmanager
+    def time_step(self):
+        if self.use_cuda:
+            start = torch.cuda.Event(enable_timing=True)
+            end = torch.cuda.Event(enable_timing=True)
+            start.record()
+            yield
+            end.record()
+            self._events.append((start, end))
+        else:
+            start = time.perf_counter()
+            yield
+            self._durations.append(time.perf_counter() - start)
+
+    def flush(self) -> dict:
+        for start, end in self._events:
+            end.synchronize()
+            self._durations.append(start.elapsed_time(end) / 1000)
+        self._events = []
+        metrics = {
+            "optimizer_step_time": (
+                sum(self._durations) / len(self._durations) if self._durations else None
+            ),
+            "optimizer_state_bytes": optimizer_state_bytes(self.optimizer),
+        }
+        self._durations = []
+        return metrics
@@ -0,0 +1,152 @@
+# SPDX-License-Identifier: Apache-2.0
+
+# Standard
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+from typing import Optional, Tuple
+import time
+
+# Third Party
+import numpy as np
+import torch
+
+# upper bucket edges of the phase duration histograms, in milliseconds
+HISTOGRAM_EDGES_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+
+def parse_step_range(step_range: Optional[str]) -> Optional[Tuple[int, int]]:
+    """Parses `START:END` into an inclusive range of global steps."""
+    if not step_range:
+        return None
+    start, end = (int(step) for step in step_range.split(":"))
+    if end < start:
+        raise ValueError(
+            f"Invalid step range {step_range}, END must not be before START"
+        )
+    return start, end
+
+
+class StepPhaseProfiler:
+    """
+    Times the phases of a training step, e.g. waiting on the data loader, the host to
+    device copy, forward, backward, the optimizer step and checkpoint saves.
+
+    Phases that run on the GPU are timed with CUDA events, which are only resolved in
+    `flush`, so timing does not add syncs to the step. Host-side phases, and every
+    phase when CUDA is not available, use the wall clock. When disabled, `phase` is a
+    no-op context manager.
+
+    Independently of the phase timing, a `torch.profiler` trace can be captured for an
+    inclusive range of global steps with `trace_steps`.
+    """
+
+    PHASES = ("data_wait", "h2d", "forward", "backward", "optimizer", "checkpoint")
+
+    def __init__(
+        self,
+        enabled: bool = False,
+        use_cuda: Optional[bool] = None,
+        trace_steps: Optional[Tuple[int, int]] = None,
+        trace_dir: Optional[str] = None,
+        rank: int = 0,
+    ):
+        self.enabled = enabled
+        self.use_cuda = torch.cuda.is_available() if use_cuda is None else use_cuda
+        self.trace_steps = trace_steps
+        self.trace_dir = trace_dir
+        self.rank = rank
+        self._durations = defaultdict(list)
+        self._pending = []
+        self._trace = None
+        self._trace_done = False
+
+    def record(self, name: str, seconds: float):
+        if self.enabled:
+            self._durations[name].append(seconds)
+
+    def phase(self, name: str, host: bool = False):
+        """Context manager timing its block as phase `name`."""
+        if not self.enabled:
+            return nullcontext()
+        if host or not self.use_cuda:
+            return self._time_host(name)
+        return self._time_device(name)
+
+    @contextmanager
+    def _time_host(self, name: str):
+        start = time.perf_counter()
+        yield
+        self.record(name, time.perf_counter() - start)
+
+    @contextmanager
+    def _time_device(self, name: str):
+        start = torch.cuda.Event(enable_timing=True)
+        end = torch.cuda.Event(enable_timing=True)
+        start.record()
+        yield
+        end.record()
+        self._pending.append((name, start, end))
+
+    def start_step(self, global_step: int):
+        # a resumed run, or one that skipped a step, may never see START itself
+        if (
+            self.trace_steps is None
+            or self._trace is not None
+            or self._trace_done
+            or not self.trace_steps[0] <= global_step <= self.trace_steps[1]
+        ):
+            return
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self._trace = torch.profiler.profile(
+            activities=activities, record_shapes=True, with_stack=True
+        )
+        self._trace.__enter__()
+
+    def end_step(self, global_step: int):
+        if self._trace is None or global_step < self.trace_steps[1]:
+            return
+        self._trace.__exit__(None, None, None)
+        start, end = self.trace_steps
+        trace_dir = Path(self.trace_dir or ".")
+        trace_dir.mkdir(parents=True, exist_ok=True)
+        trace_file = trace_dir / f"trace_rank{self.rank}_steps{start}-{end}.json"
+        self._trace.export_chrome_trace(str(trace_file))
+        self._trace = None
+        self._trace_done = True
+        print(f"\033[92mSaved torch profiler trace to {trace_file}\033[0m")
+
+    def flush(self) -> dict:
+        """
+        Summarizes the phase durations recorded since the previous flush, waiting for
+        the CUDA events that are still pending.
+        """
+        for name, start, end in self._pending:
+            end.synchronize()
+            self._durations[name].append(start.elapsed_time(end) / 1000)
+        self._pending = []
+
+        summary = {}
+        for name, durations in self._durations.items():
+            durations_ms = np.array(durations) * 1000
+            counts = np.bincount(
+                np.searchsorted(HISTOGRAM_EDGES_MS, durations_ms, side="right"),
+                minlength=len(HISTOGRAM_EDGES_MS) + 1,
+            )
+            labels = [f"<{edge}ms" for edge in HISTOGRAM_EDGES_MS]
+            labels.append(f">={HISTOGRAM_EDGES_MS[-1]}ms")
+            summary[name] = {
+                "count": len(durations),
+                "total_seconds": float(durations_ms.sum() / 1000),
+                "mean_ms": float(durations_ms.mean()),
+                "p50_ms": float(np.percentile(durations_ms, 50)),
+                "p90_ms": float(np.percentile(durations_ms, 90)),
+                "max_ms": float(durations_ms.max()),
+                "histogram": {
+                    label: int(count) for label, count in zip(labels, counts) if count
+                },
+            }
+        self._durations.clear()
+        return summary
@@ -84,8 +84,17 @@ def get_fsdp_config(args, model: PreTrainedModel):
         backward_prefetch=prefetch_policy,
         sharding_strategy=ShardingStrategy[args.fsdp_sharding_strategy],
         cpu_offload=CPUOffload(args.cpu_offload_params_fsdp),
+        # the ranks that built the model on the meta device get rank 0's weights
+        sync_module_states=args.fsdp_cpu_ram_efficient_loading,
+        cpu_ram_efficient_loading=args.fsdp_cpu_ram_efficient_loading,
     )
 
+    # full state checkpoints are written by every rank in parallel through
+    # torch.distributed.checkpoint instead of being gathered on rank 0
+    if args.fsdp_sharded_checkpoint:
+        # also switches the state dict configs to their sharded counterparts
+        fsdp_plugin.set_state_dict_type("SHARDED_STATE_DICT")
+
     # `use_orig_params` must be disabled when using LoRA and FSDP together
     # Source: https://huggingface.co/docs/peft/en/accelerate/fsdp#the-important-parts
     if args.lora_r > 0:
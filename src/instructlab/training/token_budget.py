@@ -0,0 +1,113 @@
+# SPDX-License-Identifier: Apache-2.0
+
+# Standard
+from typing import Optional
+import math
+
+# Third Party
+import torch
+import torch.distributed as dist
+
+
+class TokenBudget:
+    """
+    Sizes the optimizer steps by loss-counted tokens instead of by a fixed number of
+    micro-batches: a step ends at the first micro-batch with which the tokens of all
+    ranks reach `target_tokens`, or at the last micro-batch of the epoch.
+
+    The token counts are summed across ranks on the host, over a gloo group, once per
+    micro-batch. Every rank takes the same decision and none of them waits for the GPU
+    to do so. The same reduction carries the OOM vote of the forward pass, so a step
+    issues a single host collective before its backward pass.
+
+    As the size of a step is only known once it ends, the losses are scaled for a step
+    of exactly `target_tokens` tokens and `finish_step` corrects the gradients.
+    """
+
+    def __init__(
+        self,
+        target_tokens: int,
+        tokens_seen: int = 0,
+        group: Optional[dist.ProcessGroup] = None,
+    ):
+        if target_tokens < 1:
+            raise ValueError(f"target_tokens must be positive, got {target_tokens}")
+        self.target_tokens = target_tokens
+        self.tokens_seen = tokens_seen
+        self.step_tokens = 0
+        self.step_micro_batches = 0
+        self.num_steps = 0
+        self.num_micro_batches = 0
+        if group is None and dist.is_initialized():
+            group = dist.new_group(backend="gloo")
+        self.group = group
+
+    def add(self, num_loss_counted_tokens: int, failed: bool = False) -> int:
+        """
+        Adds a micro-batch to the current step. `failed` is summed across ranks in the
+        same reduction as the tokens, so an OOM vote needs no collective of its own.
+        Returns the number of ranks that passed `failed`.
+        """
+        counts = torch.tensor([num_loss_counted_tokens, failed], dtype=torch.int64)
+        if self.group is not None:
+            dist.all_reduce(counts, group=self.group)
+        tokens, num_failed = counts.tolist()
+        self.step_tokens += tokens
+        self.step_micro_batches += 1
+        return num_failed
+
+    def is_step_boundary(self, last_micro_batch: bool = False) -> bool:
+        return last_micro_batch or self.step_tokens >= self.target_tokens
+
+    def finish_step(self, model: torch.nn.Module) -> int:
+        """
+        Rescales the accumulated gradients from `target_tokens` to the tokens this step
+        actually had and starts the next step. Returns the tokens of the finished step.
+        """
+        step_tokens = self.step_tokens
+        grads = [p.grad for p in model.parameters() if p.grad is not None]
+        if grads and step_tokens and step_tokens != self.target_tokens:
+            torch._foreach_mul_(grads, self.target_tokens / step_tokens)
+        self.tokens_seen += step_tokens
+        self.num_micro_batches += self.step_micro_batches
+        self.num_steps += 1
+        self.step_tokens = 0
+        self.step_micro_batches = 0
+        return step_tokens
+
+    def drop_step(self):
+        """Forgets the micro-batches of the current step, which will be retried."""
+        self.step_tokens = 0
+        self.step_micro_batches = 0
+
+    @property
+    def lr_steps(self) -> int:
+        """Tokens seen, in units of `target_tokens`, which the LR schedule counts in."""
+        return self.tokens_seen // self.target_tokens
+
+    def flush(self) -> dict:
+        """Returns the average step size since the previous call."""
+        metrics = {
+            "tokens_seen": self.tokens_seen,
+            "micro_batches_per_step": (
+                self.num_micro_batches / self.num_steps if self.num_steps else None
+            ),
+        }
+        self.num_steps = 0
+        self.num_micro_batches = 0
+        return metrics
+
+
+def num_token_budget_steps(total_tokens: int, target_tokens: int) -> int:
+    """Number of steps of `target_tokens` tokens in `total_tokens`, for the LR schedule."""
+    return max(math.ceil(total_tokens / target_tokens), 1)
+
+
+def advance_lr_scheduler(lr_scheduler, num_steps: int, max_steps: int):
+    """
+    Steps `lr_scheduler` until it has taken `num_steps` steps in total, capped at
+    `max_steps` so the schedule stays at its final value past the planned end.
+    """
+    scheduler = getattr(lr_scheduler, "scheduler", lr_scheduler)
+    while scheduler.last_epoch < min(num_steps, max_steps):
+        lr_scheduler.step()
@@ -45,6 +45,17 @@ class TokenDataset(Dataset):
     def get_lengths(self):
         return self.lengths
 
+    def get_num_loss_counted_tokens(self):
+        # counted over the flattened arrow labels column, without a pass over the
+        # rows in Python
+        labels = self.data.data.column("labels")
+        return int(
+            sum(
+                np.count_nonzero(chunk.flatten().to_numpy(zero_copy_only=False) != -100)
+                for chunk in labels.chunks
+            )
+        )
+
 
 class MockDataset(Dataset):
     def __init__(self, data_path, max_seq_len=4600):
@@ -72,6 +83,9 @@ class MockDataset(Dataset):
     def get_lengths(self):
         return np.array([len(self.input_ids[0])] * len(self.input_ids))
 
+    def get_num_loss_counted_tokens(self):
+        return int(self.get_lengths().sum())
+
 
 def setup_dataset(
     data_path: str,
@@ -97,12 +111,17 @@ def setup_dataloader(
     samples_per_gpu=None,
     sampler="multipack",
     seed=47,
+    balance_cost=False,
+    attn_cost_coeff=0.0,
+    carry_over_tail=False,
+    length_buckets=None,
 ) -> DataLoader:
     collate_fn = make_collate_fn(
         pad_token_id,
         use_dolomite=use_dolomite,
         flash_enabled=flash_enabled,
         max_batch_len=max_batch_len,
+        length_buckets=length_buckets,
     )
     rank = int(os.environ["RANK"])
     world_size = int(os.environ["WORLD_SIZE"])
@@ -116,6 +135,9 @@ def setup_dataloader(
             rank=rank,
             seed=seed,
             padding=not flash_enabled,
+            balance_cost=balance_cost,
+            attn_cost_coeff=attn_cost_coeff,
+            carry_over_tail=carry_over_tail,
         )
         sampler = {"batch_sampler": sampler}
     elif sampler == "distributed":
@@ -137,6 +159,8 @@ def setup_dataloader(
         **sampler,
         num_workers=num_workers,
         collate_fn=collate_fn,
+        # pinned batches can be copied to the GPU without blocking the host
+        pin_memory=torch.cuda.is_available(),
     )
 
     return dataloader
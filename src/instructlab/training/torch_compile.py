@@ -0,0 +1,95 @@
+# SPDX-License-Identifier: Apache-2.0
+
+# Standard
+from bisect import bisect_left
+from typing import List, Optional
+import math
+
+# Third Party
+from torch._dynamo.utils import counters
+import torch
+
+
+def make_length_buckets(
+    max_length: int, num_buckets: int = 8, multiple: int = 128
+) -> List[int]:
+    """
+    Returns `num_buckets` sequence lengths, spaced geometrically up to `max_length` and
+    rounded up to a `multiple`. Padding batches to these lengths bounds the number of
+    shapes the compiled model sees, and so the number of compilations.
+    """
+    max_length = math.ceil(max_length / multiple) * multiple
+    buckets = {
+        math.ceil(max_length / 2 ** (num_buckets - 1 - i) / multiple) * multiple
+        for i in range(num_buckets)
+    }
+    return sorted(buckets)
+
+
+def bucket_length(length: int, buckets: Optional[List[int]]) -> int:
+    """Returns the smallest bucket that fits `length`, or `length` if none does."""
+    if not buckets:
+        return length
+    index = bisect_left(buckets, length)
+    return buckets[index] if index < len(buckets) else length
+
+
+class CompileStats:
+    """
+    Reports how often the compiled decoder blocks were compiled and how often a call
+    reused an already compiled graph, from the counters dynamo keeps for the whole
+    process. `flush` returns the counts since its previous call.
+
+    Block calls are counted from the forward passes of the (uncompiled) decoder, as a
+    hook on the compiled blocks themselves would be traced into their graphs.
+    """
+
+    def __init__(self, num_blocks: int = 0):
+        self.num_blocks = num_blocks
+        self.num_calls = 0
+        self._last = self._totals()
+
+    def _record_forward(self, module, args):
+        self.num_calls += self.num_blocks
+
+    def _totals(self) -> dict:
+        return {
+            "calls": self.num_calls,
+            "compiles": counters["frames"]["total"],
+            "graph_breaks": sum(counters["graph_break"].values()),
+        }
+
+    def flush(self) -> dict:
+        totals = self._totals()
+        delta = {key: totals[key] - self._last[key] for key in totals}
+        self._last = totals
+        return {
+            "compiles": delta["compiles"],
+            "compile_cache_hits": max(delta["calls"] - delta["compiles"], 0),
+            "graph_breaks": delta["graph_breaks"],
+            "total_compiles": totals["compiles"],
+        }
+
+
+def compile_decoder_blocks(
+    model: torch.nn.Module, block_name: str, num_buckets: int = 8
+) -> CompileStats:
+    """
+    Compiles every decoder block of `model` in place. The blocks keep their class and
+    parameter names, so this can run before FSDP wraps them by class. Shapes are
+    expected to come from the length buckets, so graphs are specialized to static
+    shapes and dynamo keeps one per bucket.
+    """
+    # every bucket (and the recomputation of checkpointed blocks) may need its own graph
+    torch._dynamo.config.cache_size_limit = max(
+        torch._dynamo.config.cache_size_limit, 2 * num_buckets
+    )
+    blocks = [
+        module for module in model.modules() if module.__class__.__name__ == block_name
+    ]
+    for block in blocks:
+        block.compile(dynamic=False)
+
+    stats = CompileStats(num_blocks=len(blocks))
+    model.register_forward_pre_hook(stats._record_forward)
+    return stats
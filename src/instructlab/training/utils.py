@@ -8,13 +8,18 @@ from copy import deepcopy
 from functools import partial
 from pathlib import Path
 from tempfile import TemporaryDirectory
-from typing import Any, List, Optional, Tuple
+from typing import Any, List, Optional, Set, Tuple
+import hashlib
 import importlib
+import importlib.metadata
 import inspect
+import json
 import logging
 import os
 import random
+import re
 import shutil
+import socket
 import subprocess
 import sys
 import time
@@ -41,9 +46,11 @@ from torch.distributed.fsdp import FullStateDictConfig
 from torch.distributed.fsdp import FullyShardedDataParallel as FSDP
 from torch.distributed.fsdp import StateDictType
 from transformers import AutoModelForCausalLM, PreTrainedModel, PreTrainedTokenizer
+from transformers.modeling_outputs import CausalLMOutputWithPast
 import numpy as np
 import torch
 import torch.nn.functional as F
+import torch.utils.checkpoint
 
 # First Party
 from instructlab.training.config import (
@@ -51,6 +58,7 @@ from instructlab.training.config import (
     QuantizeDataType,
     TrainingArgs,
 )
+from instructlab.training.torch_compile import bucket_length
 
 
 def check_valid_train_args(train_args: TrainingArgs):
@@ -113,33 +121,67 @@ def retrieve_chat_template(chat_tmpl_path):
     return CHAT_TEMPLATE, SPECIAL_TOKENS
 
 
+def sequence_lengths_per_token(
+    num_tokens: int,
+    position_ids: Optional[torch.Tensor] = None,
+    cu_seqlens: Optional[torch.Tensor] = None,
+    attention_mask: Optional[torch.Tensor] = None,
+) -> Optional[torch.Tensor]:
+    """
+    Returns the length of the sample every token belongs to, flattened over the batch,
+    or None when the batch carries no sample boundaries. Packed samples are delimited
+    by `cu_seqlens` or by their position ids restarting at 0, padded ones by their
+    attention mask. Everything stays on the device, nothing here syncs with the host.
+    """
+    if cu_seqlens is not None:
+        lengths = cu_seqlens[1:] - cu_seqlens[:-1]
+        return torch.repeat_interleave(lengths, lengths, output_size=num_tokens)
+    if attention_mask is not None:
+        lengths = attention_mask.sum(dim=-1, keepdim=True)
+        return lengths.expand_as(attention_mask).reshape(-1)
+    if position_ids is not None:
+        sample_ids = torch.cumsum(position_ids.reshape(-1) == 0, dim=0) - 1
+        # no sample is empty, so there are at most as many samples as tokens
+        lengths = torch.zeros_like(sample_ids).scatter_add_(
+            0, sample_ids, torch.ones_like(sample_ids)
+        )
+        return lengths[sample_ids]
+    return None
+
+
 def add_noisy_embeddings(model, noise_alpha=None):
+    """
+    NEFTune: while training, adds uniform noise of magnitude `noise_alpha / sqrt(L * d)`
+    to the input embeddings, where d is the embedding dimension and L the length of the
+    sample each token belongs to, so samples packed together are noised as if they
+    were alone in the batch.
+    """
     if not noise_alpha:
         return model
 
-    def noised_embed(orig_embed, noise_alpha):
-        def new_func(x):
-            if model.training:
-                embed_init = orig_embed(x)
-                dims = torch.tensor(torch.numel(x))
-                mag_norm = noise_alpha / torch.sqrt(dims)
-                return embed_init + torch.zeros_like(embed_init).uniform_(
-                    -mag_norm, mag_norm
-                )
-            else:
-                return orig_embed(x)
-
-        return new_func
+    # the decoder receives the sample boundaries the embedding layer does not see
+    batch_info = {}
+
+    def capture_batch_info(module, args, kwargs):
+        for key in ("position_ids", "cu_seqlens", "attention_mask"):
+            batch_info[key] = kwargs.get(key)
+
+    def add_noise(module, args, embeddings):
+        if not module.training:
+            return embeddings
+        num_tokens = embeddings.numel() // embeddings.size(-1)
+        lengths = sequence_lengths_per_token(num_tokens, **batch_info)
+        if lengths is None:
+            lengths = torch.full(
+                (num_tokens,), embeddings.size(-2), device=embeddings.device
+            )
+        scale = noise_alpha * torch.rsqrt(lengths.float() * embeddings.size(-1))
+        noise = torch.empty_like(embeddings).uniform_(-1, 1)
+        noise.mul_(scale.to(noise.dtype).view(*embeddings.shape[:-1], 1))
+        return embeddings.add_(noise)
 
-    model_class_name = model.__class__.__name__
-    if model_class_name in ["GPTMegatronForCausalLM", "GPTDolomiteForCausalLM"]:
-        orig_forward = model.get_input_embeddings().forward
-        model.get_input_embeddings().forward = noised_embed(orig_forward, noise_alpha)
-    elif model_class_name in ["MistralForCausalLM", "LlamaForCausalLM"]:
-        orig_forward = model.base_model.embed_tokens.forward
-        model.base_model.embed_tokens.forward = noised_embed(orig_forward, noise_alpha)
-    else:
-        raise ValueError(f"Unsupported model class: {model_class_name}")
+    model.base_model.register_forward_pre_hook(capture_batch_info, with_kwargs=True)
+    model.get_input_embeddings().register_forward_hook(add_noise)
     return model
 
 
@@ -199,8 +241,17 @@ def check_flash_attn_enabled(disable_flash_attn: bool, use_dolomite: bool) -> bo
 
 
 def make_collate_fn(
-    pad_token_id, use_dolomite=False, flash_enabled=True, max_batch_len=60000
+    pad_token_id,
+    use_dolomite=False,
+    flash_enabled=True,
+    max_batch_len=60000,
+    length_buckets=None,
 ):
+    """
+    With `length_buckets`, batches are padded up to the next bucket length so that a
+    compiled model only sees that many shapes. Padding is labeled -100, so it never
+    counts towards the loss, and is not counted in `total_length`.
+    """
     rank = int(os.environ["RANK"])
     if use_dolomite:
 
@@ -230,6 +281,8 @@ def make_collate_fn(
                 "labels": labels,
                 "num_loss_counted_tokens": num_loss_counted_tokens,
                 "num_samples": len(batch),
+                "total_length": int(total_len),
+                "sum_squared_lengths": int((lens[:valid_up_to] ** 2).sum()),
             }
 
     else:
@@ -240,6 +293,7 @@ def make_collate_fn(
                 labels = []
                 position_ids = []
                 total_len = 0
+                sum_squared_lengths = 0
                 num_loss_counted_tokens = 0
 
                 for num_samples, item in enumerate(batch):
@@ -252,6 +306,7 @@ def make_collate_fn(
                     position_ids.extend(range(item_len))
 
                     total_len += item_len
+                    sum_squared_lengths += item_len**2
                     num_loss_counted_tokens += (item["labels"] != -100).sum().item()
 
                 print(
@@ -260,19 +315,28 @@ def make_collate_fn(
                     f"num_loss_counted_tokens: {num_loss_counted_tokens}\033[0m"
                 )
 
+                # the padding is packed as a sample of its own, so no real sample
+                # attends to it
+                pad_len = bucket_length(total_len, length_buckets) - total_len
+                input_ids.extend([pad_token_id] * pad_len)
+                labels.extend([-100] * pad_len)
+                position_ids.extend(range(pad_len))
+
                 return {
                     "input_ids": torch.tensor([input_ids], dtype=torch.long),
                     "labels": torch.tensor([labels], dtype=torch.long),
                     "position_ids": torch.tensor([position_ids], dtype=torch.long),
                     "num_loss_counted_tokens": num_loss_counted_tokens,
                     "num_samples": num_samples + 1,  # pylint: disable=W0631
+                    "total_length": total_len,
+                    "sum_squared_lengths": sum_squared_lengths,
                 }
 
         else:
 
             def pad_collate_fn(batch):
                 lens = np.array([len(item["input_ids"]) for item in batch])
-                max_len = max(lens)
+                max_len = bucket_length(max(lens), length_buckets)
 
                 input_ids = torch.stack(
                     [
@@ -321,14 +385,72 @@ def make_collate_fn(
                     "num_loss_counted_tokens": num_loss_counted_tokens,
                     "attention_mask": attention_mask,
                     "num_samples": len(batch),
+                    "total_length": int(lens.sum()),
+                    "sum_squared_lengths": int((lens**2).sum()),
                 }
 
     return pad_collate_fn
 
 
-def convert_loss_to_reduce_sum(model, use_dolomite=False):
+def shift_labels_for_loss(
+    labels: torch.Tensor, cu_seqlens: Optional[torch.Tensor] = None
+) -> torch.Tensor:
+    """
+    Shifts `labels` so that position i is scored against token i + 1. The labels are
+    padded with -100 instead of slicing the logits, so the logits are never copied.
+    """
+    shift_labels = F.pad(labels[..., 1:], (0, 1), value=-100)
+    if cu_seqlens is not None:
+        # this is needed so that the last token of current example doesn't predict first token of next example
+        shift_labels[cu_seqlens[1:-1] - 1] = -100
+    return shift_labels
+
+
+def _cross_entropy_sum(inputs, labels, projection):
+    logits = inputs if projection is None else projection(inputs)
+    return F.cross_entropy(logits.float(), labels, reduction="sum")
+
+
+def sum_cross_entropy(
+    inputs: torch.Tensor,
+    shift_labels: torch.Tensor,
+    projection=None,
+    chunk_size: int = 0,
+) -> torch.Tensor:
+    """
+    Summed cross-entropy of the logits `projection(inputs)` (or `inputs` themselves)
+    against already shifted labels.
+
+    With `chunk_size`, tokens are processed `chunk_size` at a time and every chunk's
+    logits are recomputed in the backward pass instead of being kept, so only one
+    chunk of (float32) logits is materialized at any time. Without it, logits in a
+    lower precision are upcast to a full float32 copy for the loss.
+    """
+    inputs = inputs.reshape(-1, inputs.size(-1))
+    shift_labels = shift_labels.reshape(-1).to(inputs.device)
+    if not chunk_size:
+        return _cross_entropy_sum(inputs, shift_labels, projection)
+
+    loss = inputs.new_zeros((), dtype=torch.float32)
+    for start in range(0, inputs.size(0), chunk_size):
+        loss = loss + torch.utils.checkpoint.checkpoint(
+            _cross_entropy_sum,
+            inputs[start : start + chunk_size],
+            shift_labels[start : start + chunk_size],
+            projection,
+            use_reentrant=False,
+        )
+    return loss
+
+
+def convert_loss_to_reduce_sum(model, use_dolomite=False, loss_chunk_size=0):
     """
     this is necessary because multipack changes the samples per gpu, which biases the gradients to be larger for batches with less samples but longer lengths.
+
+    With `loss_chunk_size`, the LM head (for HF models) and the cross-entropy are
+    computed that many tokens at a time, so the full-vocabulary logits are never
+    materialized at once. Dolomite models hand the loss their full logits, for them
+    only the float32 upcast and the cross-entropy are chunked.
     """
     if use_dolomite:
 
@@ -340,21 +462,12 @@ def convert_loss_to_reduce_sum(model, use_dolomite=False):
             loss = None
             # Shift so that tokens < n predict n
             if labels is not None:
-                if model._use_padding_free_transformer:
-                    shift_logits = lm_logits[:-1, :]
-                    shift_labels = labels[1:].to(shift_logits.device)
-
-                    # this is needed so that the last token of current example doesn't predict first token of next example
-                    drop_loss_positions = cu_seqlens[1:-1] - 1
-                    shift_labels[drop_loss_positions] = -100
-                else:
-                    shift_logits = lm_logits[..., :-1, :].contiguous()
-                    shift_labels = labels[..., 1:].contiguous().to(shift_logits.device)
-
-                # Flatten the tokens
-                loss_fct = torch.nn.CrossEntropyLoss(reduction="sum")
-                loss = loss_fct(
-                    shift_logits.view(-1, shift_logits.size(-1)), shift_labels.view(-1)
+                shift_labels = shift_labels_for_loss(
+                    labels,
+                    cu_seqlens if model._use_padding_free_transformer else None,
+                )
+                loss = sum_cross_entropy(
+                    lm_logits, shift_labels, chunk_size=loss_chunk_size
                 )
 
             return loss
@@ -365,6 +478,14 @@ def convert_loss_to_reduce_sum(model, use_dolomite=False):
         return model
     else:
 
+        def project_logits(hidden_states):
+            logits = model.lm_head(hidden_states)
+            # granite scales down its logits
+            logits_scaling = getattr(model.config, "logits_scaling", None)
+            if logits_scaling:
+                logits = logits / logits_scaling
+            return logits
+
         def reduce_sum_forward(
             input_ids: torch.LongTensor = None,
             attention_mask: Optional[torch.Tensor] = None,
@@ -378,13 +499,40 @@ def convert_loss_to_reduce_sum(model, use_dolomite=False):
             return_dict: Optional[bool] = None,
             **deprecated_arguments,
         ):
+            if loss_chunk_size and labels is not None:
+                # run the decoder without the LM head, which is applied per chunk
+                output = model.model(
+                    input_ids=input_ids,
+                    attention_mask=attention_mask,
+                    position_ids=position_ids,
+                    past_key_values=past_key_values,
+                    inputs_embeds=inputs_embeds,
+                    use_cache=use_cache,
+                    output_attentions=output_attentions,
+                    output_hidden_states=output_hidden_states,
+                    return_dict=True,
+                )
+                loss = sum_cross_entropy(
+                    output.last_hidden_state,
+                    shift_labels_for_loss(labels),
+                    projection=project_logits,
+                    chunk_size=loss_chunk_size,
+                )
+                return CausalLMOutputWithPast(
+                    loss=loss,
+                    past_key_values=output.past_key_values,
+                    hidden_states=output.hidden_states,
+                    attentions=output.attentions,
+                )
+
+            # the labels are not passed on, the loss is computed below
             output = model.__original_forward__(
                 input_ids,
                 attention_mask,
                 position_ids,
                 past_key_values,
                 inputs_embeds,
-                labels,
+                None,
                 use_cache,
                 output_attentions,
                 output_hidden_states,
@@ -396,15 +544,7 @@ def convert_loss_to_reduce_sum(model, use_dolomite=False):
             loss = None
             if labels is not None:
                 # Shift so that tokens < n predict n
-                shift_logits = logits[..., :-1, :].contiguous()
-                shift_labels = labels[..., 1:].contiguous()
-                # Flatten the tokens
-                shift_logits = shift_logits.view(-1, model.config.vocab_size)
-                shift_labels = shift_labels.view(-1)
-                # Ensure tensors are on the same device
-                shift_labels = shift_labels.to(shift_logits.device)
-                loss_fct = torch.nn.CrossEntropyLoss(reduction="sum")
-                loss = loss_fct(shift_logits, shift_labels)
+                loss = sum_cross_entropy(logits, shift_labels_for_loss(labels))
 
             if not return_dict:
                 return ((loss,) + output) if loss is not None else output
@@ -502,6 +642,8 @@ def save_fsdp_lora_model(
 
     This function creates a full copy of the model being trained and stores it in CPU memory.
     If encountering OOM errors on CPU, this is likely a culprit.
+    It is only used when `save_lora_model_streaming` cannot merge into the base model's
+    safetensors files directly.
 
     Args:
         args (Namespace): Args received by the ArgumentParser.
@@ -554,6 +696,76 @@ def save_fsdp_lora_model(
     dist.barrier()
 
 
+def get_lora_merge_base_files(args: Namespace, model) -> Optional[List[Path]]:
+    """
+    Returns the safetensors files of the base model when the trained LoRA adapters can
+    be merged into them while streaming them to disk, or None when the merge has to be
+    done on an in-memory copy of the model.
+    """
+    # dolomite weights are named differently from the HF checkpoint on disk
+    if args.use_dolomite:
+        return None
+
+    base_dir = Path(args.model_name_or_path)
+    index_file = base_dir / "model.safetensors.index.json"
+    if index_file.exists():
+        with open(index_file) as f:
+            weight_map = json.load(f)["weight_map"]
+        base_files = sorted({base_dir / name for name in weight_map.values()})
+    elif (base_dir / "model.safetensors").exists():
+        base_files = [base_dir / "model.safetensors"]
+    else:
+        return None
+
+    # resized embeddings only exist in memory
+    with open(base_dir / "config.json") as f:
+        if json.load(f)["vocab_size"] != model.config.vocab_size:
+            return None
+    return base_files
+
+
+def save_lora_model_streaming(
+    args: Namespace,
+    model,
+    tokenizer: PreTrainedTokenizer,
+    accelerator: Accelerator,
+    output_dir: Path,
+    base_files: List[Path],
+):
+    """Saves the base model with the trained LoRA adapters merged into it, reading and
+    writing the weights one shard at a time instead of merging a full copy of the model.
+
+    Args:
+        args (Namespace): Args received by the ArgumentParser.
+        model: LoRA model as prepared by `accelerate.Accelerator`
+        accelerator (Accelerator): The given accelerator object.
+        base_files (List[Path]): Safetensors files of the base model, from
+            `get_lora_merge_base_files`.
+    """
+    # First Party
+    from instructlab.training.checkpointing import (
+        gather_lora_state_dict,
+        stream_merge_lora,
+    )
+
+    lora_state = gather_lora_state_dict(model, accelerator.is_main_process)
+    if not accelerator.is_main_process:
+        return
+
+    output_dir.mkdir(parents=True, exist_ok=True)
+    if args.model_type not in ("gpt_megatron", "gpt_dolomite"):
+        add_missing_architectures(args, model.config)
+    model.config.to_json_file(output_dir / "config.json")
+    tokenizer.save_pretrained(output_dir)
+    stream_merge_lora(
+        base_files,
+        lora_state,
+        output_dir,
+        scaling=args.lora_alpha / args.lora_r,
+        dtype=args.base_model_args["torch_dtype"],
+    )
+
+
 def prepare_peft_model(
     model: PreTrainedModel,
     peft_config,
@@ -749,52 +961,135 @@ def prepare_universal_checkpoint_from_latest(output_dir):
     log_rank_0(f"Preparing universal checkpoint took {time.time() - start} seconds")
 
 
+DOLOMITE_CONVERSION_META = "conversion_meta.json"
+
+
+def default_dolomite_cache_dir() -> str:
+    cache_home = os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
+    return os.path.join(cache_home, "instructlab", "dolomite")
+
+
+def fingerprint_checkpoint(model_name_or_path: str, sample_bytes=1 << 20) -> str:
+    """
+    Hashes a checkpoint directory together with the installed dolomite version. Weight
+    files are represented by their size and their first and last `sample_bytes`, so
+    two fine-tunes of the same model differ while copies of one checkpoint on different
+    nodes or paths hash the same, without reading the whole checkpoint.
+    """
+    digest = hashlib.sha256()
+    digest.update(importlib.metadata.version("instructlab-dolomite").encode())
+    for path in sorted(Path(model_name_or_path).iterdir()):
+        if not path.is_file() or path.name.startswith("."):
+            continue
+        size = path.stat().st_size
+        digest.update(f"{path.name}:{size}".encode())
+        with open(path, "rb") as f:
+            digest.update(f.read(sample_bytes))
+            if size > 2 * sample_bytes:
+                f.seek(-sample_bytes, os.SEEK_END)
+                digest.update(f.read(sample_bytes))
+    return digest.hexdigest()
+
+
+def read_dolomite_conversion_meta(path: str) -> Optional[dict]:
+    try:
+        with open(Path(path) / DOLOMITE_CONVERSION_META) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def convert_to_dolomite_cached(model_name_or_path: str, cache_dir: str) -> Path:
+    """
+    Returns the dolomite conversion of `model_name_or_path` from `cache_dir`, converting
+    it first when it is not cached yet. Conversions are written to a staging directory
+    and renamed into place, so concurrent converters (e.g. one per node on a shared
+    cache) never see a partial conversion and the first one to finish is kept.
+    """
+    fingerprint = fingerprint_checkpoint(model_name_or_path)
+    cached_dir = Path(cache_dir) / fingerprint
+    if read_dolomite_conversion_meta(cached_dir) is not None:
+        log_rank_0(
+            f"\033[93mUsing the cached dolomite conversion of {model_name_or_path} in {cached_dir}\033[0m",
+            to_print=True,
+        )
+        return cached_dir
+
+    log_rank_0(
+        f"\033[93mModel saved in {model_name_or_path} requires conversion \033[0m",
+        to_print=True,
+    )
+    start = time.time()
+    staging_dir = (
+        Path(cache_dir) / f".{fingerprint}.{socket.gethostname()}.{os.getpid()}"
+    )
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    # for now just assume its a llama
+    import_from_huggingface(model_name_or_path, staging_dir)
+
+    with open(Path(model_name_or_path) / "config.json") as f:
+        source_config = json.load(f)
+    meta = {
+        "source": str(model_name_or_path),
+        "fingerprint": fingerprint,
+        "dolomite_version": importlib.metadata.version("instructlab-dolomite"),
+        "source_model_type": source_config.get("model_type"),
+        "source_architectures": source_config.get("architectures"),
+        "conversion_time": time.time() - start,
+    }
+    with open(staging_dir / DOLOMITE_CONVERSION_META, "w") as f:
+        json.dump(meta, f, indent=2)
+
+    try:
+        staging_dir.rename(cached_dir)
+    except OSError:
+        # another process published the same conversion first
+        if read_dolomite_conversion_meta(cached_dir) is None:
+            raise
+        shutil.rmtree(staging_dir, ignore_errors=True)
+    return cached_dir
+
+
 @contextmanager
 def ensure_loadable_dolomite_checkpoint(
     model_name_or_path: str,
-    tmpdir: str,
+    cache_dir: Optional[str] = None,
 ):
+    """
+    Yields a path dolomite can load `model_name_or_path` from. HF checkpoints are
+    converted once by local rank 0 and kept in `cache_dir`, so restarts, resumed runs
+    and other runs on the same checkpoint reuse the conversion.
+    """
     local_rank = int(os.environ["LOCAL_RANK"])
-    group_rank = int(os.environ["GROUP_RANK"])
 
     try:
         GPTDolomiteConfig.from_pretrained(model_name_or_path)
-        yield model_name_or_path
+        is_dolomite = True
     except:  # pylint: disable=bare-except
-        log_rank_0(
-            f"\033[93mModel saved in {model_name_or_path} requires conversion \033[0m",
-            to_print=True,
-        )
         # if the load failed then it must not be a granite
-        # for now just assume its a llama
-        # make a temp directory name, but do not create it
-        # previously we used mktemp, but it caused problems in multi node settings
-        # so now we use a provided tmpdir
-        # Assumption: tmpdir should be accessible by all ranks, even those
-        # in different nodes
-        tmpdir = Path(tmpdir) / f"tmp.{group_rank}"
-        if os.path.exists(tmpdir) and (not dist.is_initialized() or local_rank == 0):
-            # need to delete if it exists because import doesn't like it to
-            shutil.rmtree(tmpdir, ignore_errors=True)
+        is_dolomite = False
 
-        if not dist.is_initialized() or local_rank == 0:
-            import_from_huggingface(model_name_or_path, tmpdir)
-
-        if dist.is_initialized():
-            # the first barrier is to wait for local rank 0 to finish converting the model
-            # and place into tmpdir
-            dist.barrier()
+    if is_dolomite:
+        yield model_name_or_path
+        return
 
-        # return tmpdir out for loading
-        yield tmpdir
+    # Assumption: when the cache is shared between nodes, it should be accessible by
+    # all ranks, otherwise every node converts into its own cache
+    cache_dir = cache_dir or default_dolomite_cache_dir()
+    os.makedirs(cache_dir, exist_ok=True)
+    cached_dir = None
+    if not dist.is_initialized() or local_rank == 0:
+        cached_dir = convert_to_dolomite_cached(model_name_or_path, cache_dir)
 
-        if dist.is_initialized():
-            # the second barrier is to wait for all the models to finish loading
-            dist.barrier()
+    if dist.is_initialized():
+        # waits for local rank 0 to finish converting the model, then every rank takes
+        # the path of its node's local rank 0 instead of fingerprinting the checkpoint
+        # again; torchrun numbers the ranks of a node contiguously
+        cached_dirs = [None] * dist.get_world_size()
+        dist.all_gather_object(cached_dirs, cached_dir)
+        cached_dir = cached_dirs[dist.get_rank() - local_rank]
 
-        if not dist.is_initialized() or local_rank == 0:
-            # at this point, we can be confident that the tmpdir is no longer needed
-            shutil.rmtree(tmpdir, ignore_errors=True)
+    yield cached_dir
 
 
 def get_module_class_from_name(
@@ -824,6 +1119,7 @@ def apply_gradient_checkpointing(
         block_name: str,
         checkpoint_every: int = 1,
         use_reentrant: bool = False,
+        blocks: Optional[Set[int]] = None,
     ) -> None:
         block_class = get_module_class_from_name(model, block_name)
         block_idx = 0
@@ -833,6 +1129,9 @@ def apply_gradient_checkpointing(
 
             if isinstance(submodule, block_class):
                 block_idx += 1
+                if blocks is not None:
+                    # explicit selection of block indices overrides `checkpoint_every`
+                    return (block_idx - 1) in blocks
                 if (block_idx - 1) % checkpoint_every == 0:
                     return True
             return False
@@ -917,6 +1216,31 @@ def save_dict_accelerate(
     accelerator.get_state_dict = old_get_state
 
 
+def add_missing_architectures(args, model_config):
+    if model_config.architectures:
+        return
+    arch_added = False
+    # the dolomite conversion records the architectures of the original checkpoint
+    conversion_meta = getattr(args, "dolomite_conversion_meta", None) or {}
+    if conversion_meta.get("source_architectures"):
+        model_config.architectures = conversion_meta["source_architectures"]
+        arch_added = True
+    elif args.model_type == "llama":
+        model_config.architectures = ["LlamaForCausalLM"]
+        arch_added = True
+    elif args.model_type == "granite":
+        model_config.architectures = ["GraniteForCausalLM"]
+        arch_added = True
+    if arch_added:
+        warnings.warn(
+            f"Adding architectures to ckpt: {model_config.architectures}",
+        )
+    else:
+        warnings.warn(
+            f"Converting from dolomite, but no architecture field added to config.json",
+        )
+
+
 def save_hf_format_accelerate(
     args,
     model,
@@ -924,6 +1248,8 @@ def save_hf_format_accelerate(
     accelerator: Accelerator,
     samples_seen,
     is_lora=False,
+    retention=None,
+    metric=None,
 ):
     log_rank_0(
         f"\033[93mSaving model in huggingface format at samples_seen: {samples_seen}\033[0m",
@@ -949,7 +1275,17 @@ def save_hf_format_accelerate(
     # XXX(osilkin): LoRA + FSDP requires a different saving path than the others
     #               so we set this variable and use it to avoid those paths further down.
     is_fsdp_lora = is_lora and accelerator.distributed_type == DistributedType.FSDP
-    if is_fsdp_lora:
+    lora_base_files = get_lora_merge_base_files(args, model) if is_lora else None
+    if lora_base_files is not None:
+        save_lora_model_streaming(
+            args=args,
+            model=model,
+            tokenizer=tokenizer,
+            accelerator=accelerator,
+            output_dir=output_dir,
+            base_files=lora_base_files,
+        )
+    elif is_fsdp_lora:
         save_fsdp_lora_model(
             args=args,
             model=model,
@@ -965,28 +1301,15 @@ def save_hf_format_accelerate(
 
     accelerator.get_state_dict = _get_state_dict_patched
 
-    if not is_fsdp_lora and accelerator.is_main_process:
+    is_merged_in_memory = lora_base_files is None and not is_fsdp_lora
+    if is_merged_in_memory and accelerator.is_main_process:
         if is_lora:
             model.module.merge_adapter()
             model_state = model.module.state_dict()
 
         output_dir.mkdir(parents=True, exist_ok=True)
-        if not model.module.config.architectures and convert_dolomite:
-            arch_added = False
-            if args.model_type == "llama":
-                model.module.config.architectures = ["LlamaForCausalLM"]
-                arch_added = True
-            elif args.model_type == "granite":
-                model.module.config.architectures = ["GraniteForCausalLM"]
-                arch_added = True
-            if arch_added:
-                warnings.warn(
-                    f"Adding architectures to ckpt: {model.module.config.architectures}",
-                )
-            else:
-                warnings.warn(
-                    f"Converting from dolomite, but no architecture field added to config.json",
-                )
+        if convert_dolomite:
+            add_missing_architectures(args, model.module.config)
         model.module.config.to_json_file(output_config_file)
         tokenizer.save_pretrained(output_dir)
 
@@ -1019,6 +1342,14 @@ def save_hf_format_accelerate(
         )
         tmpdir.cleanup()
 
+    if retention is not None and accelerator.is_main_process:
+        retention.register(
+            final_output_dir.parent,
+            final_output_dir.name,
+            metric=metric,
+            samples_seen=samples_seen,
+        )
+
     log_rank_0(f"\033[93mModel saved in {final_output_dir}\033[0m", to_print=True)
     log_rank_0(f"saving took {time.time() - start} seconds")
     dist.barrier()
@@ -1082,8 +1413,26 @@ def save_checkpoint(
     epoch: int = None,
     hf_format: bool = True,
     full_state: bool = False,
+    sampler_state: Optional[dict] = None,
+    async_saver=None,
+    retention=None,
+    metric: Optional[float] = None,
 ) -> None:
-    if hf_format:
+    """
+    `retention` rotates old checkpoints and keeps the manifest of each checkpoint
+    directory, `metric` (lower is better) is recorded for it to keep the best ones.
+    """
+    if hf_format and async_saver is not None and not is_lora:
+        # returns once the state is in host memory, the write happens in the background
+        async_saver.save(
+            args=args,
+            model=model,
+            tokenizer=tokenizer,
+            accelerator=accelerator,
+            samples_seen=samples_seen,
+            metric=metric,
+        )
+    elif hf_format:
         save_hf_format_accelerate(
             args=args,
             model=model,
@@ -1091,6 +1440,8 @@ def save_checkpoint(
             tokenizer=tokenizer,
             samples_seen=samples_seen,
             is_lora=is_lora,
+            retention=retention,
+            metric=metric,
         )
 
     if full_state:
@@ -1100,12 +1451,26 @@ def save_checkpoint(
             is_lora=is_lora,
             epoch=epoch,
             samples_seen=samples_seen,
+            sampler_state=sampler_state,
+            retention=retention,
+            metric=metric,
         )
 
 
-def save_full_state(args, accelerator, is_lora: bool, epoch: int, samples_seen: int):
+def save_full_state(
+    args,
+    accelerator,
+    is_lora: bool,
+    epoch: int,
+    samples_seen: int,
+    sampler_state: Optional[dict] = None,
+    retention=None,
+    metric: Optional[float] = None,
+):
     """
     Saves model, optimizer, and lr_scheduler state.
+    `sampler_state` is the position training should resume from, as the `epoch` and
+    the `start_batch` within it.
     TODO: save model config - decided not to do this.
     TODO: save tokenizer - decided not to do this.
     TODO: handle LoRA
@@ -1117,7 +1482,11 @@ def save_full_state(args, accelerator, is_lora: bool, epoch: int, samples_seen:
     # if args.is_granite:
     #     raise NotImplementedError("Can't save full state for Granite models yet.")
 
-    output_dir = Path(args.output_dir) / "full_state" / f"epoch_{epoch}"
+    if sampler_state is not None and sampler_state["start_batch"]:
+        # saved in the middle of an epoch
+        output_dir = Path(args.output_dir) / "full_state" / f"samples_{samples_seen}"
+    else:
+        output_dir = Path(args.output_dir) / "full_state" / f"epoch_{epoch}"
     log_rank_0(f"\033[93mSaving full model state in {output_dir}\033[0m", to_print=True)
 
     # patch FSDP state dict method so it works correctly.
@@ -1128,6 +1497,9 @@ def save_full_state(args, accelerator, is_lora: bool, epoch: int, samples_seen:
         get_state_dict_unpatched = accelerator.get_state_dict
         accelerator.get_state_dict = _get_state_dict_patched
 
+    # with --fsdp_sharded_checkpoint every rank writes its own shards of the model and
+    # optimizer through torch.distributed.checkpoint, `consolidate_checkpoint` turns
+    # them into a HF model offline
     accelerator.save_state(
         output_dir=output_dir,
         # max_shard_size="5GB",
@@ -1139,8 +1511,17 @@ def save_full_state(args, accelerator, is_lora: bool, epoch: int, samples_seen:
         # TODO: should we set the global_step here rather than calculating global_step
         #   based on samples_seen?
         metadata = {"current_epoch": epoch, "samples_seen": samples_seen}
+        if sampler_state is not None:
+            metadata["sampler_state"] = sampler_state
         torch.save(metadata, output_dir / "training_metadata.json")
         log_rank_0(f"\033[93mSaving training state: {metadata}\033[0m", to_print=True)
+        if retention is not None:
+            retention.register(
+                output_dir.parent,
+                output_dir.name,
+                metric=metric,
+                samples_seen=samples_seen,
+            )
 
     log_rank_0(f"\033[93mModel state saved in: {output_dir}\033[0m", to_print=True)
 
@@ -1154,26 +1535,34 @@ def load_latest_full_state(args, accelerator) -> None:
     Loads accelerator state from most recently saved checkpoint
     in `output_dir/full_state`.
     """
+    # First Party
+    from instructlab.training.checkpointing import read_manifest
+
     output_dir = Path(args.output_dir) / "full_state"
 
     if not output_dir.is_dir():
         return
 
-    # picks checkpoint with the largest number of samples by splitting the "samples_NNNN" string on _
-    # and comparing the number at the end of the string
-    checkpoint_list = sorted(
-        list(output_dir.iterdir()),
-        reverse=True,
-        key=lambda x: int(str(x).rsplit("_", maxsplit=1)[-1]),
-    )
-
-    if len(checkpoint_list) == 0:
-        log_rank_0(
-            f"\033[93mNo checkpoints to load from: {output_dir}\033[0m", to_print=True
+    manifest = read_manifest(output_dir)
+    if manifest is not None and (output_dir / manifest["latest"]).is_dir():
+        latest = output_dir / manifest["latest"]
+    else:
+        # picks checkpoint with the largest number of samples by splitting the "samples_NNNN" string on _
+        # and comparing the number at the end of the string
+        checkpoint_list = sorted(
+            [x for x in output_dir.iterdir() if re.fullmatch(r"\w+_\d+", x.name)],
+            reverse=True,
+            key=lambda x: int(str(x).rsplit("_", maxsplit=1)[-1]),
         )
-        return
 
-    latest = checkpoint_list[0]
+        if len(checkpoint_list) == 0:
+            log_rank_0(
+                f"\033[93mNo checkpoints to load from: {output_dir}\033[0m",
+                to_print=True,
+            )
+            return
+
+        latest = checkpoint_list[0]
 
     log_rank_0(f"\033[93mLoading state from: {latest}\033[0m", to_print=True)
     accelerator.load_state(latest)
@@ -1183,9 +1572,17 @@ def load_latest_full_state(args, accelerator) -> None:
         f"\033[93mTraining metadata loaded: {training_metadata}\033[0m", to_print=True
     )
 
-    # previous epoch is basis for current epoch.
-    args.__dict__["current_epoch"] = training_metadata["current_epoch"] + 1
     args.__dict__["samples_seen"] = training_metadata["samples_seen"]
+    sampler_state = training_metadata.get("sampler_state")
+    if sampler_state is None:
+        # previous epoch is basis for current epoch.
+        args.__dict__["current_epoch"] = training_metadata["current_epoch"] + 1
+        return
+
+    # steps are counted from the start of the resumed epoch, so skipping the first
+    # `start_batch` steps lands on the saved position
+    args.__dict__["current_epoch"] = sampler_state["epoch"]
+    args.__dict__["last_step"] = sampler_state["start_batch"]
 
 
 def get_projection_layer_names(model: PreTrainedModel) -> List[str]:
@@ -0,0 +1,111 @@
+# SPDX-License-Identifier: Apache-2.0
+
+# Standard
+from argparse import Namespace
+
+# Third Party
+import pytest
+
+# First Party
+from instructlab.training.activation_checkpointing import (
+    estimate_block_activation_bytes,
+    plan_activation_checkpointing,
+    select_blocks_to_checkpoint,
+)
+from instructlab.training.config import ActivationCheckpointingPolicy
+
+
+def test_estimate_block_activation_bytes():
+    assert estimate_block_activation_bytes(16, 64) == 2 * (10 * 16 + 4 * 64)
+    # the MLP defaults to four times the hidden size
+    assert estimate_block_activation_bytes(16) == estimate_block_activation_bytes(
+        16, 64
+    )
+    assert estimate_block_activation_bytes(16, 64, dtype_bytes=4) == 2 * (
+        estimate_block_activation_bytes(16, 64)
+    )
+
+
+def test_fixed_policies():
+    assert select_blocks_to_checkpoint(4, "full") == {0, 1, 2, 3}
+    assert select_blocks_to_checkpoint(4, ActivationCheckpointingPolicy.NONE) == set()
+    assert select_blocks_to_checkpoint(10, "every_n", every_n=3) == {0, 3, 6, 9}
+    assert select_blocks_to_checkpoint(3, "every_n", every_n=5) == {0}
+    with pytest.raises(ValueError, match="every_n"):
+        select_blocks_to_checkpoint(10, "every_n", every_n=0)
+
+
+@pytest.mark.parametrize(
+    "memory_budget_bytes, expected",
+    [
+        # every block checkpointed takes 10 * 10 bytes, each kept block 90 more
+        (100 + 3 * 90, set(range(7))),
+        (100 + 3 * 90 + 89, set(range(7))),
+        (100, set(range(10))),
+        # too small to even checkpoint everything: checkpoint everything anyway
+        (0, set(range(10))),
+        (10**9, set()),
+    ],
+)
+def test_memory_budget_keeps_the_last_blocks(memory_budget_bytes, expected):
+    assert (
+        select_blocks_to_checkpoint(
+            10,
+            "memory_budget",
+            memory_budget_bytes=memory_budget_bytes,
+            block_bytes=100,
+            checkpointed_block_bytes=10,
+        )
+        == expected
+    )
+
+
+def test_memory_budget_requires_a_budget():
+    with pytest.raises(ValueError, match="memory budget"):
+        select_blocks_to_checkpoint(10, "memory_budget", block_bytes=100)
+
+
+def make_args(**kwargs):
+    defaults = dict(
+        activation_checkpointing="memory_budget",
+        activation_checkpointing_every_n=1,
+        activation_memory_budget_gb=None,
+        packing_max_batch_len=None,
+        max_batch_len=1000,
+    )
+    defaults.update(kwargs)
+    return Namespace(**defaults)
+
+
+def test_plan_sizes_blocks_for_the_packed_micro_batch():
+    config = Namespace(hidden_size=1024, intermediate_size=4096)
+    tokens = 2048
+    block_bytes = tokens * estimate_block_activation_bytes(1024, 4096)
+    checkpointed_bytes = tokens * 1024 * 2
+    # room for 8 checkpointed blocks and 3 kept ones
+    budget = 8 * checkpointed_bytes + 3.5 * (block_bytes - checkpointed_bytes)
+    args = make_args(
+        activation_memory_budget_gb=budget / 1024**3, packing_max_batch_len=tokens
+    )
+    assert plan_activation_checkpointing(args, config, 8) == set(range(5))
+
+    # without a packing length the sampler's max_batch_len is used, which is
+    # half as long here, so the budget keeps more than twice as many blocks
+    args.packing_max_batch_len = None
+    args.max_batch_len = tokens // 2
+    assert plan_activation_checkpointing(args, config, 8) == {0}
+
+
+def test_plan_reads_gpt_style_config_names():
+    config = Namespace(n_embd=1024, n_inner=None)
+    tokens = 1000
+    block_bytes = tokens * estimate_block_activation_bytes(1024)
+    checkpointed_bytes = tokens * 1024 * 2
+    budget = 4 * checkpointed_bytes + 2.5 * (block_bytes - checkpointed_bytes)
+    args = make_args(activation_memory_budget_gb=budget / 1024**3)
+    assert plan_activation_checkpointing(args, config, 4) == {0, 1}
+
+    args = make_args(
+        activation_checkpointing="every_n", activation_checkpointing_every_n=2
+    )
+    assert plan_activation_checkpointing(args, config, 4) == {0, 2}
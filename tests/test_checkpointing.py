@@ -0,0 +1,81 @@
+# SPDX-License-Identifier: Apache-2.0
+
+# Standard
+from argparse import Namespace
+from concurrent.futures import ThreadPoolExecutor
+
+# Third Party
+import pytest
+
+pytest.importorskip("accelerate")
+pytest.importorskip("instructlab.dolomite")
+
+# First Party
+from instructlab.training.checkpointing import CheckpointRetention, read_manifest
+
+
+def test_retention_from_concurrent_threads(tmp_path):
+    retention = CheckpointRetention(keep_last=2)
+    names = [f"samples_{i}" for i in range(40)]
+    for name in names:
+        (tmp_path / name).mkdir()
+
+    # the async saver's worker and the training loop both register checkpoints
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        list(pool.map(lambda name: retention.register(tmp_path, name), names))
+    retention.wait()
+
+    manifest = read_manifest(tmp_path)
+    assert manifest["num_saved"] == len(names)
+    assert [entry["index"] for entry in manifest["entries"]] == [
+        len(names) - 1,
+        len(names),
+    ]
+    remaining = sorted(path.name for path in tmp_path.iterdir() if path.is_dir())
+    assert remaining == sorted(entry["name"] for entry in manifest["entries"])
+
+
+class FakeAccelerator:
+    is_main_process = True
+
+    def __init__(self):
+        self.loaded = None
+
+    def save_state(self, output_dir, **kwargs):
+        output_dir.mkdir(parents=True)
+
+    def load_state(self, input_dir):
+        self.loaded = input_dir
+
+
+@pytest.mark.parametrize(
+    "sampler_state,checkpoint",
+    [
+        ({"epoch": 2, "start_batch": 0}, "epoch_1"),
+        ({"epoch": 1, "start_batch": 7}, "samples_1234"),
+    ],
+)
+def test_full_state_resumes_at_the_saved_batch(tmp_path, sampler_state, checkpoint):
+    # First Party
+    from instructlab.training.utils import load_latest_full_state, save_full_state
+
+    args = Namespace(
+        output_dir=str(tmp_path), distributed_training_framework="deepspeed"
+    )
+    accelerator = FakeAccelerator()
+    save_full_state(
+        args,
+        accelerator,
+        is_lora=False,
+        epoch=1,
+        samples_seen=1234,
+        sampler_state=sampler_state,
+        retention=CheckpointRetention(),
+    )
+
+    resumed = Namespace(output_dir=str(tmp_path))
+    load_latest_full_state(resumed, accelerator)
+    assert accelerator.loaded == tmp_path / "full_state" / checkpoint
+    assert resumed.samples_seen == 1234
+    assert resumed.current_epoch == sampler_state["epoch"]
+    assert resumed.last_step == sampler_state["start_batch"]
@@ -0,0 +1,100 @@
+# SPDX-License-Identifier: Apache-2.0
+
+# Standard
+import json
+
+# Third Party
+from safetensors.torch import load_file
+import pytest
+import torch
+import torch.distributed.checkpoint as dcp
+
+pytest.importorskip("accelerate")
+pytest.importorskip("instructlab.dolomite")
+
+# First Party
+from instructlab.training.consolidate_checkpoint import (
+    FSDP_MODEL_DIR,
+    consolidate_checkpoint,
+)
+
+VOCAB_SIZE, HIDDEN_SIZE, LORA_R, LORA_ALPHA = 12, 8, 2, 4.0
+
+
+def save_sharded(checkpoint_dir, model_state):
+    # accelerate nests the model weights under "model"
+    dcp.save({"model": model_state}, checkpoint_id=checkpoint_dir, no_dist=True)
+
+
+@pytest.fixture
+def model_path(tmp_path):
+    path = tmp_path / "base"
+    path.mkdir()
+    with open(path / "config.json", "w") as f:
+        json.dump({"model_type": "llama", "vocab_size": VOCAB_SIZE - 2}, f)
+    with open(path / "tokenizer_config.json", "w") as f:
+        json.dump({}, f)
+    return path
+
+
+def test_consolidate_full_model(tmp_path, model_path):
+    embeddings = torch.randn(VOCAB_SIZE, HIDDEN_SIZE)
+    q_proj = torch.randn(HIDDEN_SIZE, HIDDEN_SIZE)
+    save_sharded(
+        tmp_path / "epoch_0" / FSDP_MODEL_DIR,
+        {
+            "_fsdp_wrapped_module.model.embed_tokens.weight": embeddings,
+            "_fsdp_wrapped_module.model.layers.0._fsdp_wrapped_module._checkpoint_wrapped_module.self_attn.q_proj.weight": q_proj,
+        },
+    )
+
+    output_dir = tmp_path / "out"
+    consolidate_checkpoint(
+        str(tmp_path / "epoch_0"), str(model_path), str(output_dir), dtype=torch.float32
+    )
+
+    weights = load_file(output_dir / "model.safetensors")
+    assert set(weights) == {
+        "model.embed_tokens.weight",
+        "model.layers.0.self_attn.q_proj.weight",
+    }
+    assert torch.equal(weights["model.embed_tokens.weight"], embeddings)
+    assert torch.equal(weights["model.layers.0.self_attn.q_proj.weight"], q_proj)
+    with open(output_dir / "config.json") as f:
+        assert json.load(f)["vocab_size"] == VOCAB_SIZE
+    assert (output_dir / "tokenizer_config.json").exists()
+
+
+def test_consolidate_merges_lora(tmp_path, model_path):
+    base = torch.randn(HIDDEN_SIZE, HIDDEN_SIZE)
+    lora_a = torch.randn(LORA_R, HIDDEN_SIZE)
+    lora_b = torch.randn(HIDDEN_SIZE, LORA_R)
+    prefix = "_fsdp_wrapped_module.base_model.model.model.layers.0.self_attn.q_proj"
+    checkpoint_dir = tmp_path / "epoch_0" / FSDP_MODEL_DIR
+    save_sharded(
+        checkpoint_dir,
+        {
+            f"{prefix}.base_layer.weight": base,
+            f"{prefix}.lora_A.default.weight": lora_a,
+            f"{prefix}.lora_B.default.weight": lora_b,
+        },
+    )
+
+    with pytest.raises(ValueError):
+        consolidate_checkpoint(str(checkpoint_dir), str(model_path), str(tmp_path))
+
+    output_dir = tmp_path / "out"
+    consolidate_checkpoint(
+        str(checkpoint_dir),
+        str(model_path),
+        str(output_dir),
+        lora_alpha=LORA_ALPHA,
+        lora_r=LORA_R,
+        dtype=torch.float32,
+    )
+    weights = load_file(output_dir / "model.safetensors")
+    assert list(weights) == ["model.layers.0.self_attn.q_proj.weight"]
+    torch.testing.assert_close(
+        weights["model.layers.0.self_attn.q_proj.weight"],
+        base + lora_b @ lora_a * (LORA_ALPHA / LORA_R),
+    )
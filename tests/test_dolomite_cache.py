@@ -0,0 +1,114 @@
+# SPDX-License-Identifier: Apache-2.0
+
+# Standard
+from argparse import Namespace
+import json
+
+# Third Party
+import pytest
+
+pytest.importorskip("accelerate")
+pytest.importorskip("instructlab.dolomite")
+pytest.importorskip("transformers")
+
+# First Party
+from instructlab.training import utils
+
+
+@pytest.fixture
+def conversions(monkeypatch):
+    """Replaces the dolomite conversion by one that only writes a config."""
+    calls = []
+
+    def import_from_huggingface(model_name_or_path, output_dir):
+        calls.append(model_name_or_path)
+        output_dir.mkdir(parents=True)
+        (output_dir / "config.json").write_text(
+            json.dumps({"model_type": "gpt_dolomite"})
+        )
+
+    monkeypatch.setattr(utils, "import_from_huggingface", import_from_huggingface)
+    # the fingerprint covers the dolomite version, pin it
+    monkeypatch.setattr(utils.importlib.metadata, "version", lambda name: "0.0.0")
+    return calls
+
+
+@pytest.fixture
+def checkpoint(tmp_path):
+    path = tmp_path / "model"
+    path.mkdir()
+    (path / "config.json").write_text(
+        json.dumps({"model_type": "llama", "architectures": ["LlamaForCausalLM"]})
+    )
+    (path / "model.safetensors").write_bytes(b"\0" * 4096)
+    return path
+
+
+def test_cache_hit_skips_the_conversion(tmp_path, checkpoint, conversions):
+    cache_dir = tmp_path / "cache"
+    cache_dir.mkdir()
+    first = utils.convert_to_dolomite_cached(str(checkpoint), str(cache_dir))
+    second = utils.convert_to_dolomite_cached(str(checkpoint), str(cache_dir))
+    assert first == second
+    assert conversions == [str(checkpoint)]
+
+    meta = utils.read_dolomite_conversion_meta(first)
+    assert meta["fingerprint"] == first.name
+    assert meta["source_architectures"] == ["LlamaForCausalLM"]
+    # no staging directory is left behind
+    assert [path.name for path in cache_dir.iterdir()] == [first.name]
+
+
+def test_changed_source_invalidates_the_cache(tmp_path, checkpoint, conversions):
+    cache_dir = tmp_path / "cache"
+    cache_dir.mkdir()
+    first = utils.convert_to_dolomite_cached(str(checkpoint), str(cache_dir))
+
+    # same size, different weights
+    (checkpoint / "model.safetensors").write_bytes(b"\1" * 4096)
+    second = utils.convert_to_dolomite_cached(str(checkpoint), str(cache_dir))
+    assert second != first
+    assert len(conversions) == 2
+
+
+def test_fingerprint_ignores_the_checkpoint_location(tmp_path, checkpoint, conversions):
+    copy = tmp_path / "copy"
+    copy.mkdir()
+    for path in checkpoint.iterdir():
+        (copy / path.name).write_bytes(path.read_bytes())
+    assert utils.fingerprint_checkpoint(str(copy)) == utils.fingerprint_checkpoint(
+        str(checkpoint)
+    )
+
+
+def test_ensure_loadable_converts_once_without_distributed(
+    tmp_path, checkpoint, conversions, monkeypatch
+):
+    def not_dolomite(path):
+        raise ValueError("not a dolomite checkpoint")
+
+    monkeypatch.setattr(utils.GPTDolomiteConfig, "from_pretrained", not_dolomite)
+    monkeypatch.setenv("LOCAL_RANK", "0")
+    cache_dir = tmp_path / "cache"
+    for _ in range(2):
+        with utils.ensure_loadable_dolomite_checkpoint(
+            str(checkpoint), str(cache_dir)
+        ) as path:
+            assert utils.read_dolomite_conversion_meta(path) is not None
+    assert conversions == [str(checkpoint)]
+
+
+def test_add_missing_architectures_keeps_the_source_architectures():
+    args = Namespace(
+        model_type="gpt_dolomite",
+        dolomite_conversion_meta={"source_architectures": ["GraniteForCausalLM"]},
+    )
+    config = Namespace(architectures=None)
+    with pytest.warns(UserWarning, match="GraniteForCausalLM"):
+        utils.add_missing_architectures(args, config)
+    assert config.architectures == ["GraniteForCausalLM"]
+
+    # architectures that are already set are kept
+    config = Namespace(architectures=["LlamaForCausalLM"])
+    utils.add_missing_architectures(args, config)
+    assert config.architectures == ["LlamaForCausalLM"]
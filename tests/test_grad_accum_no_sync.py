@@ -0,0 +1,119 @@
+# SPDX-License-Identifier: Apache-2.0
+
+# Standard
+from argparse import Namespace
+from contextlib import nullcontext
+import os
+import socket
+
+# Third Party
+import pytest
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+WORLD_SIZE = 2
+GRAD_ACCUM = 4
+
+
+class CountingHook:
+    """
+    FSDP comm hook counting the gradient reductions. gloo has no reduce-scatter, so the
+    full gradient is all-reduced and this rank keeps its shard of it.
+    """
+
+    def __init__(self):
+        self.num_reductions = 0
+
+    def __call__(self, state, grad, output):
+        self.num_reductions += 1
+        dist.all_reduce(grad)
+        grad.div_(dist.get_world_size())
+        output.copy_(grad.chunk(dist.get_world_size())[dist.get_rank()])
+
+
+def make_model():
+    torch.manual_seed(0)
+    return torch.nn.Sequential(
+        torch.nn.Linear(8, 16), torch.nn.ReLU(), torch.nn.Linear(16, 4)
+    )
+
+
+def train_window(grad_accum_no_sync, rank):
+    # Third Party
+    from torch.distributed.fsdp import FullyShardedDataParallel as FSDP
+
+    model = FSDP(make_model(), device_id=torch.device("cpu"))
+    hook = CountingHook()
+    model.register_comm_hook(None, hook)
+
+    torch.manual_seed(1 + rank)
+    for micro_step in range(1, GRAD_ACCUM + 1):
+        # the same pattern as the training loop in main_ds
+        skip_sync = grad_accum_no_sync and micro_step % GRAD_ACCUM != 0
+        loss = model(torch.randn(3, 8)).square().sum()
+        with model.no_sync() if skip_sync else nullcontext():
+            loss.backward()
+    # the sharded gradients of the flat parameters
+    grads = [param.grad.clone() for param in model.parameters()]
+    return hook.num_reductions, grads
+
+
+def _check_no_sync(rank, port):
+    os.environ.update(MASTER_ADDR="127.0.0.1", MASTER_PORT=str(port))
+    dist.init_process_group("gloo", rank=rank, world_size=WORLD_SIZE)
+    try:
+        synced_reductions, synced_grads = train_window(False, rank)
+        reductions, grads = train_window(True, rank)
+        # one reduction per optimizer step instead of one per micro-step
+        assert synced_reductions == GRAD_ACCUM
+        assert reductions == 1
+        for grad, synced_grad in zip(grads, synced_grads):
+            torch.testing.assert_close(grad, synced_grad)
+    finally:
+        dist.destroy_process_group()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def test_no_sync_reduces_once_per_accumulation_window():
+    mp.spawn(_check_no_sync, args=(free_port(),), nprocs=WORLD_SIZE)
+
+
+def make_args(**kwargs):
+    # First Party
+    from instructlab.training.config import DistributedBackend
+
+    args = {
+        "grad_accum_no_sync": True,
+        "target_tokens_per_step": 0,
+        "distributed_training_framework": DistributedBackend.FSDP.value,
+        "cpu_offload_params_fsdp": False,
+    }
+    args.update(kwargs)
+    return Namespace(**args)
+
+
+def test_use_grad_accum_no_sync():
+    pytest.importorskip("accelerate")
+    pytest.importorskip("aiofiles")
+    pytest.importorskip("instructlab.dolomite")
+    pytest.importorskip("transformers")
+    # First Party
+    from instructlab.training.config import DistributedBackend
+    from instructlab.training.main_ds import use_grad_accum_no_sync
+
+    assert use_grad_accum_no_sync(make_args(), grad_accum=4)
+    assert not use_grad_accum_no_sync(make_args(grad_accum_no_sync=False), 4)
+    # nothing to skip without accumulation, unless the token budget accumulates
+    assert not use_grad_accum_no_sync(make_args(), grad_accum=1)
+    assert use_grad_accum_no_sync(make_args(target_tokens_per_step=4096), 1)
+    assert not use_grad_accum_no_sync(
+        make_args(distributed_training_framework=DistributedBackend.DEEPSPEED.value),
+        4,
+    )
+    assert not use_grad_accum_no_sync(make_args(cpu_offload_params_fsdp=True), 4)
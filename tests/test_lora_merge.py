@@ -0,0 +1,157 @@
+# SPDX-License-Identifier: Apache-2.0
+
+# Standard
+from copy import deepcopy
+import os
+import socket
+
+# Third Party
+from safetensors.torch import load_file
+import pytest
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+pytest.importorskip("accelerate")
+pytest.importorskip("instructlab.dolomite")
+peft = pytest.importorskip("peft")
+transformers = pytest.importorskip("transformers")
+
+# First Party
+from instructlab.training.checkpointing import (
+    gather_lora_state_dict,
+    stream_merge_lora,
+)
+
+LORA_R, LORA_ALPHA = 2, 4
+SCALING = LORA_ALPHA / LORA_R
+
+
+def make_lora_model(seed=0):
+    torch.manual_seed(seed)
+    config = transformers.LlamaConfig(
+        vocab_size=64,
+        hidden_size=16,
+        intermediate_size=32,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        num_key_value_heads=2,
+    )
+    model = transformers.LlamaForCausalLM(config)
+    lora_config = peft.LoraConfig(
+        r=LORA_R,
+        lora_alpha=LORA_ALPHA,
+        target_modules=["q_proj", "v_proj", "up_proj"],
+        # random B matrices, so merging actually changes the weights
+        init_lora_weights=False,
+    )
+    return model, peft.get_peft_model(deepcopy(model), lora_config)
+
+
+@pytest.fixture
+def base_dir(tmp_path):
+    model, _ = make_lora_model()
+    path = tmp_path / "base"
+    model.save_pretrained(path, safe_serialization=True)
+    return path
+
+
+def read_weights(path):
+    weights = {}
+    for shard in sorted(path.glob("*.safetensors")):
+        weights.update(load_file(shard))
+    return weights
+
+
+def test_stream_merge_matches_merge_and_unload(tmp_path, base_dir):
+    _, lora_model = make_lora_model()
+    expected = deepcopy(lora_model).merge_and_unload().state_dict()
+
+    lora_state = gather_lora_state_dict(lora_model, is_main_process=True)
+    assert "model.layers.0.self_attn.q_proj.lora_A.default.weight" in lora_state
+
+    output_dir = tmp_path / "merged"
+    output_dir.mkdir()
+    stream_merge_lora(
+        [base_dir / "model.safetensors"],
+        lora_state,
+        output_dir,
+        scaling=SCALING,
+        dtype=torch.float32,
+        # several output shards
+        max_shard_size=16 * 1024,
+    )
+    assert (output_dir / "model.safetensors.index.json").exists()
+
+    merged = read_weights(output_dir)
+    assert set(merged) == set(expected)
+    for name, tensor in expected.items():
+        torch.testing.assert_close(merged[name], tensor, msg=name)
+
+
+def test_stream_merge_rejects_missing_adapter_weights(tmp_path, base_dir):
+    _, lora_model = make_lora_model()
+    lora_state = gather_lora_state_dict(lora_model, is_main_process=True)
+
+    unknown = dict(lora_state)
+    unknown["model.layers.7.self_attn.q_proj.lora_A.default.weight"] = torch.zeros(
+        LORA_R, 16
+    )
+    unknown["model.layers.7.self_attn.q_proj.lora_B.default.weight"] = torch.zeros(
+        16, LORA_R
+    )
+    with pytest.raises(ValueError, match="not in the base model"):
+        stream_merge_lora(
+            [base_dir / "model.safetensors"], unknown, tmp_path, scaling=SCALING
+        )
+
+    incomplete = dict(lora_state)
+    del incomplete["model.layers.0.self_attn.q_proj.lora_B.default.weight"]
+    with pytest.raises(ValueError, match="missing their A or B"):
+        stream_merge_lora(
+            [base_dir / "model.safetensors"], incomplete, tmp_path, scaling=SCALING
+        )
+
+
+def _gather_under_fsdp(rank, world_size, port, expected):
+    # Third Party
+    from torch.distributed.fsdp import FullyShardedDataParallel as FSDP
+    from torch.distributed.fsdp.wrap import ModuleWrapPolicy
+
+    os.environ.update(MASTER_ADDR="127.0.0.1", MASTER_PORT=str(port))
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    try:
+        _, lora_model = make_lora_model()
+        model = FSDP(
+            lora_model,
+            auto_wrap_policy=ModuleWrapPolicy(
+                {transformers.models.llama.modeling_llama.LlamaDecoderLayer}
+            ),
+            device_id=torch.device("cpu"),
+            use_orig_params=True,
+        )
+        lora_state = gather_lora_state_dict(model, is_main_process=rank == 0)
+        if rank == 0:
+            # the FSDP wrapper prefixes are stripped from the names
+            assert set(lora_state) == set(expected)
+            for name, tensor in expected.items():
+                torch.testing.assert_close(lora_state[name], tensor, msg=name)
+        else:
+            assert not lora_state
+    finally:
+        dist.destroy_process_group()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def test_gather_lora_state_dict_under_fsdp():
+    _, lora_model = make_lora_model()
+    expected = gather_lora_state_dict(lora_model, is_main_process=True)
+    world_size = 2
+    mp.spawn(
+        _gather_under_fsdp, args=(world_size, free_port(), expected), nprocs=world_size
+    )
@@ -0,0 +1,105 @@
+# SPDX-License-Identifier: Apache-2.0
+
+# Standard
+from copy import deepcopy
+
+# Third Party
+import pytest
+import torch
+
+pytest.importorskip("accelerate")
+pytest.importorskip("instructlab.dolomite")
+transformers = pytest.importorskip("transformers")
+
+# First Party
+from instructlab.training.utils import (
+    convert_loss_to_reduce_sum,
+    shift_labels_for_loss,
+    sum_cross_entropy,
+)
+
+VOCAB_SIZE = 64
+
+
+def make_model():
+    torch.manual_seed(0)
+    config = transformers.LlamaConfig(
+        vocab_size=VOCAB_SIZE,
+        hidden_size=16,
+        intermediate_size=32,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        num_key_value_heads=2,
+    )
+    return transformers.LlamaForCausalLM(config)
+
+
+def padded_batch():
+    lengths = [11, 6]
+    input_ids = torch.zeros(len(lengths), max(lengths), dtype=torch.long)
+    attention_mask = torch.zeros_like(input_ids)
+    labels = torch.full_like(input_ids, -100)
+    for i, length in enumerate(lengths):
+        input_ids[i, :length] = torch.randint(VOCAB_SIZE, (length,))
+        attention_mask[i, :length] = 1
+        # the first tokens are the prompt
+        labels[i, 2:length] = input_ids[i, 2:length]
+    return {"input_ids": input_ids, "attention_mask": attention_mask, "labels": labels}
+
+
+def packed_batch():
+    lengths = [7, 4, 9]
+    input_ids = torch.randint(VOCAB_SIZE, (1, sum(lengths)))
+    position_ids = torch.cat([torch.arange(length) for length in lengths])[None]
+    labels = input_ids.clone()
+    # the first token of every sample has no loss, so no sample is scored
+    # against the first token of the next one
+    labels[position_ids == 0] = -100
+    return {"input_ids": input_ids, "position_ids": position_ids, "labels": labels}
+
+
+def loss_and_grads(model, batch):
+    model.zero_grad(set_to_none=True)
+    loss = model(**batch).loss
+    loss.backward()
+    return loss.detach(), {name: param.grad for name, param in model.named_parameters()}
+
+
+@pytest.mark.parametrize("make_batch", [padded_batch, packed_batch])
+@pytest.mark.parametrize("chunk_size", [1, 5, 64])
+def test_chunked_loss_matches_unchunked(make_batch, chunk_size):
+    model = make_model()
+    chunked = convert_loss_to_reduce_sum(deepcopy(model), loss_chunk_size=chunk_size)
+    model = convert_loss_to_reduce_sum(model)
+
+    torch.manual_seed(1)
+    batch = make_batch()
+    expected_loss, expected_grads = loss_and_grads(model, batch)
+    loss, grads = loss_and_grads(chunked, batch)
+
+    torch.testing.assert_close(loss, expected_loss)
+    assert grads.keys() == expected_grads.keys()
+    for name, grad in expected_grads.items():
+        torch.testing.assert_close(grads[name], grad, msg=name)
+
+
+def test_sum_cross_entropy_chunks_match_with_projection():
+    torch.manual_seed(0)
+    projection = torch.nn.Linear(8, VOCAB_SIZE)
+    hidden = torch.randn(2, 13, 8, requires_grad=True)
+    labels = shift_labels_for_loss(torch.randint(VOCAB_SIZE, (2, 13)))
+
+    expected = sum_cross_entropy(hidden, labels, projection=projection)
+    (expected_grad,) = torch.autograd.grad(expected, hidden)
+    loss = sum_cross_entropy(hidden, labels, projection=projection, chunk_size=4)
+    (grad,) = torch.autograd.grad(loss, hidden)
+
+    torch.testing.assert_close(loss, expected)
+    torch.testing.assert_close(grad, expected_grad)
+
+
+def test_shift_labels_for_loss_masks_sample_boundaries():
+    labels = torch.arange(10)
+    cu_seqlens = torch.tensor([0, 4, 10])
+    shifted = shift_labels_for_loss(labels, cu_seqlens)
+    assert shifted.tolist() == [1, 2, 3, -100, 5, 6, 7, 8, 9, -100]
@@ -0,0 +1,73 @@
+# SPDX-License-Identifier: Apache-2.0
+
+# First Party
+from instructlab.training.config import EmptyCacheMode
+from instructlab.training.memory import EmptyCachePolicy
+
+GiB = 1024**3
+
+
+class FakeAllocator:
+    def __init__(self):
+        self.stats = {
+            "num_alloc_retries": 0,
+            "reserved_bytes.all.current": 40 * GiB,
+            "allocated_bytes.all.current": 10 * GiB,
+            "inactive_split_bytes.all.current": 1 * GiB,
+        }
+        self.num_empty_cache = 0
+
+    def memory_stats(self):
+        return dict(self.stats)
+
+    def empty_cache(self):
+        self.num_empty_cache += 1
+
+
+def make_policy(allocator, mode=EmptyCacheMode.ADAPTIVE):
+    return EmptyCachePolicy(
+        mode,
+        stats_provider=allocator.memory_stats,
+        empty_cache=allocator.empty_cache,
+    )
+
+
+def test_fixed_modes():
+    allocator = FakeAllocator()
+    assert not make_policy(allocator, EmptyCacheMode.NEVER).step()
+    assert make_policy(allocator, EmptyCacheMode.ALWAYS).step()
+    assert allocator.num_empty_cache == 1
+
+
+def test_adaptive_keeps_cached_activations():
+    # most of the reserved memory is free but cached, which the next step reuses
+    allocator = FakeAllocator()
+    policy = make_policy(allocator)
+    for _ in range(10):
+        assert not policy.step()
+    assert allocator.num_empty_cache == 0
+
+
+def test_adaptive_empties_fragmented_cache():
+    allocator = FakeAllocator()
+    policy = make_policy(allocator)
+    allocator.stats["inactive_split_bytes.all.current"] = 25 * GiB
+    assert policy.step()
+    assert policy.num_empty_cache == 1
+
+
+def test_adaptive_ignores_fragmentation_of_small_caches():
+    allocator = FakeAllocator()
+    allocator.stats["reserved_bytes.all.current"] = GiB // 2
+    allocator.stats["inactive_split_bytes.all.current"] = GiB // 3
+    assert not make_policy(allocator).step()
+
+
+def test_adaptive_empties_after_alloc_retries():
+    allocator = FakeAllocator()
+    policy = make_policy(allocator)
+    assert not policy.step()
+    allocator.stats["num_alloc_retries"] = 1
+    assert policy.step()
+    # only new retries count
+    assert not policy.step()
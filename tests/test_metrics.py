@@ -0,0 +1,101 @@
+# SPDX-License-Identifier: Apache-2.0
+
+# Standard
+from contextlib import contextmanager
+
+# Third Party
+import pytest
+import torch
+
+# First Party
+from instructlab.training.metrics import StepMetrics
+
+HOST_READS = ("item", "tolist", "__bool__", "__int__", "__float__", "__index__")
+
+
+@contextmanager
+def forbid_host_reads(monkeypatch):
+    """Makes every read of a tensor's values back to the host fail, like a sync would."""
+
+    def fail(*args, **kwargs):
+        raise AssertionError("a tensor was read back to the host")
+
+    with monkeypatch.context() as patch:
+        for name in HOST_READS:
+            patch.setattr(torch.Tensor, name, fail)
+        yield
+
+
+def run_steps(metrics, num_steps, device):
+    for step in range(num_steps):
+        metrics.start_step(num_loss_counted_tokens=100 + step, micro_batch_size=4)
+        loss = torch.tensor(2.0, device=device, requires_grad=True) * (100 + step)
+        scaled = loss / metrics.loss_tokens()
+        scaled.backward()
+        metrics.end_step(loss, total_length=120 + step, sum_squared_lengths=3600)
+        metrics.record_grad_norm(torch.tensor(1.5, device=device))
+
+
+def test_steps_between_logs_do_not_read_back(monkeypatch):
+    metrics = StepMetrics("cpu")
+    with forbid_host_reads(monkeypatch):
+        run_steps(metrics, 5, "cpu")
+    assert metrics.host_syncs == 0
+
+    logged = metrics.flush()
+    assert metrics.host_syncs == 1
+    assert logged["steps"] == 5
+    assert logged["num_loss_counted_tokens"] == sum(100 + step for step in range(5))
+    assert logged["batch_size"] == 20
+    assert logged["total_loss"] == pytest.approx(2.0)
+    assert logged["gradnorm"] == pytest.approx(1.5)
+
+    # ranks that do not log reset their window without reading it
+    with forbid_host_reads(monkeypatch):
+        run_steps(metrics, 3, "cpu")
+        assert metrics.flush(read=False) == {}
+    assert metrics.host_syncs == 1
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="requires a GPU")
+def test_steps_between_logs_do_not_sync_the_device():
+    metrics = StepMetrics("cuda")
+    torch.cuda.set_sync_debug_mode("error")
+    try:
+        run_steps(metrics, 5, "cuda")
+    finally:
+        torch.cuda.set_sync_debug_mode("default")
+    assert metrics.host_syncs == 0
+    assert metrics.flush()["steps"] == 5
+
+
+def test_dropped_optimizer_step_is_not_counted(monkeypatch):
+    metrics = StepMetrics("cpu")
+    run_steps(metrics, 2, "cpu")
+    metrics.end_optimizer_step()
+
+    # a step of two micro-batches runs out of memory and is trained on again
+    with forbid_host_reads(monkeypatch):
+        run_steps(metrics, 2, "cpu")
+        metrics.drop_optimizer_step()
+    run_steps(metrics, 2, "cpu")
+    metrics.end_optimizer_step()
+
+    logged = metrics.flush()
+    assert logged["steps"] == 4
+    assert logged["batch_size"] == 16
+    assert logged["num_loss_counted_tokens"] == 2 * (100 + 101)
+    assert logged["num_tokens"] == 2 * (120 + 121)
+    assert logged["samples_seen"] == 16
+
+
+def test_dropped_optimizer_step_after_a_flush():
+    metrics = StepMetrics("cpu", samples_seen=100)
+    run_steps(metrics, 1, "cpu")
+    # the log falls inside the step, which is dropped afterwards
+    assert metrics.flush()["samples_seen"] == 104
+    run_steps(metrics, 1, "cpu")
+    metrics.drop_optimizer_step()
+
+    assert metrics.samples_seen == 100
+    assert metrics.flush() == {}
@@ -0,0 +1,88 @@
+# SPDX-License-Identifier: Apache-2.0
+
+# Standard
+from argparse import Namespace
+from pathlib import Path
+import json
+import os
+import subprocess
+import sys
+
+# Third Party
+import numpy as np
+import pytest
+
+# First Party
+from instructlab.training import multipack_planner
+
+
+@pytest.fixture
+def lengths_file(tmp_path):
+    lengths = np.random.default_rng(0).integers(20, 400, size=2000)
+    path = tmp_path / "lengths.npy"
+    np.save(path, lengths)
+    return path
+
+
+def make_args(data_path, **kwargs):
+    args = {
+        "data_path": str(data_path),
+        "num_gpus": 4,
+        "effective_batch_size": 64,
+        "max_batch_len": 4000,
+        "seed": 42,
+        "padding": False,
+        "multipack_balance_cost": False,
+        "multipack_carry_over_tail": False,
+        "hidden_size": None,
+        "json": True,
+    }
+    args.update(kwargs)
+    return Namespace(**args)
+
+
+@pytest.mark.parametrize("balance_cost", [False, True])
+def test_main_prints_the_plan(lengths_file, capsys, balance_cost):
+    multipack_planner.main(
+        make_args(lengths_file, multipack_balance_cost=balance_cost, hidden_size=64)
+    )
+    plan = json.loads(capsys.readouterr().out)
+    assert plan["sampler"] == "multipack"
+    assert plan["num_samples"] == 2000
+    assert plan["num_gpus"] == 4
+    assert plan["packing_max_batch_len"] <= 4000
+    assert plan["optimizer_steps_per_epoch"] >= 1
+    assert 0 < plan["multipack_plan"]["data_utilization"] <= 1
+
+
+def test_main_prints_a_table(lengths_file, capsys):
+    multipack_planner.main(make_args(lengths_file, json=False))
+    out = capsys.readouterr().out
+    assert "packing_max_batch_len" in out
+    assert "data_utilization" in out
+
+
+def run_cli(*args):
+    env = dict(os.environ)
+    # the package may only be importable from the source tree
+    src = str(Path(multipack_planner.__file__).parents[2])
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [src, env.get("PYTHONPATH")]))
+    return subprocess.run(
+        [sys.executable, "-m", "instructlab.training.multipack_planner", *args],
+        capture_output=True,
+        text=True,
+        env=env,
+        check=False,
+    )
+
+
+def test_cli_rejects_balance_cost_with_padding(lengths_file):
+    result = run_cli(
+        f"--data_path={lengths_file}",
+        "--num_gpus=4",
+        "--padding",
+        "--multipack_balance_cost",
+    )
+    assert result.returncode == 2
+    assert "--multipack_balance_cost" in result.stderr
+    assert "Traceback" not in result.stderr
@@ -0,0 +1,199 @@
+# SPDX-License-Identifier: Apache-2.0
+
+# Third Party
+import numpy as np
+import pytest
+
+# First Party
+from instructlab.training.multipack_sampler import (
+    MultipackDistributedBatchSampler,
+    allocate_balanced,
+    lpt_check,
+    lpt_with_result,
+)
+
+NUM_REPLICAS = 4
+
+
+def epoch_samples(samplers, epoch):
+    used = []
+    for sampler in samplers:
+        sampler.set_epoch(epoch)
+        used.extend(np.concatenate(list(sampler)).tolist())
+    return used
+
+
+@pytest.fixture
+def lengths():
+    return np.random.default_rng(0).integers(20, 400, size=500)
+
+
+def make_samplers(lengths, **kwargs):
+    return [
+        MultipackDistributedBatchSampler(
+            batch_max_length=1000,
+            lengths=lengths,
+            num_replicas=NUM_REPLICAS,
+            rank=rank,
+            padding=False,
+            prefetch_next_epoch=False,
+            **kwargs,
+        )
+        for rank in range(NUM_REPLICAS)
+    ]
+
+
+def test_carry_over_tail_trains_every_sample_once_per_epoch(lengths):
+    samplers = make_samplers(lengths, carry_over_tail=True)
+    previous_tail = []
+    for epoch in range(4):
+        used = epoch_samples(samplers, epoch)
+        assert len(used) == len(set(used))
+        # the previous epoch's leftovers are trained on first
+        assert set(previous_tail) <= set(used)
+
+        stats = samplers[0].epoch_stats()
+        assert stats["data_utilization"] <= 1.0
+        assert stats["data_utilization"] == len(used) / len(lengths)
+        previous_tail = samplers[0]._get_plan(epoch)["tail"].tolist()
+        if epoch > 0:
+            assert stats["carried_over_samples"] > 0
+
+
+def test_replan_keeps_trained_batches_and_repacks_the_rest(lengths):
+    samplers = make_samplers(lengths)
+    for sampler in samplers:
+        sampler.set_epoch(0)
+    before = [sampler.generate_batches() for sampler in samplers]
+
+    for sampler in samplers:
+        sampler.replan(batch_max_length=600, start_batch=3)
+    after = [sampler.generate_batches() for sampler in samplers]
+
+    for old, new in zip(before, after):
+        for old_batch, new_batch in zip(old[:3], new[:3]):
+            assert np.array_equal(old_batch, new_batch)
+        assert all(lengths[batch].sum() <= 600 for batch in new[3:])
+    used = np.concatenate([np.concatenate(batches) for batches in after]).tolist()
+    assert len(used) == len(set(used))
+    assert samplers[0].start_batch == 3
+
+
+@pytest.fixture
+def skewed_lengths():
+    # mostly short samples and a few long ones, whose attention dominates their cost
+    rng = np.random.default_rng(0)
+    lengths = np.concatenate(
+        [rng.integers(16, 128, size=900), rng.integers(1024, 4000, size=100)]
+    )
+    return rng.permutation(lengths)
+
+
+def test_lpt_assigns_every_sample_within_capacity():
+    lengths = np.array([900, 700, 500, 400, 300, 300, 200, 100, 50, 50])
+    assert lpt_check(lengths, 1000, 4, 1e-3)
+    assert not lpt_check(lengths, 1000, 3, 1e-3)
+
+    assignment = lpt_with_result(lengths, 1000, 4, 1e-3)
+    assert ((assignment >= 0) & (assignment < 4)).all()
+    bins_tokens = np.bincount(assignment, weights=lengths, minlength=4)
+    assert (bins_tokens <= 1000).all()
+    assert bins_tokens.sum() == lengths.sum()
+
+
+def test_allocate_balanced_packs_every_index_once(skewed_lengths):
+    capacity, num_replicas = 8192, 4
+    steps = []
+    for rank in range(num_replicas):
+        batches, total_used, _, step_tokens, _ = allocate_balanced(
+            lengths=skewed_lengths,
+            lengths_cumsum=np.cumsum(skewed_lengths),
+            rank=rank,
+            c=capacity,
+            n=num_replicas,
+            attn_cost_coeff=1 / 1024,
+        )
+        steps.append(batches)
+        for step, batch in enumerate(batches):
+            assert skewed_lengths[batch].sum() == step_tokens[step, rank]
+    assert (step_tokens <= capacity).all()
+
+    used = np.concatenate([batch for batches in steps for batch in batches])
+    assert len(used) == len(np.unique(used))
+    # the steps consume a prefix of the samples, every bin of a step is non-empty
+    assert sorted(used.tolist()) == list(range(len(used)))
+    assert skewed_lengths[used].sum() == total_used
+    assert all(len(batch) for batches in steps for batch in batches)
+
+
+def test_balanced_packing_is_no_worse_than_greedy(skewed_lengths):
+    def imbalance(balance_cost):
+        sampler = MultipackDistributedBatchSampler(
+            batch_max_length=8192,
+            lengths=skewed_lengths,
+            num_replicas=4,
+            rank=0,
+            padding=False,
+            prefetch_next_epoch=False,
+            balance_cost=balance_cost,
+            attn_cost_coeff=1 / 1024,
+        )
+        sampler.set_epoch(0)
+        return sampler.imbalance_stats()["cost_imbalance_mean"]
+
+    assert imbalance(balance_cost=True) <= imbalance(balance_cost=False)
+
+
+def test_epoch_stats_on_a_hand_computed_plan():
+    # nine samples of 4 tokens and one that never fits: bins of 10 tokens hold two
+    # samples, so a step across 2 ranks takes 4 samples and one sample is left over
+    lengths = np.array([4] * 9 + [20])
+    samplers = [
+        MultipackDistributedBatchSampler(
+            batch_max_length=10,
+            lengths=lengths,
+            num_replicas=2,
+            rank=rank,
+            padding=False,
+            prefetch_next_epoch=False,
+            carry_over_tail=True,
+        )
+        for rank in range(2)
+    ]
+
+    for sampler in samplers:
+        sampler.set_epoch(0)
+    stats = samplers[0].epoch_stats()
+    assert stats["num_steps"] == 2
+    assert stats["efficiency"] == pytest.approx(32 / (2 * 2 * 10))
+    assert stats["tokens_per_rank_min"] == stats["tokens_per_rank_max"] == 8
+    assert stats["dropped_long_samples"] == 1
+    assert stats["dropped_tail_samples"] == 1
+    assert stats["carried_over_samples"] == 0
+    assert stats["data_utilization"] == pytest.approx(8 / 10)
+    (tail,) = samplers[0]._get_plan(0)["tail"].tolist()
+
+    used = epoch_samples(samplers, 1)
+    stats = samplers[0].epoch_stats()
+    assert stats["carried_over_samples"] == 1
+    assert stats["dropped_tail_samples"] == 1
+    assert stats["data_utilization"] == pytest.approx(8 / 10)
+    # the carried sample is trained on first, and only once
+    assert any(tail in sampler.generate_batches()[0] for sampler in samplers)
+    assert len(used) == len(set(used)) == 8
+
+
+@pytest.mark.parametrize("start_batch", [0, 1, 5])
+def test_resumed_epoch_starts_at_the_saved_batch(lengths, start_batch):
+    sampler = make_samplers(lengths, carry_over_tail=True)[1]
+    sampler.set_epoch(2)
+    full_epoch = list(sampler)
+
+    resumed = make_samplers(lengths, carry_over_tail=True)[1]
+    resumed.set_epoch(2, start_batch=start_batch)
+    batches = list(resumed)
+    assert len(batches) == len(full_epoch) - start_batch
+    for batch, expected in zip(batches, full_epoch[start_batch:]):
+        assert np.array_equal(batch, expected)
+    # the epoch still counts every batch, for the progress bar and LR schedule
+    assert len(resumed) == len(full_epoch)
@@ -0,0 +1,105 @@
+# SPDX-License-Identifier: Apache-2.0
+
+# Third Party
+import pytest
+import torch
+
+pytest.importorskip("accelerate")
+pytest.importorskip("instructlab.dolomite")
+pytest.importorskip("transformers")
+
+# First Party
+from instructlab.training.utils import add_noisy_embeddings
+
+HIDDEN_SIZE = 16
+ALPHA = 5.0
+
+
+class Decoder(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.embed_tokens = torch.nn.Embedding(64, HIDDEN_SIZE)
+
+    def forward(
+        self, input_ids, position_ids=None, cu_seqlens=None, attention_mask=None
+    ):
+        return self.embed_tokens(input_ids)
+
+
+class TinyModel(torch.nn.Module):
+    """The parts of a HF model the NEFTune hooks use."""
+
+    def __init__(self):
+        super().__init__()
+        self.model = Decoder()
+
+    @property
+    def base_model(self):
+        return self.model
+
+    def get_input_embeddings(self):
+        return self.model.embed_tokens
+
+    def forward(self, input_ids, **kwargs):
+        return self.model(input_ids, **kwargs)
+
+
+def noise_and_bound(model, input_ids, lengths, **kwargs):
+    clean = model.get_input_embeddings().weight[input_ids].detach()
+    noise = model(input_ids, **kwargs).detach() - clean
+    bound = ALPHA / torch.sqrt(lengths.float() * HIDDEN_SIZE)
+    return noise.reshape(-1, HIDDEN_SIZE), bound.reshape(-1, 1)
+
+
+@pytest.fixture
+def model():
+    torch.manual_seed(0)
+    return add_noisy_embeddings(TinyModel(), noise_alpha=ALPHA)
+
+
+def check_noise(noise, bound):
+    # bounded by the scale of each token's own sample, and using most of it
+    assert (noise.abs() <= bound + 1e-6).all()
+    assert (noise.abs().amax(dim=-1) > bound.squeeze(-1) / 2).all()
+
+
+def test_packed_samples_are_noised_by_their_own_length(model):
+    sample_lengths = torch.tensor([3, 40, 9])
+    input_ids = torch.randint(64, (1, int(sample_lengths.sum())))
+    lengths = torch.repeat_interleave(sample_lengths, sample_lengths)
+    position_ids = torch.cat([torch.arange(n) for n in sample_lengths])[None]
+
+    check_noise(*noise_and_bound(model, input_ids, lengths, position_ids=position_ids))
+    cu_seqlens = torch.nn.functional.pad(sample_lengths.cumsum(0), (1, 0))
+    check_noise(*noise_and_bound(model, input_ids, lengths, cu_seqlens=cu_seqlens))
+
+
+def test_padded_samples_are_noised_by_their_unpadded_length(model):
+    attention_mask = torch.tensor([[0] * 30 + [1] * 10, [1] * 40])
+    input_ids = torch.randint(64, attention_mask.shape)
+    lengths = attention_mask.sum(-1, keepdim=True).expand_as(attention_mask)
+    noise, bound = noise_and_bound(
+        model, input_ids, lengths, attention_mask=attention_mask
+    )
+    assert (noise.abs() <= bound + 1e-6).all()
+    # the sample of 10 tokens gets a larger noise than a 40 token sequence would
+    assert noise[30:40].abs().max() > ALPHA / (40 * HIDDEN_SIZE) ** 0.5
+
+
+def test_unpacked_batch_uses_the_sequence_length(model):
+    input_ids = torch.randint(64, (2, 25))
+    check_noise(*noise_and_bound(model, input_ids, torch.full((2, 25), 25)))
+
+
+def test_no_noise_in_eval_mode(model):
+    model.eval()
+    input_ids = torch.randint(64, (2, 25))
+    noise, _ = noise_and_bound(model, input_ids, torch.full((2, 25), 25))
+    assert (noise == 0).all()
+
+
+def test_disabled_without_alpha():
+    model = TinyModel()
+    assert add_noisy_embeddings(model, noise_alpha=None) is model
+    assert not model.get_input_embeddings()._forward_hooks
+    assert not model.base_model._forward_pre_hooks
@@ -0,0 +1,267 @@
+# SPDX-License-Identifier: Apache-2.0
+
+# Standard
+import json
+import os
+import socket
+
+# Third Party
+from torch.utils.data import DataLoader
+import numpy as np
+import pytest
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+# First Party
+from instructlab.training.multipack_sampler import MultipackDistributedBatchSampler
+from instructlab.training.oom_recovery import (
+    OOMGuard,
+    is_oom_error,
+    iterate_epoch,
+    recover_step,
+)
+
+WORLD_SIZE = 2
+GRAD_ACCUM = 2
+BATCH_MAX_LENGTH = 2000
+# rank 1 runs out of memory in the second micro-batch of the step starting at batch 6
+OOM_RANK, OOM_BATCH = 1, 7
+
+
+def make_sampler(rank):
+    lengths = np.random.default_rng(0).integers(20, 400, size=500)
+    return lengths, MultipackDistributedBatchSampler(
+        batch_max_length=BATCH_MAX_LENGTH,
+        lengths=lengths,
+        num_replicas=WORLD_SIZE,
+        rank=rank,
+        padding=False,
+        prefetch_next_epoch=False,
+    )
+
+
+def _train_epoch(rank, port, output_dir):
+    os.environ.update(MASTER_ADDR="127.0.0.1", MASTER_PORT=str(port))
+    dist.init_process_group("gloo", rank=rank, world_size=WORLD_SIZE)
+    try:
+        lengths, sampler = make_sampler(rank)
+        sampler.set_epoch(0)
+        original_batches = sampler.generate_batches()
+        train_loader = DataLoader(
+            range(len(lengths)), batch_sampler=sampler, collate_fn=list
+        )
+        model = torch.nn.Linear(1, 1)
+        optimizer = torch.optim.SGD(model.parameters(), lr=0.1)
+        guard = OOMGuard(enabled=True)
+
+        # the same control flow as the training loop in main_ds
+        trained, step_samples, events = [], [], []
+        step_start_batch = 0
+        for batch_index, batch in iterate_epoch(train_loader, 0, guard):
+            with guard.catch():
+                if rank == OOM_RANK and batch_index == OOM_BATCH and not events:
+                    raise torch.cuda.OutOfMemoryError("CUDA out of memory")
+                model(torch.ones(1, 1)).sum().backward()
+            if guard.vote("backward"):
+                events.append(
+                    guard.recover(
+                        optimizer,
+                        sampler,
+                        restart_batch=step_start_batch,
+                        min_batch_len=int(lengths.max()),
+                    )
+                )
+                assert all(param.grad is None for param in model.parameters())
+                step_samples = []
+                continue
+            step_samples.extend(batch)
+            if (batch_index + 1) % GRAD_ACCUM == 0 or batch_index == len(
+                train_loader
+            ) - 1:
+                optimizer.step()
+                optimizer.zero_grad()
+                trained.extend(step_samples)
+                step_samples = []
+                step_start_batch = batch_index + 1
+
+        with open(os.path.join(output_dir, f"rank{rank}.json"), "w") as f:
+            json.dump(
+                {
+                    "events": events,
+                    "trained": trained,
+                    "original_batches": [b.tolist() for b in original_batches],
+                    "batches": [b.tolist() for b in sampler.generate_batches()],
+                },
+                f,
+            )
+    finally:
+        dist.destroy_process_group()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def test_all_ranks_retry_the_failed_step_on_a_smaller_plan(tmp_path):
+    mp.spawn(
+        _train_epoch, args=(free_port(), str(tmp_path)), nprocs=WORLD_SIZE, join=True
+    )
+    results = [
+        json.loads((tmp_path / f"rank{rank}.json").read_text())
+        for rank in range(WORLD_SIZE)
+    ]
+    lengths, _ = make_sampler(0)
+
+    # every rank dropped the same step, although only one of them failed
+    expected_event = {
+        "phase": "backward",
+        "failed_ranks": 1,
+        "recoveries": 1,
+        "previous_batch_max_length": BATCH_MAX_LENGTH,
+        "batch_max_length": int(BATCH_MAX_LENGTH * 0.8),
+        "restart_batch": OOM_BATCH - 1,
+    }
+    assert all(result["events"] == [expected_event] for result in results)
+
+    trained = [sample for result in results for sample in result["trained"]]
+    # the micro-batch of the failed step that succeeded was not trained on twice
+    assert len(trained) == len(set(trained))
+    planned = {
+        sample for result in results for batch in result["batches"] for sample in batch
+    }
+    assert set(trained) == planned
+
+    restart = expected_event["restart_batch"]
+    for result in results:
+        assert result["batches"][:restart] == result["original_batches"][:restart]
+        assert all(
+            lengths[batch].sum() <= expected_event["batch_max_length"]
+            for batch in result["batches"][restart:]
+        )
+
+
+def test_guard_only_swallows_oom_errors():
+    guard = OOMGuard(enabled=True)
+    with guard.catch():
+        raise RuntimeError("CUDA error: out of memory")
+    assert guard.failed
+    assert guard.vote("forward")
+
+    with pytest.raises(ValueError):
+        with guard.catch():
+            raise ValueError("not an OOM")
+    assert not guard.failed
+
+    # a disabled guard lets everything through and never votes for a failure
+    disabled = OOMGuard(enabled=False)
+    with pytest.raises(torch.cuda.OutOfMemoryError):
+        with disabled.catch():
+            raise torch.cuda.OutOfMemoryError("CUDA out of memory")
+    assert not disabled.vote("forward")
+    assert is_oom_error(torch.cuda.OutOfMemoryError("CUDA out of memory"))
+    assert not is_oom_error(RuntimeError("shape mismatch"))
+
+
+def test_recovery_gives_up_at_the_minimum_capacity():
+    _, sampler = make_sampler(0)
+    sampler.set_epoch(0)
+    optimizer = torch.optim.SGD(torch.nn.Linear(1, 1).parameters(), lr=0.1)
+    guard = OOMGuard(enabled=True, max_recoveries=10)
+    with pytest.raises(RuntimeError, match="cannot be reduced"):
+        guard.recover(optimizer, sampler, restart_batch=0, min_batch_len=2000)
+
+    guard = OOMGuard(enabled=True, max_recoveries=1)
+    guard.recover(optimizer, None, restart_batch=0, min_batch_len=0)
+    with pytest.raises(RuntimeError, match="giving up"):
+        guard.recover(optimizer, None, restart_batch=0, min_batch_len=0)
+
+
+class LengthsDataset(torch.utils.data.Dataset):
+    def __init__(self, lengths):
+        self.lengths = lengths
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __getitem__(self, idx):
+        return int(idx)
+
+    def get_lengths(self):
+        return self.lengths
+
+
+def run_epoch(train_loader, guard, oom_batch):
+    """The step bookkeeping of the training loop in main_ds, with one OOM."""
+    optimizer = torch.optim.SGD(torch.nn.Linear(1, 1).parameters(), lr=0.1)
+    global_step, step_start_batch, skip_to_step_boundary = 1, 0, False
+    steps, events = [], []
+    for batch_index, batch in iterate_epoch(train_loader, 0, guard):
+        if skip_to_step_boundary:
+            skip_to_step_boundary = global_step % GRAD_ACCUM != 0
+            global_step += 1
+            step_start_batch = batch_index + 1
+            continue
+        with guard.catch():
+            if batch_index == oom_batch and not events:
+                raise torch.cuda.OutOfMemoryError("CUDA out of memory")
+        step_boundary = global_step % GRAD_ACCUM == 0
+        if guard.vote("backward"):
+            event, global_step, step_start_batch, skip_to_step_boundary = recover_step(
+                guard,
+                optimizer,
+                train_loader,
+                batch_index=batch_index,
+                step_start_batch=step_start_batch,
+                global_step=global_step,
+                skip_window=not step_boundary,
+            )
+            events.append(event)
+            continue
+        steps.append((global_step, batch_index))
+        if step_boundary:
+            step_start_batch = batch_index + 1
+        global_step += 1
+    return steps, events
+
+
+def test_recover_step_retries_the_step_on_a_plan_fitting_the_longest_sample():
+    lengths = np.random.default_rng(0).integers(20, 400, size=500)
+    lengths[0] = 1900
+    sampler = MultipackDistributedBatchSampler(
+        batch_max_length=BATCH_MAX_LENGTH,
+        lengths=lengths,
+        num_replicas=1,
+        rank=0,
+        padding=False,
+        prefetch_next_epoch=False,
+    )
+    sampler.set_epoch(0)
+    train_loader = DataLoader(
+        LengthsDataset(lengths), batch_sampler=sampler, collate_fn=list
+    )
+    steps, events = run_epoch(train_loader, OOMGuard(enabled=True), oom_batch=7)
+
+    # 0.8 of the capacity would not fit the longest sample
+    assert events[0]["batch_max_length"] == 1900
+    assert events[0]["restart_batch"] == 6
+    # batch 6 was done when batch 7 failed, the step is retried from batch 6 and
+    # the micro-step counter goes back to where that step started
+    assert steps[:9] == [(step, step - 1) for step in range(1, 8)] + [(7, 6), (8, 7)]
+    retried = steps[7:]
+    assert [step for step, _ in retried] == list(range(7, 7 + len(retried)))
+    # the rest of the epoch runs on the new plan
+    assert retried[-1][1] == len(train_loader) - 1
+
+
+def test_recover_step_skips_the_window_without_multipack():
+    lengths = np.full(20, 100)
+    train_loader = DataLoader(LengthsDataset(lengths), batch_size=2, collate_fn=list)
+    steps, events = run_epoch(train_loader, OOMGuard(enabled=True), oom_batch=6)
+
+    assert "restart_batch" not in events[0]
+    # the OOM in the first micro-batch of the fourth step drops its whole window
+    assert [batch_index for _, batch_index in steps] == [0, 1, 2, 3, 4, 5, 8, 9]
+    assert [step for step, _ in steps] == [1, 2, 3, 4, 5, 6, 9, 10]
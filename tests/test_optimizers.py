@@ -0,0 +1,168 @@
+# SPDX-License-Identifier: Apache-2.0
+
+# Standard
+import os
+import socket
+import warnings
+
+# Third Party
+import pytest
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+# First Party
+from instructlab.training.config import OptimizerType
+from instructlab.training.optimizers import (
+    OPTIMIZERS,
+    AdamWBF16State,
+    create_optimizer,
+    make_param_groups,
+    optimizer_state_bytes,
+)
+
+
+class Block(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.proj = torch.nn.Linear(8, 8)
+        self.norm = torch.nn.LayerNorm(8)
+
+    def forward(self, hidden_states):
+        return self.norm(self.proj(hidden_states))
+
+
+class TinyModel(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.block = Block()
+        self.final_norm = torch.nn.LayerNorm(8)
+        self.head = torch.nn.Linear(8, 4, bias=False)
+
+    def forward(self, hidden_states):
+        return self.head(self.final_norm(self.block(hidden_states)))
+
+
+def group_names(model, groups):
+    names = {id(param): name for name, param in model.named_parameters()}
+    return [
+        (sorted(names[id(param)] for param in group["params"]), group["weight_decay"])
+        for group in groups
+    ]
+
+
+def test_biases_and_norms_are_not_decayed():
+    model = TinyModel()
+    model.head.weight.requires_grad_(False)
+    assert group_names(model, make_param_groups(model, 0.1)) == [
+        (["block.proj.weight"], 0.1),
+        (
+            [
+                "block.norm.bias",
+                "block.norm.weight",
+                "block.proj.bias",
+                "final_norm.bias",
+                "final_norm.weight",
+            ],
+            0.0,
+        ),
+    ]
+    # without weight decay a single group holds every trainable parameter
+    [group] = make_param_groups(model, 0.0)
+    assert len(group["params"]) == 6
+    assert group["weight_decay"] == 0.0
+
+
+def _group_flat_params(rank, world_size, port):
+    # Third Party
+    from torch.distributed.fsdp import FullyShardedDataParallel as FSDP
+    from torch.distributed.fsdp.wrap import ModuleWrapPolicy
+
+    os.environ.update(MASTER_ADDR="127.0.0.1", MASTER_PORT=str(port))
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    try:
+        torch.manual_seed(0)
+        # flat parameters, as FSDP is set up for LoRA
+        model = FSDP(
+            TinyModel(),
+            auto_wrap_policy=ModuleWrapPolicy({Block, torch.nn.LayerNorm}),
+            device_id=torch.device("cpu"),
+            use_orig_params=False,
+        )
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            groups = make_param_groups(model, 0.1)
+        decayed, not_decayed = group_names(model, groups)
+
+        # the head is alone in the root unit and the norms have units of their
+        # own, only the projection's weight and bias share a flat parameter
+        assert all(name.endswith("_flat_param") for name in decayed[0])
+        assert len(decayed[0]) == 2 and decayed[1] == 0.1
+        assert len(not_decayed[0]) == 2 and not_decayed[1] == 0.0
+        assert all("norm" in name for name in not_decayed[0])
+        assert len(caught) == 1
+        assert "1 flattened FSDP parameters" in str(caught[0].message)
+    finally:
+        dist.destroy_process_group()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def test_flat_params_are_grouped_by_their_original_names():
+    world_size = 2
+    mp.spawn(_group_flat_params, args=(world_size, free_port()), nprocs=world_size)
+
+
+def test_adamw_bf16_state_matches_adamw():
+    torch.manual_seed(0)
+    reference = TinyModel()
+    model = TinyModel()
+    model.load_state_dict(reference.state_dict())
+    betas = (0.9, 0.95)
+    expected = torch.optim.AdamW(
+        make_param_groups(reference, 0.1), lr=1e-3, betas=betas
+    )
+    optimizer = AdamWBF16State(make_param_groups(model, 0.1), lr=1e-3, betas=betas)
+
+    for _ in range(20):
+        inputs = torch.randn(16, 8)
+        for net, opt in ((reference, expected), (model, optimizer)):
+            opt.zero_grad()
+            net(inputs).square().mean().backward()
+            opt.step()
+
+    for (name, param), ref in zip(model.named_parameters(), reference.parameters()):
+        torch.testing.assert_close(param, ref, atol=3e-4, rtol=0, msg=name)
+    # both moments are stored in bf16, half the fp32 state
+    num_params = sum(param.numel() for param in model.parameters())
+    assert optimizer_state_bytes(optimizer) == 2 * 2 * num_params
+    assert optimizer_state_bytes(expected) > 2 * 4 * num_params
+
+
+def test_every_optimizer_type_is_registered():
+    assert set(OPTIMIZERS) == {optimizer_type.value for optimizer_type in OptimizerType}
+
+
+@pytest.mark.parametrize(
+    "optimizer_type, cls",
+    [
+        (OptimizerType.ADAMW, torch.optim.AdamW),
+        ("adamw_foreach", torch.optim.AdamW),
+        ("adamw_bf16_state", AdamWBF16State),
+    ],
+)
+def test_create_optimizer(optimizer_type, cls):
+    model = TinyModel()
+    optimizer = create_optimizer(
+        optimizer_type, make_param_groups(model, 0.1), lr=1e-4, betas=(0.9, 0.95)
+    )
+    assert type(optimizer) is cls
+    assert [group["weight_decay"] for group in optimizer.param_groups] == [0.1, 0.0]
+    assert all(group["lr"] == 1e-4 for group in optimizer.param_groups)
+
+    with pytest.raises(ValueError):
+        create_optimizer("sgd", [], lr=1e-4, betas=(0.9, 0.95))
@@ -0,0 +1,55 @@
+# SPDX-License-Identifier: Apache-2.0
+
+# Third Party
+import pytest
+import torch
+
+# First Party
+from instructlab.training.profiler import StepPhaseProfiler, parse_step_range
+
+
+def run_steps(profiler, steps):
+    for step in steps:
+        profiler.start_step(step)
+        with profiler.phase("forward"):
+            torch.ones(8, 8).sum()
+        profiler.end_step(step)
+
+
+def traces(tmp_path):
+    return sorted(path.name for path in tmp_path.iterdir())
+
+
+def test_parse_step_range():
+    assert parse_step_range(None) is None
+    assert parse_step_range("3:5") == (3, 5)
+    with pytest.raises(ValueError):
+        parse_step_range("5:3")
+
+
+def test_trace_covers_the_step_range(tmp_path):
+    profiler = StepPhaseProfiler(trace_steps=(3, 5), trace_dir=tmp_path, use_cuda=False)
+    run_steps(profiler, range(1, 10))
+    assert traces(tmp_path) == ["trace_rank0_steps3-5.json"]
+
+
+def test_trace_starts_when_resumed_past_start(tmp_path):
+    profiler = StepPhaseProfiler(trace_steps=(3, 5), trace_dir=tmp_path, use_cuda=False)
+    run_steps(profiler, range(4, 10))
+    assert traces(tmp_path) == ["trace_rank0_steps3-5.json"]
+
+
+def test_trace_ends_when_end_step_is_skipped(tmp_path):
+    profiler = StepPhaseProfiler(trace_steps=(3, 5), trace_dir=tmp_path, use_cuda=False)
+    run_steps(profiler, [1, 2, 4, 6, 7, 8])
+    assert traces(tmp_path) == ["trace_rank0_steps3-5.json"]
+
+
+def test_phase_durations(tmp_path):
+    profiler = StepPhaseProfiler(enabled=True, use_cuda=False)
+    run_steps(profiler, range(3))
+    with profiler.phase("checkpoint", host=True):
+        pass
+    summary = profiler.flush()
+    assert set(summary) == {"forward", "checkpoint"}
+    assert profiler.flush() == {}
@@ -0,0 +1,56 @@
+# SPDX-License-Identifier: Apache-2.0
+
+# Third Party
+import torch
+
+# First Party
+from instructlab.training.oom_recovery import OOMGuard
+from instructlab.training.token_budget import TokenBudget
+
+
+def test_steps_end_at_the_token_target():
+    budget = TokenBudget(100)
+    model = torch.nn.Linear(2, 1)
+    model(torch.ones(1, 2)).sum().backward()
+    grad = model.weight.grad.clone()
+
+    for tokens in (40, 40):
+        budget.add(tokens)
+        assert not budget.is_step_boundary()
+    budget.add(40)
+    assert budget.is_step_boundary()
+    assert budget.finish_step(model) == 120
+    # the losses were scaled for 100 tokens, the step had 120
+    torch.testing.assert_close(model.weight.grad, grad * 100 / 120)
+
+    assert budget.flush() == {"tokens_seen": 120, "micro_batches_per_step": 3}
+
+
+def test_dropped_micro_batches_are_not_counted():
+    budget = TokenBudget(100)
+    model = torch.nn.Linear(2, 1)
+    budget.add(60)
+    budget.add(60, failed=True)
+    budget.drop_step()
+
+    budget.add(50)
+    budget.add(50)
+    budget.finish_step(model)
+    assert budget.flush() == {"tokens_seen": 100, "micro_batches_per_step": 2}
+
+
+def test_add_carries_the_oom_vote():
+    budget = TokenBudget(100)
+    guard = OOMGuard(enabled=True)
+    with guard.catch():
+        raise torch.cuda.OutOfMemoryError("CUDA out of memory")
+    assert guard.failed
+
+    num_failed = budget.add(10, failed=guard.failed)
+    assert num_failed == 1
+    assert guard.vote("forward", num_failed_ranks=num_failed)
+    assert not guard.failed
+    assert guard.failed_phase == "forward"
+
+    assert budget.add(10, failed=guard.failed) == 0
+    assert not guard.vote("forward", num_failed_ranks=0)
@@ -0,0 +1,29 @@
+# SPDX-License-Identifier: Apache-2.0
+
+# Standard
+import json
+
+# Third Party
+import pytest
+
+pytest.importorskip("accelerate")
+pytest.importorskip("datasets")
+pytest.importorskip("instructlab.dolomite")
+pytest.importorskip("transformers")
+
+# First Party
+from instructlab.training.token_dataset import TokenDataset
+
+
+def test_num_loss_counted_tokens(tmp_path):
+    samples = [
+        {"input_ids": [1, 2, 3, 4], "labels": [-100, -100, 3, 4]},
+        {"input_ids": [5, 6], "labels": [-100, -100]},
+        {"input_ids": [7, 8, 9], "labels": [7, 8, 9]},
+    ]
+    data_path = tmp_path / "data.jsonl"
+    data_path.write_text("".join(json.dumps(sample) + "\n" for sample in samples))
+
+    dataset = TokenDataset(str(data_path))
+    assert dataset.get_num_loss_counted_tokens() == 5
+    assert dataset.get_lengths().tolist() == [4, 2, 3]
@@ -0,0 +1,132 @@
+# SPDX-License-Identifier: Apache-2.0
+
+# Third Party
+import pytest
+import torch
+
+# First Party
+from instructlab.training.torch_compile import (
+    bucket_length,
+    compile_decoder_blocks,
+    make_length_buckets,
+)
+
+
+@pytest.mark.parametrize("max_length", [100, 1000, 4096, 60000])
+def test_make_length_buckets(max_length):
+    buckets = make_length_buckets(max_length, num_buckets=8, multiple=128)
+    assert buckets == sorted(set(buckets))
+    assert len(buckets) <= 8
+    assert all(bucket % 128 == 0 for bucket in buckets)
+    # the largest bucket fits every batch, rounded up to the multiple
+    assert max_length <= buckets[-1] < max_length + 128
+
+
+def test_bucket_length():
+    buckets = [128, 256, 512]
+    assert bucket_length(1, buckets) == 128
+    assert bucket_length(128, buckets) == 128
+    assert bucket_length(129, buckets) == 256
+    assert bucket_length(512, buckets) == 512
+    # longer than every bucket, or no buckets at all
+    assert bucket_length(513, buckets) == 513
+    assert bucket_length(300, None) == 300
+    assert bucket_length(300, []) == 300
+
+
+class Block(torch.nn.Module):
+    def __init__(self, hidden_size):
+        super().__init__()
+        self.norm = torch.nn.LayerNorm(hidden_size)
+        self.mlp = torch.nn.Linear(hidden_size, hidden_size)
+
+    def forward(self, hidden_states):
+        return hidden_states + self.mlp(self.norm(hidden_states)).relu()
+
+
+class TinyModel(torch.nn.Module):
+    def __init__(self, hidden_size=16, num_blocks=2):
+        super().__init__()
+        self.embed = torch.nn.Embedding(32, hidden_size)
+        self.blocks = torch.nn.ModuleList(Block(hidden_size) for _ in range(num_blocks))
+
+    def forward(self, input_ids):
+        hidden_states = self.embed(input_ids)
+        for block in self.blocks:
+            hidden_states = block(hidden_states)
+        return hidden_states
+
+
+def test_compile_decoder_blocks_reuses_graphs_per_bucket():
+    torch._dynamo.reset()
+    torch.manual_seed(0)
+    model = TinyModel()
+    names = [name for name, _ in model.named_parameters()]
+    stats = compile_decoder_blocks(model, "Block", num_buckets=2)
+    # the blocks are compiled in place, so FSDP wrapping and checkpoints see the
+    # same module classes and parameter names
+    assert [name for name, _ in model.named_parameters()] == names
+    assert all(isinstance(block, Block) for block in model.blocks)
+
+    buckets = [8, 16]
+    model(torch.randint(32, (1, buckets[0]))).sum().backward()
+    first = stats.flush()
+    assert first["compiles"] > 0
+
+    # a bucket that was already seen reuses its graph
+    model(torch.randint(32, (1, buckets[0]))).sum().backward()
+    repeated = stats.flush()
+    assert repeated["compiles"] == 0
+    assert repeated["compile_cache_hits"] == len(model.blocks)
+    assert repeated["total_compiles"] == first["total_compiles"]
+
+    # a new bucket compiles once more
+    model(torch.randint(32, (1, buckets[1]))).sum().backward()
+    assert stats.flush()["compiles"] > 0
+
+
+def make_samples(lengths):
+    return [
+        {
+            "input_ids": torch.arange(length) + 1,
+            "labels": torch.arange(length) + 1,
+            "attention_mask": torch.ones(length, dtype=torch.long),
+        }
+        for length in lengths
+    ]
+
+
+@pytest.fixture
+def make_collate_fn(monkeypatch):
+    pytest.importorskip("accelerate")
+    pytest.importorskip("instructlab.dolomite")
+    pytest.importorskip("transformers")
+    monkeypatch.setenv("RANK", "0")
+    # First Party
+    from instructlab.training.utils import make_collate_fn
+
+    return make_collate_fn
+
+
+def test_packed_collate_pads_to_bucket(make_collate_fn):
+    collate = make_collate_fn(
+        pad_token_id=0, flash_enabled=True, length_buckets=[128, 256]
+    )
+    batch = collate(make_samples([50, 70, 30]))
+    assert batch["input_ids"].shape == (1, 256)
+    assert batch["position_ids"].shape == (1, 256)
+    # the padding is a sample of its own and never counts towards the loss
+    assert batch["position_ids"][0, 150:].tolist() == list(range(106))
+    assert (batch["labels"][0, 150:] == -100).all()
+    assert batch["total_length"] == 150
+    assert batch["num_loss_counted_tokens"] == 150
+
+
+def test_padded_collate_pads_to_bucket(make_collate_fn):
+    collate = make_collate_fn(
+        pad_token_id=0, flash_enabled=False, length_buckets=[128, 256]
+    )
+    batch = collate(make_samples([50, 100]))
+    assert batch["input_ids"].shape == (2, 128)
+    assert batch["attention_mask"].sum().item() == 150
+    assert int(batch["num_loss_counted_tokens"]) == 150